@@ -0,0 +1,175 @@
+"""
+End-to-end benchmark of run_generation_task against the fake LLM provider, over a grid
+of plan sizes, chunk sizes, concurrency levels and output formats. Uploads are replaced
+by a local no-op, so no network, API key or Cloudinary account is needed:
+
+    cd backend && python -m benchmarks.bench_generation
+    cd backend && python -m benchmarks.bench_generation --questions 20 100 --concurrency 1 4 8 --latency 0.5
+
+Each scenario runs in a fresh process (so peak RSS is per scenario) and reports wall time,
+p50/p95/p99 chunk latency, questions/second, peak RSS and the per-stage breakdown
+(prompt_build, llm, parse, raw_log, render, upload). Results are written as JSON, tagged with the
+git commit, so runs can be compared across commits. Generated files, raw response logs and
+caches go to a temporary BACKEND_DATA_DIR that is deleted afterwards (set BACKEND_DATA_DIR
+to keep them).
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+QTYPES = ["MCQ", "SL", "2S", "AR"]
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+def build_plan(questions: int, chunk_size: int):
+    """Spreads `questions` over QTYPES in whole chunks."""
+    chunks = max(1, questions // chunk_size)
+    plan = {}
+    for i in range(chunks):
+        qtype = QTYPES[i % len(QTYPES)]
+        plan[qtype] = plan.get(qtype, 0) + chunk_size
+    return plan
+
+def run_scenario(scenario: dict) -> dict:
+    """Runs one generation in this (fresh) process and returns its measurements."""
+    from services.Generation import run_generation_task
+    from services.LLMProvider import FakeProvider, set_llm_provider
+    from services.Metrics import get_render_stats, get_stage_timings, reset_stage_timings
+    from services.Rendering import shutdown_render_pool
+
+    set_llm_provider(FakeProvider(
+        latency=scenario["latency_distribution"],
+        latency_seconds=scenario["latency"],
+        malformed_rate=scenario["malformed_rate"],
+        seed=scenario["seed"]
+    ))
+    reset_stage_timings()
+    plan = build_plan(scenario["questions"], scenario["chunk_size"])
+    topics = [f"Benchmark topic {i + 1}" for i in range(sum(plan.values()))]
+
+    chunk_started = {}
+    chunk_latencies = []
+    retries = []
+    def on_event(event, data):
+        now = time.perf_counter()
+        if event == "attempt_retried":
+            retries.append(data["chunk"])
+        elif event == "chunk_started":
+            chunk_started.setdefault(data["chunk"], now)
+        elif event in ("chunk_validated", "chunk_skipped") and data["chunk"] in chunk_started:
+            chunk_latencies.append(now - chunk_started.pop(data["chunk"]))
+
+    started_at = time.perf_counter()
+    try:
+        result = run_generation_task(
+            plan=plan,
+            testing_mode=False,
+            exam_name="Benchmark Exam",
+            output_format=scenario["output_format"],
+            questions_per_chunk=scenario["chunk_size"],
+            topics=topics,
+            max_in_flight=scenario["concurrency"],
+            on_event=on_event,
+            stream=scenario["stream"],
+            structured=scenario["structured"],
+            upload_function=lambda local_path, public_id: f"file://{local_path}"
+        )
+    finally:
+        shutdown_render_pool() # Idle render workers would keep this process from exiting
+    wall_seconds = time.perf_counter() - started_at
+
+    ordered = sorted(chunk_latencies)
+    return {
+        **scenario,
+        "plan": plan,
+        "success": result["success"],
+        "message": result["message"],
+        "wall_seconds": round(wall_seconds, 4),
+        "questions_per_second": round(scenario["questions"] / wall_seconds, 3),
+        "chunk_latency_p50": round(percentile(ordered, 0.50) or 0, 4),
+        "chunk_latency_p95": round(percentile(ordered, 0.95) or 0, 4),
+        "chunk_latency_p99": round(percentile(ordered, 0.99) or 0, 4),
+        "retries": len(retries),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # KiB on Linux
+        "stages": get_stage_timings(),
+        "rendering": get_render_stats(),
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, nargs="+", default=[20, 60], help="Plan sizes (questions per run)")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[2, 5])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--formats", nargs="+", default=["pdf", "docx"], choices=["pdf", "docx"])
+    parser.add_argument("--latency", type=float, default=0.2, help="Median simulated LLM latency (seconds)")
+    parser.add_argument("--latency-distribution", default="lognormal", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--stream", action="store_true", help="Stream completions (STREAM_GPT_RESPONSES)")
+    parser.add_argument("--structured", action="store_true", help="JSON questions instead of the marker format (STRUCTURED_OUTPUT)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="JSON file (default: benchmarks/results/generation_<commit>.json)")
+    args = parser.parse_args()
+
+    scenarios = [
+        {
+            "questions": questions, "chunk_size": chunk_size, "concurrency": concurrency, "output_format": output_format,
+            "latency": args.latency, "latency_distribution": args.latency_distribution,
+            "malformed_rate": args.malformed_rate, "stream": args.stream, "structured": args.structured, "seed": args.seed,
+        }
+        for questions, chunk_size, concurrency, output_format
+        in itertools.product(args.questions, args.chunk_sizes, args.concurrency, args.formats)
+    ]
+
+    results = []
+    # The scenario processes inherit the environment, so they never write to the container's /app/data
+    scratch_dir = None
+    if "BACKEND_DATA_DIR" not in os.environ:
+        scratch_dir = os.environ["BACKEND_DATA_DIR"] = tempfile.mkdtemp(prefix="bench_generation_")
+    try:
+        # max_tasks_per_child=1: every scenario gets a fresh process, so imports and peak RSS don't carry over.
+        # (Not a multiprocessing.Pool: its daemonic workers could not start the render pool.)
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1) as pool:
+            for scenario in scenarios:
+                result = pool.submit(run_scenario, scenario).result()
+                results.append(result)
+                print(f"{scenario['questions']:>4}q chunk={scenario['chunk_size']} x{scenario['concurrency']} {scenario['output_format']}: "
+                      f"{result['wall_seconds']:.2f}s, {result['questions_per_second']:.1f} q/s, "
+                      f"p95 chunk {result['chunk_latency_p95']:.2f}s, {result['retries']} retries, {result['peak_rss_mb']} MB", file=sys.stderr)
+    finally:
+        if scratch_dir is not None:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    commit = git_commit()
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"generation_{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "benchmark": "generation",
+            "commit": commit,
+            "created_at": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "results": results,
+        }, f, indent=2)
+    print(f"Wrote {len(results)} result(s) to {output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
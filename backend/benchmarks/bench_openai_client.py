@@ -0,0 +1,103 @@
+"""
+Measures per-call overhead of a fresh OpenAI client per call (the old call_gpt
+behaviour) against the shared pooled client from services.OpenAIClient.
+
+Runs against a local mock chat-completions server, so no network or API key is needed:
+
+    cd backend && python -m benchmarks.bench_openai_client --calls 200
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_COMPLETION = {
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4-turbo",
+    "choices": [{
+        "index": 0,
+        "message": {"role": "assistant", "content": "--Question Starting--\nQ1. Benchmark question."},
+        "finish_reason": "stop"
+    }],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20}
+}
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+    disable_nagle_algorithm = True
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        MockOpenAIHandler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps(MOCK_COMPLETION).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def time_calls(make_client, calls: int):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        make_client().chat.completions.create(
+            model="gpt-4-turbo",
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=10
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def summarize(name, latencies, connections):
+    ordered = sorted(latencies)
+    return {
+        "client": name,
+        "calls": len(latencies),
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "p50_ms": round(ordered[len(ordered) // 2], 3),
+        "p95_ms": round(ordered[int(len(ordered) * 0.95) - 1], 3),
+        "connections_opened": connections,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("API_KEY", "bench")
+
+    # Imported after OPENAI_BASE_URL is set so the shared client targets the mock server
+    from openai import OpenAI
+    from services.OpenAIClient import get_openai_client, close_openai_clients
+
+    results = []
+    MockOpenAIHandler.connections = 0
+    fresh = time_calls(lambda: OpenAI(api_key="bench", base_url=base_url), args.calls)
+    results.append(summarize("fresh client per call", fresh, MockOpenAIHandler.connections))
+
+    MockOpenAIHandler.connections = 0
+    pooled = time_calls(get_openai_client, args.calls)
+    results.append(summarize("shared pooled client", pooled, MockOpenAIHandler.connections))
+    close_openai_clients()
+    server.shutdown()
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
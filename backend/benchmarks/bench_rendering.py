@@ -0,0 +1,145 @@
+"""
+PDF rendering throughput of the embedded Unicode font against the latin-1 core font
+(PDF_UNICODE_FONT="") the PDFs used before, over a grid of document sizes and render
+pool sizes. Documents are rendered with render_document, as run_generation_task does:
+
+    cd backend && python -m benchmarks.bench_rendering
+    cd backend && python -m benchmarks.bench_rendering --questions 50 500 --processes 0 4 --documents 10
+
+Each scenario runs in a fresh process, so the first document pays for parsing the font
+("cold") and the following ones show the cached font and subsets ("warm"). Reports pages,
+seconds and pages/second per document and peak RSS; results are written as JSON, tagged with
+the git commit, so runs can be compared across commits. Every PDF is also checked structurally
+(see check_pdf), since services.UnicodePdf and services.Rendering patch fpdf 1.7.2 internals.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from benchmarks.bench_generation import git_commit
+
+FONTS = {"latin1": "", "unicode": None} # PDF_UNICODE_FONT per font (None = the default font)
+
+def sample_question(number: int) -> str:
+    """A question with the symbols physics / chemistry papers use (the latin-1 font prints '?' for most)."""
+    return (
+        f"{number}. A particle of mass m = 2.0 × 10⁻³ kg moves with velocity v⃗ = (3î + 4ĵ) m/s under a force "
+        f"F = −kx. Which statement about its energy E = ½mv² + ½kx² is correct when Δx → 0 and θ ≈ 30°?\n"
+        f"(1) E ∝ x²\n(2) E ≥ ½kx² for all x\n(3) ∂E/∂t = 0 only if k ≤ 0\n(4) E = μ₀ε₀c²\n"
+        f"Answer Key: 2\n"
+        f"Solution:\nKinetic energy is never negative, so E − ½kx² = ½mv² ≥ 0. Hence, Option (2) is the right answer."
+    )
+
+_XREF_ENTRY = re.compile(rb"(\d{10}) (\d{5}) ([nf]) ?\r?\n")
+
+def check_pdf(data: bytes) -> int:
+    """Checks that a PDF still opens: header, trailer, a cross-reference table whose offsets point at
+    their objects, and a page tree whose /Count matches its page objects. Returns the page count."""
+    if not data.startswith(b"%PDF-1.") or not data.rstrip().endswith(b"%%EOF"):
+        raise ValueError("missing %PDF header or %%EOF trailer")
+    startxref = re.search(rb"startxref\s+(\d+)\s+%%EOF\s*$", data)
+    if startxref is None or not data.startswith(b"xref", int(startxref.group(1))):
+        raise ValueError("startxref does not point at the cross-reference table")
+    xref = re.compile(rb"xref\s+(\d+) (\d+)\s+").match(data, int(startxref.group(1)))
+    first, count = int(xref.group(1)), int(xref.group(2))
+    position = xref.end()
+    for number in range(first, first + count):
+        entry = _XREF_ENTRY.match(data, position)
+        if entry is None:
+            raise ValueError(f"malformed cross-reference entry for object {number}")
+        position = entry.end()
+        if entry.group(3) == b"n" and not re.match(rb"%d 0 obj" % number, data[int(entry.group(1)):int(entry.group(1)) + 20]):
+            raise ValueError(f"cross-reference offset of object {number} does not point at it")
+    pages = int(re.search(rb"/Type /Pages\s*/Kids \[.*?\]\s*/Count (\d+)", data, re.DOTALL).group(1))
+    page_objects = len(re.findall(rb"/Type /Page\b(?!s)", data))
+    if pages != page_objects or pages == 0:
+        raise ValueError(f"/Count {pages} but {page_objects} page objects")
+    return pages
+
+def run_scenario(scenario: dict) -> dict:
+    """Renders scenario["documents"] PDFs in this (fresh) process and returns their measurements."""
+    if FONTS[scenario["font"]] is not None:
+        os.environ["PDF_UNICODE_FONT"] = FONTS[scenario["font"]]
+    os.environ["RENDER_PROCESSES"] = str(scenario["processes"])
+    from services.Rendering import render_document, shutdown_render_pool
+
+    blocks = [sample_question(i + 1) for i in range(scenario["questions"])]
+    documents = []
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            for i in range(scenario["documents"]):
+                path = os.path.join(folder, f"document_{i}.pdf")
+                started_at = time.perf_counter()
+                render_document(blocks, path, "pdf")
+                seconds = time.perf_counter() - started_at
+                with open(path, "rb") as f:
+                    data = f.read()
+                pages = check_pdf(data)
+                documents.append({"seconds": seconds, "pages": pages, "bytes": len(data)})
+                os.remove(path)
+        finally:
+            shutdown_render_pool() # Idle render workers would keep this process from exiting
+
+    cold, warm = documents[0], documents[1:] or documents
+    warm_seconds = statistics.median(d["seconds"] for d in warm)
+    return {
+        **scenario,
+        "pages": cold["pages"],
+        "document_kb": round(cold["bytes"] / 1024, 1),
+        "cold_seconds": round(cold["seconds"], 4),
+        "cold_pages_per_second": round(cold["pages"] / cold["seconds"], 1),
+        "warm_seconds": round(warm_seconds, 4),
+        "warm_pages_per_second": round(cold["pages"] / warm_seconds, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # KiB on Linux
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, nargs="+", default=[50, 300], help="Questions per document")
+    parser.add_argument("--processes", type=int, nargs="+", default=[0, 4], help="RENDER_PROCESSES (0 = in-process)")
+    parser.add_argument("--fonts", nargs="+", default=list(FONTS), choices=list(FONTS))
+    parser.add_argument("--documents", type=int, default=8, help="Documents per scenario (the first one is cold)")
+    parser.add_argument("--output", default=None, help="JSON file (default: benchmarks/results/rendering_<commit>.json)")
+    args = parser.parse_args()
+
+    scenarios = [
+        {"questions": questions, "processes": processes, "font": font, "documents": args.documents}
+        for questions, processes, font in itertools.product(args.questions, args.processes, args.fonts)
+    ]
+
+    results = []
+    # max_tasks_per_child=1: every scenario gets a fresh process, so fonts are parsed again and peak RSS doesn't carry over
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"), max_tasks_per_child=1) as pool:
+        for scenario in scenarios:
+            result = pool.submit(run_scenario, scenario).result()
+            results.append(result)
+            print(f"{scenario['questions']:>4}q x{scenario['processes']} {scenario['font']:<7}: {result['pages']} pages, "
+                  f"cold {result['cold_seconds']:.3f}s ({result['cold_pages_per_second']:.0f} pages/s), "
+                  f"warm {result['warm_seconds']:.3f}s ({result['warm_pages_per_second']:.0f} pages/s), "
+                  f"{result['document_kb']} KB, {result['peak_rss_mb']} MB", file=sys.stderr)
+
+    commit = git_commit()
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"rendering_{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "benchmark": "rendering",
+            "commit": commit,
+            "created_at": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "results": results,
+        }, f, indent=2)
+    print(f"Wrote {len(results)} result(s) to {output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
 from sqlalchemy.orm import Session
-from models import User, OnboardingData, Syllabus
+from sqlalchemy import func
+from models import User, OnboardingData, Syllabus, BankQuestion, BankQuestionUsage
 from schemas import UserCreate, OnboardingCreate, OnboardingUpdate
 from auth import hash_password
 import pandas as pd
-from typing import List, IO
+from typing import List, IO, Dict, Optional, Tuple
 
 def get_user_by_email(db: Session, email: str):
     return db.query(User).filter(User.email == email).first()
@@ -126,4 +127,43 @@ def delete_syllabus_by_id(db: Session, syllabus_id: int, user_id: int) -> bool:
         db.delete(db_syllabus)
         db.commit()
         return True
-    return False
\ No newline at end of file
+    return False
+
+# Question Bank Funcs
+def get_unused_bank_questions(db: Session, user_id: int, exam_name: str, qtype: str, topics: List[str]) -> Dict[str, List[BankQuestion]]:
+    """
+    Fetches the bank questions for these topics that this user has not been served yet,
+    grouped by topic in random order. Topics without an unused question are missing from the result.
+    """
+    served = db.query(BankQuestionUsage.question_id).filter(BankQuestionUsage.user_id == user_id)
+    candidates = (
+        db.query(BankQuestion)
+        .filter(
+            BankQuestion.exam_name == exam_name,
+            BankQuestion.qtype == qtype,
+            BankQuestion.topic.in_(topics),
+            BankQuestion.id.notin_(served)
+        )
+        .order_by(func.random())
+        .all()
+    )
+    by_topic = {}
+    for question in candidates:
+        by_topic.setdefault(question.topic, []).append(question)
+    return by_topic
+
+def add_bank_questions(db: Session, exam_name: str, qtype: str, entries: List[Tuple[str, str, Optional[dict]]]) -> List[BankQuestion]:
+    """Stores (topic, question_text, question_json) entries in the question bank; question_json holds
+    the fields of structured questions (None for marker-format ones)."""
+    db_questions = [
+        BankQuestion(exam_name=exam_name, qtype=qtype, topic=topic, question_text=text, question_json=fields)
+        for topic, text, fields in entries
+    ]
+    db.add_all(db_questions)
+    db.commit()
+    return db_questions
+
+def mark_bank_questions_served(db: Session, user_id: int, question_ids: List[int]):
+    """Remembers that these bank questions were given to the user."""
+    db.add_all([BankQuestionUsage(user_id=user_id, question_id=qid) for qid in question_ids])
+    db.commit()
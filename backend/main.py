@@ -1,7 +1,8 @@
 # backend/main.py
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, APIRouter
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, APIRouter, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from database import SessionLocal, engine, Base
 from models import User
@@ -18,12 +19,21 @@ from crud import (
 )
 from auth import verify_password, create_access_token, get_current_user_from_token
 
-from typing import Dict, List, Optional
+from typing import Dict, List, Literal, Optional
 from pydantic import BaseModel
 import os
+import json
+import asyncio
 
 # Since uvicorn runs from 'src', Python can find MockTestAutomation directly
-from services.Generation import run_generation_task
+from services.Jobs import submit_generation_job, get_job, cancel_job, resume_batch_jobs
+from services.OpenAIClient import close_openai_clients
+from services.Metrics import get_prompt_usage_stats, get_render_stats
+from services.Rendering import shutdown_render_pool
+from services.RawResponseLog import close_raw_response_log
+from services.RunStore import EXPORT_FORMATS, load_run, export_run, export_filename
+from services.Downloads import file_download
+from services.Generation import estimate_generation_task, OUTPUT_DIR
 from services.PromptsDict import prompt_templates
 
 # Initialize Database
@@ -31,6 +41,16 @@ Base.metadata.create_all(bind=engine)
 
 app = FastAPI(title="AceTrack API", version="1.0.0")
 
+@app.on_event("startup")
+def resume_saved_jobs():
+    resume_batch_jobs()
+
+@app.on_event("shutdown")
+def shutdown_shared_resources():
+    close_openai_clients()
+    shutdown_render_pool()
+    close_raw_response_log()
+
 # --- Pydantic Models for Mock Test Generator ---
 class QuestionGenerationRequest(BaseModel):
     question_plan: Dict[str, int]
@@ -39,11 +59,40 @@ class QuestionGenerationRequest(BaseModel):
     output_format: str = 'pdf'
     questions_per_chunk: int
     syllabus_id: int 
+    use_question_bank: bool = False
+    output_mode: Literal['online', 'batch'] = 'online' # 'batch' = OpenAI Batch API: cheaper, finishes within hours
+    deadline_seconds: Optional[float] = None # Stop and return the validated questions after this long
+    cancel_on_disconnect: bool = False # Cancel when the client stops polling / streaming events
+    structured_output: Optional[bool] = None # JSON questions instead of the marker format (None = server default)
 
 class QuestionGenerationResponse(BaseModel):
     success: bool
     message: str
     files: Optional[Dict[str, str]] = None
+    job_id: Optional[str] = None
+
+class GenerationEstimateResponse(BaseModel):
+    requests: int
+    questions: int
+    input_tokens: int
+    output_tokens: int
+    max_tokens: int
+    estimated_cost_usd: float
+    tokenizer: str
+    per_qtype: Dict[str, dict]
+    packing_limited: List[dict] = [] # Packing factors cut down by the output token budget
+
+class GenerationJobResponse(BaseModel):
+    job_id: str
+    status: str
+    message: str
+    chunks_total: int
+    chunks_done: int
+    chunks_failed: int
+    files: Dict[str, str] = {}
+    error: Optional[str] = None
+    created_at: str
+    finished_at: Optional[str] = None
 
 class QuestionType(BaseModel):
     name: str
@@ -72,6 +121,10 @@ def get_db():
     finally:
         db.close()
 
+# Seconds between SSE keep-alive comments so proxies don't drop an idle stream
+SSE_HEARTBEAT_SECONDS = 15
+SSE_POLL_SECONDS = 0.5
+
 # --- Create Router with /api prefix ---
 api_router = APIRouter(prefix="/api")
 
@@ -116,23 +169,119 @@ async def generate_questions(
         if not syllabus:
             raise HTTPException(status_code=404, detail="Syllabus not found or you don't have access to it")
         
-        result = run_generation_task(
+        # The run happens on a background worker; the client polls /api/jobs/{job_id}
+        job = submit_generation_job(
+            user_id=current_user["user_id"],
             plan=request.question_plan,
             testing_mode=request.testing_mode,
             exam_name=request.exam_name,
             output_format=request.output_format,
             questions_per_chunk=request.questions_per_chunk,
-            topics=syllabus.topics
+            topics=list(syllabus.topics),
+            use_question_bank=request.use_question_bank,
+            output_mode=request.output_mode,
+            deadline_seconds=request.deadline_seconds,
+            cancel_on_disconnect=request.cancel_on_disconnect,
+            structured=request.structured_output
+        )
+        return QuestionGenerationResponse(
+            success=True,
+            message="Question generation started.",
+            job_id=job.id
         )
-        if not result["success"]:
-            raise HTTPException(status_code=500, detail=result["message"])
-
-        return result
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
+# Plain def: tokenizing every prompt and the syllabus query block, so FastAPI runs it in its threadpool
+@api_router.post("/generate-questions/estimate", response_model=GenerationEstimateResponse)
+def estimate_generation(
+    request: QuestionGenerationRequest,
+    current_user: dict = Depends(get_current_user_from_token),
+    db: Session = Depends(get_db)
+):
+    syllabus = get_syllabus_by_id(db, request.syllabus_id, current_user["user_id"])
+    if not syllabus:
+        raise HTTPException(status_code=404, detail="Syllabus not found or you don't have access to it")
+    try:
+        # Dry run: same chunking and prompts as /generate-questions, but nothing is sent to GPT
+        return estimate_generation_task(
+            plan=request.question_plan,
+            exam_name=request.exam_name,
+            questions_per_chunk=request.questions_per_chunk,
+            topics=list(syllabus.topics),
+            structured=request.structured_output
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.get("/generate-questions/{run_id}/events")
+async def stream_generation_events(
+    run_id: str,
+    current_user: dict = Depends(get_current_user_from_token),
+    last_event_id: Optional[str] = Header(default=None)
+):
+    job = get_job(run_id, current_user["user_id"])
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    # Resume after the last event the client saw when it reconnects
+    next_index = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+
+    async def event_stream():
+        nonlocal next_index
+        idle_seconds = 0.0
+        while True:
+            job.touch() # An open event stream counts as the client still waiting
+            events = job.events_since(next_index)
+            for index, event, data in events:
+                yield f"id: {index}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+                next_index = index + 1
+                if event == "job_finished":
+                    return
+            if events:
+                idle_seconds = 0.0
+            elif idle_seconds >= SSE_HEARTBEAT_SECONDS:
+                yield ": keep-alive\n\n"
+                idle_seconds = 0.0
+            # Poll without tying up a threadpool worker per subscriber
+            await asyncio.sleep(SSE_POLL_SECONDS)
+            idle_seconds += SSE_POLL_SECONDS
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/jobs/{job_id}", response_model=GenerationJobResponse)
+async def get_generation_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user_from_token)
+):
+    job = get_job(job_id, current_user["user_id"])
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job.to_dict()
+
+@api_router.delete("/jobs/{job_id}", response_model=GenerationJobResponse)
+async def cancel_generation_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user_from_token)
+):
+    job = cancel_job(job_id, current_user["user_id"])
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job.to_dict()
+
+@api_router.get("/metrics/prompt-usage")
+async def prompt_usage_metrics(current_user: dict = Depends(get_current_user_from_token)):
+    return get_prompt_usage_stats()
+
+@api_router.get("/metrics/rendering")
+async def rendering_metrics(current_user: dict = Depends(get_current_user_from_token)):
+    return get_render_stats()
+
 @api_router.get("/wakeup")
 async def wakeup():
     return {"mssg":"I am ready"}
@@ -140,18 +289,43 @@ async def wakeup():
 @api_router.get("/download-questions/{filename}")
 async def download_questions_file(
     filename: str,
+    request: Request,
     current_user: dict = Depends(get_current_user_from_token)
 ):
     if ".." in filename or "/" in filename:
         raise HTTPException(status_code=400, detail="Invalid filename.")
     
-    current_script_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_script_dir, "data", "generated_files", filename)
+    file_path = os.path.join(OUTPUT_DIR, filename)
 
-    if not os.path.exists(file_path):
+    try:
+        # ETag / 304, byte ranges and the content type of the file's extension
+        return await run_in_threadpool(file_download, request, file_path, filename)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail=f"File not found.")
-    
-    return FileResponse(path=file_path, filename=filename, media_type='application/pdf')
+
+@api_router.get("/download-questions/{run_id}/{export_format}")
+async def download_run_export(
+    run_id: str,
+    export_format: str,
+    request: Request,
+    current_user: dict = Depends(get_current_user_from_token)
+):
+    # Any format of a finished run, rendered from its saved questions on first download
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format. Use one of: {', '.join(EXPORT_FORMATS)}.")
+    run = await run_in_threadpool(load_run, run_id)
+    if not run or run["user_id"] != current_user["user_id"]:
+        raise HTTPException(status_code=404, detail="Run not found.")
+    try:
+        file_path = await run_in_threadpool(export_run, run_id, export_format)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not export the run: {str(e)}")
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="Run not found.")
+    try:
+        return await run_in_threadpool(file_download, request, file_path, export_filename(run_id, export_format), EXPORT_FORMATS[export_format][1])
+    except FileNotFoundError: # Evicted from the export cache in the meantime
+        raise HTTPException(status_code=503, detail="The export was evicted, please retry.", headers={"Retry-After": "1"})
 
 # ===============================================================
 # === SYLLABUS API ENDPOINTS ===
@@ -9,6 +9,8 @@ def run_migration():
             # Add the missing column
             print("--- Adding is_authorized column to users table ---")
             connection.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_authorized BOOLEAN DEFAULT FALSE;"))
+            print("--- Adding question_json column to question_bank table ---")
+            connection.execute(text("ALTER TABLE question_bank ADD COLUMN IF NOT EXISTS question_json JSON;"))
             
             # Manually authorize your account (replace with your email)
             print("--- Authorizing admin user ---")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, Date, JSON, ForeignKey, ARRAY
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, Date, JSON, ForeignKey, ARRAY, Index, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
@@ -52,4 +52,33 @@ class Syllabus(Base):
     
     # Foreign key to link this syllabus to a user
     owner_id = Column(Integer, ForeignKey("users.id"))
-    owner = relationship("User", back_populates="syllabuses")
\ No newline at end of file
+    owner = relationship("User", back_populates="syllabuses")
+
+class BankQuestion(Base):
+    """A validated question kept for reuse by later runs of the same exam/qtype/topic."""
+    __tablename__ = "question_bank"
+
+    id = Column(Integer, primary_key=True, index=True)
+    exam_name = Column(String, nullable=False)
+    qtype = Column(String, nullable=False)
+    topic = Column(String, nullable=False)
+    question_text = Column(Text, nullable=False)
+    question_json = Column(JSON, nullable=True)  # Fields of a structured (JSON) question; NULL for marker-format ones
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_question_bank_exam_qtype_topic", "exam_name", "qtype", "topic"),
+    )
+
+class BankQuestionUsage(Base):
+    """Records which bank questions a user has already received, so they are never repeated."""
+    __tablename__ = "question_bank_usage"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    question_id = Column(Integer, ForeignKey("question_bank.id", ondelete="CASCADE"), nullable=False)
+    served_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "question_id", name="uq_question_bank_usage_user_question"),
+    )
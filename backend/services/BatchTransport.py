@@ -0,0 +1,136 @@
+import json
+import os
+import tempfile
+import uuid
+from typing import Callable, Dict, Optional
+
+from services.OpenAIClient import get_openai_client
+
+# ===============================================================
+# === BATCH TRANSPORTS ===
+# ===============================================================
+# A transport takes a JSONL file of chat-completion requests (OpenAI Batch API
+# format), runs it, and hands back {custom_id: response_content or None}.
+# Generation only talks to this interface, so the OpenAI Batch API can be swapped
+# for a local file-based stand-in.
+
+BATCH_COMPLETION_WINDOW = os.getenv("BATCH_COMPLETION_WINDOW", "24h")
+BATCH_FINAL_STATES = ("completed", "failed", "expired", "cancelled")
+# Where simulated batches (testing runs, fake provider) are answered when BATCH_TRANSPORT_DIR is not set
+SIMULATED_BATCH_DIR = os.path.join(tempfile.gettempdir(), "simulated_batches")
+
+def parse_batch_output_line(line: str):
+    """Returns (custom_id, content) for one Batch API output line; content is None for failed requests."""
+    record = json.loads(line)
+    response = record.get("response") or {}
+    if record.get("error") or response.get("status_code") != 200:
+        return record.get("custom_id"), None
+    choices = (response.get("body") or {}).get("choices") or []
+    content = choices[0]["message"]["content"] if choices else None
+    return record.get("custom_id"), content
+
+class OpenAIBatchTransport:
+    """Runs batches through the OpenAI Batch API (/v1/batches)."""
+
+    def __init__(self, client=None):
+        self.client = client or get_openai_client()
+
+    def submit(self, requests_path: str) -> str:
+        with open(requests_path, "rb") as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=BATCH_COMPLETION_WINDOW
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        batch = self.client.batches.retrieve(batch_id)
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    custom_id, content = parse_batch_output_line(line)
+                    results[custom_id] = content
+        return results
+
+    def cancel(self, batch_id: str):
+        self.client.batches.cancel(batch_id)
+
+class FileBatchTransport:
+    """Local stand-in for the Batch API. `submit` copies the requests to <dir>/<id>_input.jsonl and the
+    batch completes once <dir>/<id>_output.jsonl exists (same line format as the Batch API).
+    If a responder(request_body) -> content callable is given, the output is written immediately."""
+
+    def __init__(self, directory: str, responder: Callable[[dict], str] = None):
+        self.directory = directory
+        self.responder = responder
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, batch_id: str, kind: str) -> str:
+        return os.path.join(self.directory, f"{batch_id}_{kind}.jsonl")
+
+    def submit(self, requests_path: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        with open(requests_path, "r", encoding="utf-8") as src, open(self._path(batch_id, "input"), "w", encoding="utf-8") as dst:
+            dst.write(src.read())
+        if self.responder is not None:
+            self._respond(batch_id)
+        return batch_id
+
+    def _respond(self, batch_id: str):
+        with open(self._path(batch_id, "input"), "r", encoding="utf-8") as src, open(self._path(batch_id, "output"), "w", encoding="utf-8") as dst:
+            for line in src:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    content = self.responder(request["body"])
+                except Exception as e: # Recorded as a failed request, like the Batch API does
+                    dst.write(json.dumps({"custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}}) + "\n")
+                    continue
+                dst.write(json.dumps({
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}},
+                    "error": None
+                }) + "\n")
+
+    def status(self, batch_id: str) -> str:
+        if os.path.exists(self._path(batch_id, "cancelled")):
+            return "cancelled"
+        return "completed" if os.path.exists(self._path(batch_id, "output")) else "in_progress"
+
+    def results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        results = {}
+        with open(self._path(batch_id, "output"), "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    custom_id, content = parse_batch_output_line(line)
+                    results[custom_id] = content
+        return results
+
+    def cancel(self, batch_id: str):
+        open(self._path(batch_id, "cancelled"), "w").close()
+
+def provider_responder(provider) -> Callable[[dict], str]:
+    """Answers batch requests with an LLM provider's completions (e.g. the fake provider)."""
+    def respond(body: dict) -> str:
+        return provider.complete(body["model"], body["messages"], body["max_tokens"], body["temperature"], body.get("response_format")).content
+    return respond
+
+def get_batch_transport(provider=None):
+    """A simulated provider (testing runs, LLM_PROVIDER=fake) answers batches through the file-based
+    stand-in right away, so they never reach the OpenAI Batch API. Otherwise the stand-in is used when
+    BATCH_TRANSPORT_DIR is set, the OpenAI Batch API if not."""
+    directory = os.getenv("BATCH_TRANSPORT_DIR")
+    if provider is not None and provider.simulated:
+        return FileBatchTransport(directory or SIMULATED_BATCH_DIR, responder=provider_responder(provider))
+    if directory:
+        return FileBatchTransport(directory)
+    return OpenAIBatchTransport()
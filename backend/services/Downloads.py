@@ -0,0 +1,148 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+# ===============================================================
+# === FILE DOWNLOADS ===
+# ===============================================================
+# Downloads were always sent in full as application/pdf, without validators, so every
+# retry or repeated download re-sent the whole paper. Generated files never change
+# once written (they are named by run_id, and documents and exports are written to a
+# temporary file that is renamed into place once complete), so they are sent
+# with a strong ETag from their content, immutable cache headers, 304 Not Modified for
+# If-None-Match and single byte ranges for resumed downloads.
+
+# How long clients may reuse a download without asking again (the files never change)
+DOWNLOAD_MAX_AGE_SECONDS = int(os.getenv("DOWNLOAD_MAX_AGE_SECONDS", str(365 * 24 * 3600)))
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+# ETags of recently downloaded files, so a file is only hashed once
+MAX_CACHED_ETAGS = 1024
+
+MEDIA_TYPES = {
+    ".pdf": "application/pdf",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".json": "application/json",
+    ".csv": "text/csv; charset=utf-8",
+}
+
+def media_type_for(filename: str) -> str:
+    extension = os.path.splitext(filename)[1].lower()
+    return MEDIA_TYPES.get(extension) or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+_etags: "OrderedDict[tuple, str]" = OrderedDict()
+_etags_lock = threading.Lock()
+
+def file_etag(f, stat: os.stat_result) -> str:
+    """Strong ETag of an open file: a hash of its content, cached per (inode, size, mtime)."""
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _etags_lock:
+        if key in _etags:
+            _etags.move_to_end(key)
+            return _etags[key]
+    digest = hashlib.sha256()
+    f.seek(0)
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        digest.update(chunk)
+    etag = f'"{digest.hexdigest()[:32]}"'
+    with _etags_lock:
+        _etags[key] = etag
+        while len(_etags) > MAX_CACHED_ETAGS:
+            _etags.popitem(last=False)
+    return etag
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match uses the weak comparison: W/"x" matches "x"."""
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+_BYTE_RANGE = re.compile(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$", re.IGNORECASE)
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """(first, last) byte of a single-range Range header. None for anything else (multiple
+    ranges, other units, garbage): the full file is sent then, as HTTP allows."""
+    match = _BYTE_RANGE.match(header)
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first: # Suffix range: the last N bytes
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - int(last)), size - 1
+    first = int(first)
+    if first >= size:
+        raise RangeNotSatisfiable()
+    last = min(int(last), size - 1) if last else size - 1
+    if last < first:
+        return None
+    return first, last
+
+def _read_file(f, first: int, length: int):
+    try:
+        f.seek(first)
+        while length > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK_BYTES, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def file_download(request: Request, path: str, filename: str, media_type: str = None) -> Response:
+    """Response for downloading a generated file, honouring If-None-Match, Range and If-Range.
+    Reads and may hash the file, so call it in a worker thread. Raises FileNotFoundError."""
+    f = open(path, "rb")
+    try:
+        stat = os.fstat(f.fileno())
+        etag = file_etag(f, stat)
+        headers = {
+            "ETag": etag,
+            "Cache-Control": f"private, max-age={DOWNLOAD_MAX_AGE_SECONDS}, immutable",
+            "Accept-Ranges": "bytes",
+        }
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            f.close()
+            return Response(status_code=304, headers=headers)
+
+        size = stat.st_size
+        byte_range = None
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        # If-Range: resume only if the client's copy is this file (strong comparison), else send it all
+        if range_header and (if_range is None or if_range.strip() == etag):
+            try:
+                byte_range = parse_byte_range(range_header, size)
+            except RangeNotSatisfiable:
+                f.close()
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+        quoted = quote(filename)
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quoted}" if quoted != filename else f'attachment; filename="{filename}"'
+        media_type = media_type or media_type_for(filename)
+        if byte_range is None:
+            headers["Content-Length"] = str(size)
+            return StreamingResponse(_read_file(f, 0, size), media_type=media_type, headers=headers)
+        first, last = byte_range
+        headers["Content-Length"] = str(last - first + 1)
+        headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+        return StreamingResponse(_read_file(f, first, last - first + 1), status_code=206, media_type=media_type, headers=headers)
+    except BaseException:
+        f.close()
+        raise
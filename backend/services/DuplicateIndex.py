@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from services.Storage import data_path
+
+# ===============================================================
+# === CROSS-RUN NEAR-DUPLICATE DETECTION ===
+# ===============================================================
+# Users generating several papers from one syllabus kept getting near-identical
+# questions. Every shipped question's MinHash signature is kept in an LSH index per
+# (user, exam), persisted as append-only JSONL, and new questions too similar to
+# one already served (or to one earlier in the same run) are regenerated.
+
+# "reject" (regenerate near-duplicates), "flag" (only report them) or "off"
+DUPLICATE_QUESTIONS_MODE = os.getenv("DUPLICATE_QUESTIONS_MODE", "reject").lower()
+DUPLICATE_INDEX_DIR = os.getenv("DUPLICATE_INDEX_DIR", data_path("duplicate_index"))
+# Estimated Jaccard similarity of word 3-grams from which a question counts as a near-duplicate
+DUPLICATE_SIMILARITY_THRESHOLD = float(os.getenv("DUPLICATE_SIMILARITY_THRESHOLD", "0.7"))
+# 16 bands of 4 rows: pairs from ~0.5 similarity are compared, well below the threshold
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+SHINGLE_SIZE = 3
+# (user, exam) indexes kept in memory
+MAX_LOADED_INDEXES = 64
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+# Fixed seed: signatures are persisted, so the permutations must never change.
+# a, b < 2^31 and 32-bit shingle hashes keep a * x + b below 2^64.
+_permutation_rng = np.random.RandomState(20240601)
+_PERMUTATION_A = _permutation_rng.randint(1, 2 ** 31, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+_PERMUTATION_B = _permutation_rng.randint(0, 2 ** 31, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+
+_ANSWER_KEY_LINE = re.compile(r"^\s*Answer\s*Key\s*:", re.IGNORECASE | re.MULTILINE)
+_LEADING_NUMBER = re.compile(r"^\s*\d+\s*\.\s*")
+_OPTION_LABEL = re.compile(r"^\s*\(\d+\)", re.MULTILINE)
+_WORD = re.compile(r"\w+")
+
+def question_shingles(text: str) -> set:
+    """Word 3-grams of the question itself (stem and options; the solution is left out)."""
+    answer_key = _ANSWER_KEY_LINE.search(text)
+    body = text[:answer_key.start()] if answer_key else text
+    body = _OPTION_LABEL.sub(" ", _LEADING_NUMBER.sub("", body)).lower()
+    words = _WORD.findall(body)
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def minhash_signature(text: str) -> Optional[np.ndarray]:
+    """MINHASH_PERMUTATIONS min-hashes of the question's shingles (None for an empty question)."""
+    shingles = question_shingles(text)
+    if not shingles:
+        return None
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    return ((np.outer(_PERMUTATION_A, hashes) + _PERMUTATION_B[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+def signature_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of two signatures."""
+    return float(np.count_nonzero(a == b)) / MINHASH_PERMUTATIONS
+
+class MinHashIndex:
+    """LSH index of question signatures; with a path, additions are appended to a JSONL file."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.signatures: List[np.ndarray] = []
+        self._buckets = [dict() for _ in range(LSH_BANDS)]
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._insert(np.array(json.loads(line)["signature"], dtype=np.uint64))
+                    except (ValueError, KeyError):
+                        continue # Torn last line after a crash
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _bands(self, signature: np.ndarray):
+        rows = MINHASH_PERMUTATIONS // LSH_BANDS
+        for band in range(LSH_BANDS):
+            yield band, signature[band * rows:(band + 1) * rows].tobytes()
+
+    def _insert(self, signature: np.ndarray):
+        signature_id = len(self.signatures)
+        self.signatures.append(signature)
+        for band, key in self._bands(signature):
+            self._buckets[band].setdefault(key, []).append(signature_id)
+
+    def most_similar(self, signature: np.ndarray) -> float:
+        """Highest estimated similarity among the LSH candidates (0.0 if there are none)."""
+        with self._lock:
+            candidates = {i for band, key in self._bands(signature) for i in self._buckets[band].get(key, ())}
+            return max((signature_similarity(signature, self.signatures[i]) for i in candidates), default=0.0)
+
+    def add(self, signatures: List[np.ndarray]):
+        with self._lock:
+            for signature in signatures:
+                self._insert(signature)
+            if not self.path or not signatures:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps({"signature": signature.tolist()}) + "\n" for signature in signatures)
+            except OSError as e:
+                print(f"⚠️ Could not save duplicate index {self.path}: {e}")
+
+_indexes: "OrderedDict[Tuple[int, str], MinHashIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+def index_path(user_id: int, exam_name: str) -> str:
+    exam_slug = re.sub(r"[^A-Za-z0-9]+", "_", exam_name).strip("_")[:40]
+    exam_hash = hashlib.sha1(exam_name.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(DUPLICATE_INDEX_DIR, str(user_id), f"{exam_slug}_{exam_hash}.jsonl")
+
+def get_duplicate_index(user_id: int, exam_name: str) -> MinHashIndex:
+    """The persisted index of questions served to a user for an exam, loaded on first use."""
+    key = (user_id, exam_name)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = MinHashIndex(index_path(user_id, exam_name))
+            while len(_indexes) > MAX_LOADED_INDEXES:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(key)
+        return index
+
+class DuplicateFilter:
+    """Checks the questions of one run against the user's persisted index and against each other.
+    Questions are only added to the persisted index by commit(), once the run has shipped them.
+    Chunks run in parallel: hold `lock` across duplicates() and accept() so two chunks cannot
+    both take the same near-duplicate (each method also takes it on its own)."""
+
+    def __init__(self, index: MinHashIndex, threshold: float = DUPLICATE_SIMILARITY_THRESHOLD, reject: bool = True):
+        self.index = index
+        self.threshold = threshold
+        self.reject = reject
+        self.run_index = MinHashIndex() # Accepted in this run, in memory only
+        self.flagged = 0
+        self.lock = threading.RLock()
+
+    @classmethod
+    def for_run(cls, user_id: Optional[int], exam_name: str, mode: str = None) -> Optional["DuplicateFilter"]:
+        """The filter for a run, or None when detection is off or the run has no user."""
+        mode = (mode or DUPLICATE_QUESTIONS_MODE).lower()
+        if mode not in ("reject", "flag") or user_id is None:
+            return None
+        return cls(get_duplicate_index(user_id, exam_name), reject=mode == "reject")
+
+    def similarities(self, questions: List[str]) -> List[float]:
+        """Highest similarity of each question to a served question, one accepted earlier in the
+        run or one before it in the list."""
+        scores = []
+        seen = []
+        for question in questions:
+            signature = minhash_signature(question)
+            if signature is None:
+                scores.append(0.0)
+                continue
+            score = max(self.index.most_similar(signature), self.run_index.most_similar(signature))
+            score = max([score] + [signature_similarity(signature, other) for other in seen])
+            seen.append(signature)
+            scores.append(score)
+        return scores
+
+    def duplicates(self, questions: List[str], reject: bool = True) -> List[Optional[str]]:
+        """A problem description per near-duplicate question to reject (None for the others). In flag
+        mode, or with reject=False (e.g. a chunk's last attempt), duplicates are only reported."""
+        reject = reject and self.reject
+        problems = []
+        with self.lock:
+            for score in self.similarities(questions):
+                if score < self.threshold:
+                    problems.append(None)
+                    continue
+                self.flagged += 1
+                problems.append(f"near-duplicate of an earlier question ({score:.2f} similar)" if reject else None)
+                if not reject:
+                    print(f"  -> 🔁 Near-duplicate question kept ({score:.2f} similar).")
+        return problems
+
+    def accept(self, questions: List[str]):
+        """Registers questions taken into the run, so later chunks don't repeat them."""
+        signatures = [s for s in map(minhash_signature, questions) if s is not None]
+        with self.lock:
+            self.run_index.add(signatures)
+
+    def commit(self, questions: List[str]):
+        """Adds the questions the run shipped to the user's persisted index (call it once the run's
+        files are written, so a failed run does not block its questions in later runs)."""
+        self.index.add([s for s in map(minhash_signature, questions) if s is not None])
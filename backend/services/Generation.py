@@ -1,12 +1,28 @@
-from openai import OpenAI
 import random
+import re
+import threading
 import time
 import textwrap
 import os
 import pandas as pd
-from docx import Document
-from fpdf import FPDF
 from services.PromptsDict import prompt_templates
+from services.LLMProvider import get_llm_provider
+from services.RateLimiter import get_rate_limiter, backoff_delay, estimate_request_tokens
+from services.QuestionBank import BankedQuestion, take_from_question_bank, store_in_question_bank, mark_bank_questions_delivered
+from services.BatchTransport import get_batch_transport, BATCH_FINAL_STATES
+from services.Metrics import record_prompt_usage, record_stage, timed_stage
+from services.TokenBudget import get_output_token_model, estimate_requests, GPT_MAX_OUTPUT_TOKENS
+from services.Hedging import get_latency_tracker, get_hedge_pool, HedgeBudget, HEDGE_GPT_REQUESTS
+from services.QuestionValidator import assign_questions, describe_rejections
+from services.DuplicateIndex import DuplicateFilter
+from services.Rendering import render_document, open_document_writer
+from services.RawResponseLog import log_raw_response
+from services.RunStore import record_run
+from services.Storage import BACKEND_DATA_DIR
+from services.StructuredOutput import (
+    STRUCTURED_OUTPUT, response_format as structured_response_format, structured_instructions,
+    parse_structured_questions, parse_structured_sections, count_structured_questions, question_text
+)
 from datetime import datetime
 import json
 import uuid
@@ -14,6 +30,8 @@ import uuid
 from pymongo import MongoClient, errors
 from pymongo.errors import ConnectionFailure, OperationFailure
 from typing import List
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
 import certifi
 import cloudinary
 import cloudinary.uploader
@@ -35,6 +53,38 @@ MODEL = os.getenv("OPENAI_MODEL", "gpt-4-turbo")
 # SAVE_GENERATIONS_TO_DB = True
 SAVE_GENERATIONS_TO_DB = True
 API_KEY = os.getenv("API_KEY")
+# Maximum number of chunks sent to GPT concurrently (1 = sequential)
+MAX_CHUNKS_IN_FLIGHT = int(os.getenv("MAX_CHUNKS_IN_FLIGHT", "4"))
+# Stream completions token by token and stop as soon as a chunk has enough questions
+# (and emit question_streamed events). Runs with a cancel_event, which includes every
+# API job, stream regardless while STREAM_CANCELLABLE_RUNS is on.
+STREAM_GPT_RESPONSES = os.getenv("STREAM_GPT_RESPONSES", "false").lower() == "true"
+# Cancellable runs stream so cancelling closes the HTTP response of requests in flight;
+# false sends them as plain requests and cancellation takes effect between requests
+STREAM_CANCELLABLE_RUNS = os.getenv("STREAM_CANCELLABLE_RUNS", "true").lower() == "true"
+QUESTION_MARKER = "--Question Starting--"
+GPT_MAX_TOKENS = 4000
+SECTION_MARKER = "--Section {n} Starting--"
+SECTION_MARKER_PATTERN = re.compile(r"--Section (\d+) Starting--")
+# Keep the valid part of a short response and only re-request the missing questions
+REPAIR_PARTIAL_CHUNKS = os.getenv("REPAIR_PARTIAL_CHUNKS", "true").lower() == "true"
+# Chunks of the same qtype packed into one request, e.g. "FIL=3,SL=2" (unlisted qtypes are not packed).
+# A factor is an upper bound: chunks are only packed while the whole request's expected output
+# fits in GPT_MAX_OUTPUT_TOKENS (see pack_prompts), since cut-off sections are rerun one by one.
+# That allows GPT_MAX_OUTPUT_TOKENS / (MAX_TOKENS_HEADROOM * output tokens per question) questions
+# per request (TokenBudget.max_questions_per_request), with tokens per question learned per qtype
+# or, until then, taken from its template's example: with the defaults about 13 MCQ or 15 FIL
+# questions (two or three 5-question chunks) but only 5 SL or CS questions, so those never pack.
+# Factors the limit cuts down are logged and reported as "packing_limited" job events.
+PROMPT_PACKING_FACTORS = {
+    qtype.strip(): int(factor)
+    for qtype, factor in (item.split("=") for item in os.getenv("PROMPT_PACKING_FACTORS", "").split(",") if "=" in item)
+}
+# Default per-run deadline; once it passes the run stops and returns what is already validated
+GENERATION_DEADLINE_SECONDS = float(os.getenv("GENERATION_DEADLINE_SECONDS", "0")) or None
+# output_mode="batch": seconds between Batch API status checks, and resubmission rounds for failed chunks
+BATCH_POLL_SECONDS = int(os.getenv("BATCH_POLL_SECONDS", "30"))
+BATCH_MAX_ROUNDS = int(os.getenv("BATCH_MAX_ROUNDS", "3"))
 # questions_per_chunk = 5 
 # questions_per_chunk = 3 # change to 5 when on production level
 
@@ -43,14 +93,14 @@ API_KEY = os.getenv("API_KEY")
 
 # Define the path to the backend/data directory
 # BACKEND_DATA_DIR = os.path.join(PROJECT_ROOT, "backend", "data")
-BACKEND_DATA_DIR = "/app/data"
+# BACKEND_DATA_DIR (services.Storage) is /app/data unless the BACKEND_DATA_DIR variable is set
 # Create the output directories inside backend/data
 OUTPUT_DIR = os.path.join(BACKEND_DATA_DIR, "generated_files")
-RAW_RESPONSES_DIR = os.path.join(BACKEND_DATA_DIR, "raw_responses")
+BATCH_REQUESTS_DIR = os.path.join(BACKEND_DATA_DIR, "batch_requests")
 
 # Ensure the output directories exist at the project root
 os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs(RAW_RESPONSES_DIR, exist_ok=True)
+os.makedirs(BATCH_REQUESTS_DIR, exist_ok=True)
 
 # ===============================================================
 # === MONGODB SETUP ===
@@ -119,16 +169,43 @@ def validate_topic_capacity(plan, total_topics, questions_per_chunk: int):
         error_msg = f"Not enough unique topics to generate the requested number of questions. \nTopics available: {len(total_topics)}, Questions requested: {sum(plan.values())}"
         raise ValueError(error_msg)
 
-def build_prompt_from_template(topics_list, template_key, num_of_questions, EXAM):
-    """Builds a GPT prompt from a template with the given topics."""
+def build_system_prompt(exam_name):
+    """System message sent ahead of every prompt; it is the start of the cached prefix, so keep it fixed per exam."""
+    return f"You are a {exam_name} paper setter."
+
+# The templates reference their per-chunk values from inside the long fixed instructions and
+# few-shot examples. Those references are filled with neutral pointers instead, so everything up
+# to the per-chunk suffix is byte-identical for a qtype/exam and hits the API's prompt-prefix cache.
+PREFIX_TOPICS_REF = "(see TOPICS at the end of this prompt)"
+PREFIX_ANSWER_KEY_REF = "(see ANSWER KEY at the end of this prompt)"
+PREFIX_NUM_REF = "N"
+
+@lru_cache(maxsize=256)
+def build_prompt_prefix(template_key, EXAM):
+    """Returns the stable part of a qtype's prompt for an exam (instructions and examples)."""
+    template = prompt_templates.get(template_key, "")
+    return template.format(topics=PREFIX_TOPICS_REF, answer_key=PREFIX_ANSWER_KEY_REF, num=PREFIX_NUM_REF, exam=EXAM)
+
+def build_prompt_suffix(num_of_questions, topics_str, answer_key):
+    """Returns the per-chunk part of a prompt, appended after the cached prefix."""
+    return (
+        f"\n\n=== THIS REQUEST ===\n"
+        f"N = {num_of_questions}\n"
+        f"TOPICS:\n{topics_str}\n"
+        f"ANSWER KEY: {answer_key}"
+    )
+
+def build_prompt_from_template(topics_list, template_key, num_of_questions, EXAM, structured: bool = False):
+    """Builds a GPT prompt from a template with the given topics: stable prefix first, chunk values last.
+    structured asks for JSON questions instead of the marker format."""
     topics_str = "\n".join([f"{i+1}. {topic}" for i, topic in enumerate(topics_list)])
     randomized_answer_key = ', '.join(str(n) for n in random.choices(range(1, 5), k=num_of_questions))
-    template = prompt_templates.get(template_key, "")
-    return template.format(topics=topics_str, answer_key=randomized_answer_key, num=num_of_questions, exam=EXAM)
+    prompt = build_prompt_prefix(template_key, EXAM) + build_prompt_suffix(num_of_questions, topics_str, randomized_answer_key)
+    return prompt + structured_instructions() if structured else prompt
 
-def generate_all_prompts(plan, topics, exam, questions_per_chunk: int):
-    """Generates a list of all prompts to be sent to the GPT API."""
-    prompts = []
+def plan_topic_chunks(plan, topics, questions_per_chunk: int):
+    """Splits shuffled topics into (qtype, chunk_topics) pairs, one question per topic."""
+    chunks = []
     topic_index = 0
     # questions_per_chunk = 5
     
@@ -140,58 +217,151 @@ def generate_all_prompts(plan, topics, exam, questions_per_chunk: int):
         for _ in range(count // questions_per_chunk):
             chunk = shuffled_topics[topic_index : topic_index + questions_per_chunk]
             topic_index += questions_per_chunk
-            prompt = build_prompt_from_template(chunk, qtype, questions_per_chunk, exam)
-            prompts.append((qtype, prompt))
-    return prompts
+            chunks.append((qtype, chunk))
+    return chunks
+
+def build_chunk_prompts(chunks, exam, structured: bool = False):
+    """Builds one (qtype, prompt, chunk_topics) entry per chunk; GPT must return one question per topic."""
+    return [
+        (qtype, build_prompt_from_template(chunk_topics, qtype, len(chunk_topics), exam, structured), chunk_topics)
+        for qtype, chunk_topics in chunks
+    ]
+
+def build_packed_prompt(sections, template_key, EXAM, structured: bool = False):
+    """Builds one GPT prompt that covers several chunks of the same qtype, each in its own delimited section."""
+    topics_str = "\n\n".join(
+        f"Section {s + 1}:\n" + "\n".join(f"{i+1}. {topic}" for i, topic in enumerate(section))
+        for s, section in enumerate(sections)
+    )
+    answer_key = "; ".join(
+        f"Section {s + 1}: " + ', '.join(str(n) for n in random.choices(range(1, 5), k=len(section)))
+        for s, section in enumerate(sections)
+    )
+    num = sum(len(section) for section in sections)
+    prompt = build_prompt_prefix(template_key, EXAM) + build_prompt_suffix(num, topics_str, answer_key)
+    if structured:
+        return prompt + structured_instructions(len(sections)) + (
+            f"\n\nThe topics and answer key above are split into {len(sections)} sections. Each section must contain "
+            f"exactly one question for every topic listed in that section, following that section's answer key."
+        )
+    return prompt + (
+        f"\n\nThe topics and answer key above are split into {len(sections)} sections. Write each section separately, "
+        f"in order, and start each section with its own line \"{SECTION_MARKER.format(n='N')}\" (N = 1 to {len(sections)}) "
+        f"placed before that section's first \"{QUESTION_MARKER}\". Each section must contain exactly one question "
+        f"for every topic listed in that section, following that section's answer key."
+    )
+
+def split_packed_sections(response, num_sections, structured: bool = False):
+    """Splits a packed response into its sections; missing sections come back as None.
+    Structured sections come back as {"questions": [...]} JSON, ready for split_questions."""
+    sections = [None] * num_sections
+    with timed_stage("parse"):
+        if structured:
+            return [
+                json.dumps({"questions": questions}) if questions is not None else None
+                for questions in parse_structured_sections(response, num_sections)
+            ]
+        parts = SECTION_MARKER_PATTERN.split(response)
+        # parts = [preamble, number, text, number, text, ...]
+        for number, text in zip(parts[1::2], parts[2::2]):
+            index = int(number) - 1
+            if 0 <= index < num_sections and sections[index] is None:
+                sections[index] = text
+    return sections
+
+def pack_prompts(prompts, packing_factors, exam, structured: bool = False, on_event=None):
+    """Groups consecutive chunks of the same qtype into packed requests of up to packing_factors[qtype] chunks,
+    as long as the packed request's expected output fits in one completion (GPT_MAX_OUTPUT_TOKENS).
+    Every qtype whose factor the output budget cuts down is logged once and reported as a
+    packing_limited event. Returns a list of (chunk_indices, packed_prompt) units; packed_prompt is
+    None for unpacked chunks."""
+    output_token_model = get_output_token_model()
+    limited = {} # qtype -> largest group the output budget allowed
+    units = []
+    i = 0
+    while i < len(prompts):
+        qtype = prompts[i][0]
+        factor = max(1, packing_factors.get(qtype, 1))
+        group = [i]
+        num_questions = len(prompts[i][2])
+        while len(group) < factor and i + len(group) < len(prompts) and prompts[i + len(group)][0] == qtype:
+            next_questions = len(prompts[i + len(group)][2])
+            if not output_token_model.fits_output_budget(qtype, num_questions + next_questions):
+                limited[qtype] = max(limited.get(qtype, 1), len(group))
+                break
+            group.append(i + len(group))
+            num_questions += next_questions
+        packed_prompt = build_packed_prompt([prompts[j][2] for j in group], qtype, exam, structured) if len(group) > 1 else None
+        units.append((group, packed_prompt))
+        i += len(group)
+    for qtype, packed in limited.items():
+        max_questions = output_token_model.max_questions_per_request(qtype)
+        print(f"📦 Packing factor {packing_factors[qtype]} for {qtype} cut to {packed}: only ~{max_questions} question(s) "
+              f"fit in {GPT_MAX_OUTPUT_TOKENS} output tokens.")
+        emit_event(on_event, "packing_limited", qtype=qtype, packing_factor=packing_factors[qtype], packed_chunks=packed,
+                   max_questions_per_request=max_questions, max_output_tokens=GPT_MAX_OUTPUT_TOKENS)
+    return units
+
+def report_packing_savings(prompts, units):
+    """Reports the estimated input tokens per question with and without packing."""
+    total_questions = sum(len(chunk_topics) for _, _, chunk_topics in prompts)
+    if not total_questions:
+        return None
+    before = sum(estimate_request_tokens(prompt) for _, prompt, _ in prompts)
+    after = sum(
+        estimate_request_tokens(packed_prompt) if packed_prompt else estimate_request_tokens(prompts[group[0]][1])
+        for group, packed_prompt in units
+    )
+    report = {
+        "requests_before": len(prompts),
+        "requests_after": len(units),
+        "input_tokens_per_question_before": round(before / total_questions, 1),
+        "input_tokens_per_question_after": round(after / total_questions, 1),
+    }
+    print(f"📦 Packing: {report['requests_before']} -> {report['requests_after']} requests, "
+          f"~{report['input_tokens_per_question_before']} -> ~{report['input_tokens_per_question_after']} input tokens per question.")
+    return report
+
+def generate_all_prompts(plan, topics, exam, questions_per_chunk: int):
+    """Generates a list of all prompts to be sent to the GPT API."""
+    return build_chunk_prompts(plan_topic_chunks(plan, topics, questions_per_chunk), exam)
 
 # === FILE OPERATIONS ===
-def save_to_docx(content, filename):
-    """Saves the given content to a .docx file in the output directory."""
+def save_document(blocks: List[str], filename, output_format: str):
+    """Renders blocks (questions, skipped chunks) into a .pdf or .docx file in the output directory,
+    on the render process pool (see services.Rendering)."""
     path = os.path.join(OUTPUT_DIR, filename)
     try:
-        doc = Document()
-        doc.add_paragraph(content)
-        doc.save(path)
+        render_document(blocks, path, output_format)
     except Exception as e:
-        raise IOError(f"❌ Cannot access {path}. Details: {e}")
-    
-def save_to_pdf(content, filename):
-    """Saves the given content to a .pdf file in the output directory."""
+        raise IOError(f"❌ Cannot save {output_format.upper()} to {path}. Details: {e}")
+
+def open_question_document(filename, output_format: str):
+    """Opens a document in the output directory that questions are appended to as they are validated."""
     path = os.path.join(OUTPUT_DIR, filename)
     try:
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=11)
-        encoded_content = content.encode('latin-1', 'replace').decode('latin-1')
-        pdf.multi_cell(0, 5, txt=encoded_content)
-        pdf.output(path)
+        return open_document_writer(path, output_format)
     except Exception as e:
-        raise IOError(f"❌ Cannot save PDF to {path}. Details: {e}")
-
-def save_raw_response(text, folder=RAW_RESPONSES_DIR):
-    """Saves the raw GPT response for debugging purposes."""
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    file_id = uuid.uuid4().hex[:6]
-    # filename = f"gpt_response_{timestamp}.docx"
-    filename = f"gpt_response_{timestamp}_{file_id}.pdf"
-    path = os.path.join(folder, filename)
-    # doc = Document()
-    # doc.add_paragraph(text)
-    # doc.save(path)
-    # print(f"✅ Raw response saved to: {path}")
-    try:
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=11)
-        encoded_text = text.encode('latin-1', 'replace').decode('latin-1')
-        pdf.multi_cell(0, 5, txt=encoded_text)
-        pdf.output(path)
-        print(f"✅ Raw response saved to: {path}")
-    except Exception as e:
-        print(f"❌ Failed to save raw response PDF. Details: {e}")
+        raise IOError(f"❌ Cannot save {output_format.upper()} to {path}. Details: {e}")
+
+def save_to_docx(content, filename):
+    """Saves the given content to a .docx file in the output directory."""
+    save_document([content], filename, "docx")
+    
+def save_to_pdf(content, filename):
+    """Saves the given content to a .pdf file in the output directory."""
+    save_document([content], filename, "pdf")
+
+def save_raw_response(text, run_id: str = None, qtype: str = None, attempt: int = None, latency_seconds: float = None, **fields):
+    """Appends the raw GPT response, with what produced it, to the raw response log for debugging
+    (written in the background, see services.RawResponseLog)."""
+    with timed_stage("raw_log"):
+        log_raw_response(text, run_id, qtype, attempt, latency_seconds, **fields)
 
 def log_generation_to_db(system_prompt: str, user_prompt: str, response_content: str, exam_name: str, model_name: str, testing: bool):
     """Logs a successful prompt/response pair to MongoDB if enabled."""
+    if get_llm_provider(testing).simulated:
+        return # Simulated responses must never end up in the fine-tuning data
     if not testing and mongo_client and SAVE_GENERATIONS_TO_DB and response_content:
         try:
             finetune_collection.insert_one({
@@ -211,140 +381,803 @@ def log_generation_to_db(system_prompt: str, user_prompt: str, response_content:
         print("  -> 🟡 Skipping MongoDB log (master flag is OFF).")
 
 # === GPT HANDLING ===
-def call_gpt(prompt, testing, exam_name, chunks, retries=3):
-    """Calls the OpenAI API with a given prompt, with retries."""
-    
-    if testing:
-        time.sleep(1)
-        return "\n\n".join([
-            f"--Question Starting--\nQ{i+1}. This is a sample test question for type {prompt[:3]}.\nAnswer: A\nExplanation: This is a test explanation."
-            for i in range(chunks)
-        ])
-    
-    # if not os.getenv("OPENAI_API_KEY"):
-    #     raise ValueError("OPENAI_API_KEY environment variable not set.")
+class GPTCallAborted(Exception):
+    """Raised when a GPT call is given up because the run was cancelled or its hedge lost."""
+
+def wait_or_cancel(seconds, cancel_event=None):
+    """Sleeps for `seconds`, waking up early if the run is cancelled."""
+    if cancel_event is None:
+        time.sleep(seconds)
+    else:
+        cancel_event.wait(seconds)
+
+def provider_model_key(provider):
+    """Key for rate limits and latency/usage stats, so simulated calls never mix with real ones."""
+    return MODEL if not provider.simulated else f"{provider.name}:{MODEL}"
+
+def count_response_questions(content, structured: bool = False):
+    """Questions written in a response (valid or not), for the output token stats."""
+    return count_structured_questions(content) if structured else (content or "").count(QUESTION_MARKER)
+
+def call_gpt(prompt, testing, exam_name, chunks, retries=3, max_tokens=None, qtype=None, cancel_event=None, response_format=None):
+    """Calls the LLM provider (OpenAI, or the fake one for testing runs) with a given prompt, with retries.
+    Without an explicit max_tokens, it is sized from the qtype's learned output tokens per question
+    (GPT_MAX_TOKENS if qtype is unknown). Once cancel_event is set no further attempt is made
+    (the request in flight is not interrupted). response_format requests structured (JSON) output.
+    Returns (content, system_prompt, finish_reason); finish_reason is "length" if the output was cut off."""
+    provider = get_llm_provider(testing)
+    model_key = provider_model_key(provider)
+    limiter = get_rate_limiter(model_key)
+    output_model = get_output_token_model()
+    if max_tokens is None:
+        max_tokens = output_model.max_tokens_for(qtype, chunks) if qtype else GPT_MAX_TOKENS
+    system_prompt = build_system_prompt(exam_name)
+    estimated_tokens = estimate_request_tokens(system_prompt, prompt, max_tokens=max_tokens)
+    for attempt in range(retries):
+        if cancel_event is not None and cancel_event.is_set():
+            raise GPTCallAborted()
+        limiter.acquire(estimated_tokens)
+        try:
+            started_at = time.perf_counter()
+            with timed_stage("llm"):
+                completion = provider.complete(
+                    MODEL,
+                    [
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=max_tokens,
+                    temperature=0.7,
+                    response_format=response_format
+                )
+            limiter.update_from_headers(completion.headers)
+            usage = completion.usage
+            limiter.record_usage(estimated_tokens, usage.total_tokens if usage else None)
+            record_prompt_usage(model_key, usage, time.perf_counter() - started_at)
+            response_content = completion.content
+            if qtype:
+                get_latency_tracker().record(model_key, qtype, chunks, time.perf_counter() - started_at)
+            if qtype and usage and not provider.simulated:
+                output_model.observe(qtype, count_response_questions(response_content, response_format is not None), usage.completion_tokens,
+                                     truncated=completion.finish_reason == "length")
+
+            return response_content, system_prompt, completion.finish_reason
+        
+        except Exception as e:
+            print(f"⚠️ GPT attempt {attempt+1} failed: {e}")
+            retry_after = limiter.observe_error(e)
+            if attempt < retries - 1:
+                wait_or_cancel(backoff_delay(attempt, retry_after), cancel_event)
+    raise RuntimeError("❌ All GPT API retries failed.")
 
-    client = OpenAI(api_key=API_KEY)
-    system_prompt = f"You are a {exam_name} paper setter."
+def call_gpt_stream(prompt, testing, exam_name, chunks, on_question=None, retries=3, max_tokens=None, qtype=None, abort_event=None, cancel_event=None, response_format=None):
+    """Streams the completion and hands each question to on_question(index, text) as soon as the
+    next marker arrives. Stops reading once `chunks` questions are complete, so a runaway
+    completion stops costing tokens. Setting abort_event or cancel_event closes the HTTP response
+    and raises GPTCallAborted. Returns (content, system_prompt, finish_reason) like call_gpt
+    (finish_reason is None when the stream was stopped early).
+    With a response_format the JSON is returned whole (no per-question callbacks or early stop)."""
+    provider = get_llm_provider(testing)
+    model_key = provider_model_key(provider)
+    limiter = get_rate_limiter(model_key)
+    output_model = get_output_token_model()
+    if max_tokens is None:
+        max_tokens = output_model.max_tokens_for(qtype, chunks) if qtype else GPT_MAX_TOKENS
+    system_prompt = build_system_prompt(exam_name)
+    estimated_tokens = estimate_request_tokens(system_prompt, prompt, max_tokens=max_tokens)
+    aborted = lambda: (abort_event is not None and abort_event.is_set()) or (cancel_event is not None and cancel_event.is_set())
+    structured = response_format is not None
     for attempt in range(retries):
+        if aborted():
+            raise GPTCallAborted()
+        limiter.acquire(estimated_tokens)
         try:
-            response = client.chat.completions.create(
-                model=MODEL,
-                messages=[
+            started_at = time.perf_counter()
+            stream = provider.stream(
+                MODEL,
+                [
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt}
                 ],
+                max_tokens=max_tokens,
                 temperature=0.7,
-                max_tokens=4000
+                response_format=response_format
             )
-            response_content = response.choices[0].message.content
-
-            return response_content, system_prompt
+            limiter.update_from_headers(stream.headers)
+            buffer = ""
+            questions = []
+            question_start = 0 # Where the question currently being written begins
+            used_tokens = None
+            finish_reason = None
+            try:
+                for delta in stream:
+                    if aborted():
+                        raise GPTCallAborted()
+                    if delta.usage:
+                        used_tokens = delta.usage.total_tokens
+                        record_prompt_usage(model_key, delta.usage, time.perf_counter() - started_at)
+                        if qtype and not provider.simulated:
+                            # Only sent when the stream ran to the end, so every marker in buffer is counted
+                            output_model.observe(qtype, count_response_questions(buffer, structured), delta.usage.completion_tokens,
+                                                 truncated=finish_reason == "length")
+                    if delta.finish_reason:
+                        finish_reason = delta.finish_reason
+                    if not delta.content:
+                        continue
+                    buffer += delta.content
+                    if structured:
+                        continue # JSON is only parsed once complete
+                    # Each marker closes the question written before it
+                    marker_at = buffer.find(QUESTION_MARKER, question_start)
+                    while marker_at != -1:
+                        question = textwrap.dedent(buffer[question_start:marker_at]).strip()
+                        if question:
+                            questions.append(question)
+                            if on_question:
+                                on_question(len(questions) - 1, question)
+                        question_start = marker_at + len(QUESTION_MARKER)
+                        marker_at = buffer.find(QUESTION_MARKER, question_start)
+                    if len(questions) >= chunks:
+                        print(f"  -> ✂️ Got {chunks} questions, stopping the stream early.")
+                        break
+            finally:
+                stream.close() # Aborts the response if we stopped early
+                record_stage("llm", time.perf_counter() - started_at) # Includes parsing the stream as it arrives
+            limiter.record_usage(estimated_tokens, used_tokens)
+            if structured:
+                if qtype:
+                    get_latency_tracker().record(model_key, qtype, chunks, time.perf_counter() - started_at)
+                return buffer, system_prompt, finish_reason
+            
+            if len(questions) < chunks:
+                last_question = textwrap.dedent(buffer[question_start:]).strip()
+                if last_question:
+                    questions.append(last_question)
+                    if on_question:
+                        on_question(len(questions) - 1, last_question)
+            
+            if qtype:
+                get_latency_tracker().record(model_key, qtype, chunks, time.perf_counter() - started_at)
+            response_content = "\n\n".join(f"{QUESTION_MARKER}\n{q}" for q in questions[:chunks])
+            return response_content, system_prompt, finish_reason
         
+        except GPTCallAborted:
+            raise
         except Exception as e:
-            print(f"⚠️ GPT attempt {attempt+1} failed: {e}")
+            print(f"⚠️ GPT stream attempt {attempt+1} failed: {e}")
+            retry_after = limiter.observe_error(e)
             if attempt < retries - 1:
-                time.sleep(2)
+                wait_or_cancel(backoff_delay(attempt, retry_after), cancel_event)
     raise RuntimeError("❌ All GPT API retries failed.")
 
+def call_gpt_hedged(prompt, testing, exam_name, chunks, qtype, hedge_budget, on_question=None, on_hedge=None, cancel_event=None, response_format=None):
+    """Streams the request like call_gpt_stream; if it is still running after the recent latency
+    percentile of requests for as many `chunks` of the qtype and hedge_budget allows it, a duplicate
+    is sent. The first response with `chunks` questions wins and the other stream is aborted.
+    Both run on the shared hedge pool; without a free thread the request is sent unhedged.
+    Returns (content, system_prompt, finish_reason)."""
+    threshold = get_latency_tracker().percentile(provider_model_key(get_llm_provider(testing)), qtype, chunks)
+    pool = get_hedge_pool()
+    abort_events = []
+    def launch(on_question_cb):
+        abort_event = threading.Event()
+        future = pool.try_submit(call_gpt_stream, prompt, testing, exam_name, chunks, on_question=on_question_cb, qtype=qtype,
+                                 abort_event=abort_event, cancel_event=cancel_event, response_format=response_format)
+        if future is not None:
+            abort_events.append(abort_event)
+        return future
+    
+    primary = launch(on_question) if threshold is not None else None
+    if primary is None:
+        return call_gpt_stream(prompt, testing, exam_name, chunks, on_question=on_question, qtype=qtype, cancel_event=cancel_event, response_format=response_format)
+    running = {primary}
+    hedge_considered = False
+    best_result = None
+    best_count = -1
+    last_error = None
+    try:
+        while running:
+            done, running = wait(running, timeout=None if hedge_considered else threshold, return_when=FIRST_COMPLETED)
+            if not done:
+                hedge_considered = True
+                if hedge_budget.try_spend():
+                    duplicate = launch(None) # Only the original request reports streamed questions
+                    if duplicate is None:
+                        hedge_budget.refund() # Every hedge thread is busy
+                        continue
+                    print(f"  -> 🏁 {qtype} request slower than {threshold:.1f}s, sending a hedged duplicate.")
+                    if on_hedge:
+                        on_hedge(threshold)
+                    running.add(duplicate)
+                continue
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                count = len(split_questions(result[0], response_format is not None))
+                if count == chunks:
+                    return result
+                if count > best_count:
+                    best_result, best_count = result, count
+        if best_result is not None:
+            return best_result
+        raise last_error
+    finally:
+        for abort_event in abort_events:
+            abort_event.set() # Stops the losing stream; no-op for finished ones
+
 
 # === CORE EXECUTION LOGIC ===
-def handle_generation(prompts, TESTING, exam_name, questions_per_chunk: int):
-    """Handles the question generation loop, calling GPT for each prompt."""
+def emit_event(on_event, event: str, **data):
+    """Reports a progress event to the caller's callback, never letting it break generation."""
+    if on_event is None:
+        return
+    try:
+        on_event(event, data)
+    except Exception as e:
+        print(f"⚠️ Progress callback failed for event '{event}': {e}")
+
+def notify_chunk(on_chunk, qtype, chunk_topics, questions):
+    """Hands a validated chunk to the caller's on_chunk callback, never letting it break generation."""
+    if on_chunk is None:
+        return
+    try:
+        on_chunk(qtype, chunk_topics, questions)
+    except Exception as e:
+        print(f"⚠️ Chunk callback failed for {qtype}: {e}")
+
+def split_questions(response, structured: bool = False):
+    """Splits a raw GPT response into questions on the question marker. Structured (JSON) responses
+    give their question items instead, valid or not, for assign_questions to check."""
+    with timed_stage("parse"):
+        if structured:
+            return parse_structured_questions(response)
+        return [q.strip() for q in textwrap.dedent(response).split(QUESTION_MARKER) if q.strip()]
+
+def fill_chunk_slots(slots, questions, qtype, duplicate_filter: DuplicateFilter = None, last_attempt: bool = False, truncated: bool = False):
+    """Validates the questions of a response that was asked for the chunk's empty slots (in order)
+    and fills in the valid ones; without REPAIR_PARTIAL_CHUNKS only a response that fills every
+    slot is kept. With a duplicate_filter, near-duplicates of questions the user already got are
+    rejected too, except on the last attempt, where they are kept rather than losing the chunk.
+    truncated (the response was cut off at max_tokens) lets a short response fill the first slots.
+    Returns (accepted, rejected) as given by assign_questions."""
+    pending = [i for i, question in enumerate(slots) if question is None]
+    accepted, rejected = assign_questions(questions, pending, qtype, truncated)
+    if duplicate_filter is None:
+        if len(accepted) == len(pending) or REPAIR_PARTIAL_CHUNKS:
+            for position, question in accepted.items():
+                slots[position] = question
+        return accepted, rejected
+    with duplicate_filter.lock: # Checked and accepted in one step, so parallel chunks can't both take a duplicate
+        if accepted:
+            positions = list(accepted)
+            for position, problem in zip(positions, duplicate_filter.duplicates([question_text(accepted[p]) for p in positions], reject=not last_attempt)):
+                if problem:
+                    rejected.append((accepted.pop(position), [problem]))
+        if len(accepted) == len(pending) or REPAIR_PARTIAL_CHUNKS:
+            for position, question in accepted.items():
+                slots[position] = question
+            duplicate_filter.accept([question_text(question) for question in accepted.values()])
+    return accepted, rejected
+
+def failed_chunk_listing(slots, rejected):
+    """What a skipped chunk got so far: its valid questions, then the rejected ones with their problems
+    (rejected structured items as their raw JSON)."""
+    return [question_text(question) for question in slots if question] + [
+        f"{question if isinstance(question, str) else json.dumps(question, ensure_ascii=False)}\n--- Rejected: {', '.join(problems)} ---"
+        for question, problems in rejected
+    ]
+
+def generate_chunk(qtype, prompt, chunk_topics, TESTING, exam_name, chunk_index: int = 0, on_event=None, cancel_event=None, stream: bool = False, hedge_budget: HedgeBudget = None, structured: bool = False, initial_slots: List[str] = None, duplicate_filter: DuplicateFilter = None, run_id: str = None):
+    """Generates a single chunk of questions (one per topic), retrying until every question passes
+    the structural checks of services.QuestionValidator (and, with a duplicate_filter, is not a
+    near-duplicate). With REPAIR_PARTIAL_CHUNKS, valid questions are kept and only the topics whose
+    question was missing or invalid are re-requested.
+    With a hedge_budget, slow requests are hedged (see call_gpt_hedged). structured requests JSON
+    questions (the prompt must have been built with structured=True). initial_slots (e.g. from a
+    packed section) holds questions already validated per topic, None where one is still needed.
+    run_id tags the raw responses in the raw response log.
+    Returns (generated_chunk, last_failed_chunk); generated_chunk is None if every attempt failed
+    and both are None if the run was cancelled before the chunk finished."""
+    max_retries_per_chunk = 3
+    print(f"Generating questions for type: {qtype}")
+    emit_event(on_event, "chunk_started", chunk=chunk_index, qtype=qtype)
+    generated_chunk = None
+    last_failed_chunk = []
+    response = None
+    system_prompt_used = None
+    slots = list(initial_slots) if initial_slots else [None] * len(chunk_topics) # The chunk's validated question per topic
+    current_prompt = prompt
+    response_format = structured_response_format(MODEL) if structured else None
+    
+    def request_missing():
+        pending_topics = [topic for topic, question in zip(chunk_topics, slots) if question is None]
+        return build_prompt_from_template(pending_topics, qtype, len(pending_topics), exam_name, structured)
+    
+    if any(slots):
+        current_prompt = request_missing()
+        print(f"  🩹 Kept {len(chunk_topics) - slots.count(None)} question(s) of the packed section; requesting the other {slots.count(None)}...")
+    
+    for attempt in range(max_retries_per_chunk):
+        if cancel_event is not None and cancel_event.is_set():
+            print(f"  -> 🛑 Run cancelled, dropping chunk {chunk_index + 1} ({qtype}).")
+            return None, None
+        pending = [i for i, question in enumerate(slots) if question is None]
+        expected = len(pending)
+        try:
+            print(f"  -> Attempt {attempt + 1} for {qtype}...")
+            request_started = time.perf_counter()
+            on_question = lambda index, text: emit_event(on_event, "question_streamed", chunk=chunk_index, qtype=qtype, attempt=attempt + 1, index=pending[index] if index < len(pending) else index, text=text)
+            if hedge_budget is not None:
+                # Hedged requests are always streamed so the losing one can be aborted
+                response, system_prompt_used, finish_reason = call_gpt_hedged(
+                    current_prompt, TESTING, exam_name, expected, qtype, hedge_budget,
+                    on_question=on_question if stream else None,
+                    on_hedge=lambda after: emit_event(on_event, "request_hedged", chunk=chunk_index, qtype=qtype, attempt=attempt + 1, after_seconds=round(after, 2)),
+                    cancel_event=cancel_event, response_format=response_format
+                )
+            elif stream or (cancel_event is not None and STREAM_CANCELLABLE_RUNS):
+                # Cancellable runs stream under the hood, so cancelling closes the HTTP response
+                response, system_prompt_used, finish_reason = call_gpt_stream(
+                    current_prompt, TESTING, exam_name, expected,
+                    on_question=on_question if stream else None, qtype=qtype, cancel_event=cancel_event,
+                    response_format=response_format
+                )
+            else:
+                response, system_prompt_used, finish_reason = call_gpt(current_prompt, TESTING, exam_name, expected, qtype=qtype, response_format=response_format)
+            
+            if response is None: # Handle potential failure from call_gpt retries
+                print(f"  -> ⚠️ call_gpt failed for {qtype} after all retries.")
+                last_failed_chunk = failed_chunk_listing(slots, []) + [f"--- GPT CALL FAILED ---", f"Prompt Type: {qtype}"]
+                if attempt < max_retries_per_chunk - 1:
+                    emit_event(on_event, "attempt_retried", chunk=chunk_index, qtype=qtype, attempt=attempt + 1, reason="GPT call failed")
+                continue # Move to the next attempt or fail the chunk
+            
+            if not TESTING:
+                save_raw_response(response, run_id, qtype, attempt + 1, time.perf_counter() - request_started,
+                                  chunk=chunk_index, structured=structured)
+
+            questions = split_questions(response, structured)
+            
+            # --- VALIDATION LOGIC ---
+            accepted, rejected = fill_chunk_slots(slots, questions, qtype, duplicate_filter, last_attempt=attempt == max_retries_per_chunk - 1,
+                                                  truncated=finish_reason == "length")
+            last_failed_chunk = failed_chunk_listing(slots, rejected)
+            if rejected:
+                print(f"  ⚠️ Rejected {len(rejected)} question(s): {describe_rejections(rejected)}")
+            if len(accepted) == expected:
+                generated_chunk = slots
+                print(f"  ✅ Success! Got {len(generated_chunk)} questions.")
+                if not TESTING and system_prompt_used: # Ensure system_prompt is available
+                     log_generation_to_db(
+                         system_prompt=system_prompt_used,
+                         user_prompt=current_prompt, # The prompt this response answers
+                         response_content=response, # Log the full raw response
+                         exam_name=exam_name,
+                         model_name=MODEL,
+                         testing=TESTING
+                     )
+                break # <<-- Exit the retry loop on success
+            elif REPAIR_PARTIAL_CHUNKS and accepted:
+                # Only the topics whose question is missing or invalid are asked for again
+                current_prompt = request_missing()
+                missing = slots.count(None)
+                print(f"  🩹 Kept {len(accepted)} question(s); regenerating only the {missing} missing or invalid one(s)...")
+                if attempt < max_retries_per_chunk - 1:
+                    emit_event(on_event, "attempt_retried", chunk=chunk_index, qtype=qtype, attempt=attempt + 1,
+                               reason=f"Repairing: regenerating {missing} missing or invalid question(s)")
+            else:
+                print(f"  ⚠️ Validation failed: {len(accepted)} valid question(s) out of {expected} expected. Retrying...")
+                if attempt < max_retries_per_chunk - 1:
+                    emit_event(on_event, "attempt_retried", chunk=chunk_index, qtype=qtype, attempt=attempt + 1,
+                               reason=f"Got {len(accepted)} valid questions instead of {expected}"
+                                      + (f" ({describe_rejections(rejected)})" if rejected else ""))
+                wait_or_cancel(backoff_delay(attempt), cancel_event) # Jittered so parallel chunks don't retry in lockstep
+
+        except GPTCallAborted:
+            continue # The run was cancelled; the check at the top of the loop returns
+        except Exception as e:
+            print(f"An error occurred during GPT call for {qtype}: {e}")
+            if attempt < max_retries_per_chunk - 1:
+                emit_event(on_event, "attempt_retried", chunk=chunk_index, qtype=qtype, attempt=attempt + 1, reason=str(e))
+                wait_or_cancel(backoff_delay(attempt + 1), cancel_event) # Wait longer if there's an actual API error
+    
+    if not generated_chunk and cancel_event is not None and cancel_event.is_set():
+        print(f"  -> 🛑 Run cancelled, dropping chunk {chunk_index + 1} ({qtype}).")
+        return None, None
+    if generated_chunk:
+        emit_event(on_event, "chunk_validated", chunk=chunk_index, qtype=qtype, questions=len(generated_chunk))
+    else:
+        print(f"❌ Failed to generate a valid chunk for {qtype} after {max_retries_per_chunk} attempts. Skipping.")
+        emit_event(on_event, "chunk_skipped", chunk=chunk_index, qtype=qtype)
+    return generated_chunk, last_failed_chunk
+
+def generate_packed_chunks(entries, packed_prompt, TESTING, exam_name, chunk_indices, on_event=None, cancel_event=None, stream: bool = False, hedge_budget: HedgeBudget = None, structured: bool = False, duplicate_filter: DuplicateFilter = None, run_id: str = None):
+    """Generates several chunks of one qtype with a single packed request, validating each section
+    on its own. Sections that fail fall back to generate_chunk, which keeps their valid questions.
+    Returns one (generated_chunk, last_failed_chunk) pair per entry."""
+    qtype = entries[0][0]
+    if cancel_event is not None and cancel_event.is_set():
+        return [(None, None)] * len(entries)
+    print(f"Generating {len(entries)} packed chunks for type: {qtype}")
+    for chunk_index in chunk_indices:
+        emit_event(on_event, "chunk_started", chunk=chunk_index, qtype=qtype)
+    
+    sections = [None] * len(entries)
+    finish_reason = None
+    try:
+        expected_total = sum(len(chunk_topics) for _, _, chunk_topics in entries)
+        request_started = time.perf_counter()
+        response, _, finish_reason = call_gpt(packed_prompt, TESTING, exam_name, expected_total, qtype=qtype, cancel_event=cancel_event,
+                               response_format=structured_response_format(MODEL, packed=True) if structured else None)
+        if not TESTING:
+            save_raw_response(response, run_id, qtype, 1, time.perf_counter() - request_started,
+                              chunk=list(chunk_indices), packed=True, structured=structured)
+        sections = split_packed_sections(response, len(entries), structured)
+    except Exception as e:
+        print(f"An error occurred during packed GPT call for {qtype}: {e}")
+    
+    # A cut-off response can only have cut off the last section it has
+    last_section = max((s for s, section in enumerate(sections) if section is not None), default=None)
+    results = []
+    for s, ((_, prompt, chunk_topics), chunk_index, section) in enumerate(zip(entries, chunk_indices, sections)):
+        slots = [None] * len(chunk_topics)
+        accepted, _ = fill_chunk_slots(slots, split_questions(section, structured) if section else [], qtype, duplicate_filter,
+                                       truncated=finish_reason == "length" and s == last_section)
+        if None not in slots:
+            print(f"  ✅ Packed section for chunk {chunk_index + 1} OK: {len(slots)} questions.")
+            emit_event(on_event, "chunk_validated", chunk=chunk_index, qtype=qtype, questions=len(slots))
+            results.append((slots, slots))
+        else:
+            print(f"  ⚠️ Packed section for chunk {chunk_index + 1} has {len(accepted)} valid question(s) out of {len(chunk_topics)}; generating the rest on its own.")
+            results.append(generate_chunk(qtype, prompt, chunk_topics, TESTING, exam_name, chunk_index, on_event, cancel_event, stream, hedge_budget, structured,
+                                          initial_slots=slots, duplicate_filter=duplicate_filter, run_id=run_id))
+    return results
+
+def handle_generation(prompts, TESTING, exam_name, max_in_flight: int = None, on_event=None, cancel_event=None, stream: bool = None, on_chunk=None, packing_factors: dict = None, hedge: bool = None, structured: bool = None, duplicate_filter: DuplicateFilter = None, run_id: str = None):
+    """Handles the question generation loop, calling GPT for up to max_in_flight requests at once.
+    Each chunk must return one question per topic; on_chunk(qtype, chunk_topics, questions) is
+    called for every validated chunk, in prompt order. packing_factors packs consecutive chunks of
+    the same qtype into one request (defaults to PROMPT_PACKING_FACTORS). hedge enables hedged
+    requests for slow chunks (defaults to HEDGE_GPT_REQUESTS). structured (defaults to
+    STRUCTURED_OUTPUT) must match how the prompts were built. duplicate_filter rejects (or flags)
+    near-duplicates of questions the user already got, and only those are regenerated. run_id tags
+    the raw responses in the raw response log."""
     all_questions = []
     skipped_chunks = []
-    # questions_per_chunk = 5
-    max_retries_per_chunk = 3
+    if max_in_flight is None:
+        max_in_flight = MAX_CHUNKS_IN_FLIGHT
+    if stream is None:
+        stream = STREAM_GPT_RESPONSES
+    if packing_factors is None:
+        packing_factors = PROMPT_PACKING_FACTORS
+    if hedge is None:
+        hedge = HEDGE_GPT_REQUESTS
+    if structured is None:
+        structured = STRUCTURED_OUTPUT
+    hedge_budget = HedgeBudget.for_run(len(prompts)) if hedge else None
+    emit_event(on_event, "generation_started", total_chunks=len(prompts))
     
-    for qtype, prompt in prompts:
-        print(f"Generating questions for type: {qtype}")
-        generated_chunk = None
-        last_failed_chunk = []
-        response = None
-        system_prompt_used = None
-        
-        for attempt in range(max_retries_per_chunk):
-            try:
-                print(f"  -> Attempt {attempt + 1} for {qtype}...")
-                response, system_prompt_used = call_gpt(prompt, TESTING, exam_name, questions_per_chunk)
-                
-                if response is None: # Handle potential failure from call_gpt retries
-                    print(f"  -> ⚠️ call_gpt failed for {qtype} after all retries.")
-                    last_failed_chunk = [f"--- GPT CALL FAILED ---", f"Prompt Type: {qtype}"]
-                    continue # Move to the next attempt or fail the chunk
-                
-                if not TESTING:
-                    save_raw_response(response) 
-
-                questions = [q.strip() for q in textwrap.dedent(response).split("--Question Starting--") if q.strip()]
-                last_failed_chunk = questions
-                
-            #     if len(questions) != questions_per_chunk:
-            #         print(f"⚠️ GPT returned {len(questions)} questions instead of {questions_per_chunk}. Skipping this chunk.")
-            #         skipped_chunks.append(questions)
-            #         continue
-                
-            #     all_questions.extend(questions)
-            # except Exception as e:
-            #     print(f"An error occurred during generation for prompt type {qtype}: {e}")
-            #     continue
-                # --- VALIDATION LOGIC ---
-                if len(questions) == questions_per_chunk:
-                    print(f"  ✅ Success! Got {len(questions)} questions.")
-                    generated_chunk = questions
-                    if not TESTING and system_prompt_used: # Ensure system_prompt is available
-                         log_generation_to_db(
-                             system_prompt=system_prompt_used,
-                             user_prompt=prompt, # Use the original user prompt
-                             response_content=response, # Log the full raw response
-                             exam_name=exam_name,
-                             model_name=MODEL,
-                             testing=TESTING
-                         )
-                    break # <<-- Exit the retry loop on success
+    with timed_stage("prompt_build"):
+        units = pack_prompts(prompts, packing_factors, exam_name, structured, on_event) if packing_factors else [([i], None) for i in range(len(prompts))]
+    if len(units) < len(prompts):
+        emit_event(on_event, "packing_report", **report_packing_savings(prompts, units))
+    max_workers = max(1, min(max_in_flight, len(units)))
+    
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gpt-chunk") as executor:
+        futures = []
+        for chunk_indices, packed_prompt in units:
+            if packed_prompt is None:
+                qtype, prompt, chunk_topics = prompts[chunk_indices[0]]
+                futures.append(executor.submit(
+                    lambda *args: [generate_chunk(*args)],
+                    qtype, prompt, chunk_topics, TESTING, exam_name, chunk_indices[0], on_event, cancel_event, stream, hedge_budget, structured,
+                    None, duplicate_filter, run_id
+                ))
+            else:
+                futures.append(executor.submit(
+                    generate_packed_chunks, [prompts[i] for i in chunk_indices], packed_prompt,
+                    TESTING, exam_name, chunk_indices, on_event, cancel_event, stream, hedge_budget, structured, duplicate_filter, run_id
+                ))
+        # Collect in prompt order (not completion order) so the output stays deterministic
+        for (chunk_indices, _), future in zip(units, futures):
+            for chunk_index, (generated_chunk, last_failed_chunk) in zip(chunk_indices, future.result()):
+                qtype, _, chunk_topics = prompts[chunk_index]
+                if generated_chunk:
+                    all_questions.extend(generated_chunk)
+                    notify_chunk(on_chunk, qtype, chunk_topics, generated_chunk)
+                elif last_failed_chunk is None:
+                    continue # Cancelled before this chunk finished
                 else:
-                    print(f"  ⚠️ Validation failed: GPT returned {len(questions)} questions instead of {questions_per_chunk}. Retrying...")
-                    time.sleep(1) # Optional: wait a moment before retrying
+                    # Save the last failed response for debugging
+                    skipped_chunks.append(last_failed_chunk)
+            
+    if hedge_budget is not None and hedge_budget.used:
+        print(f"🏁 Sent {hedge_budget.used} hedged request(s) (budget {hedge_budget.max_extra_requests}).")
+    # random.shuffle(all_questions)
+    return all_questions, skipped_chunks
+
 
+def wait_for_batch(transport, batch_id, cancel_event=None):
+    """Polls the transport until the batch reaches a final state; cancels it if the run is cancelled."""
+    while True:
+        status = transport.status(batch_id)
+        if status in BATCH_FINAL_STATES:
+            return status
+        if cancel_event is None:
+            time.sleep(BATCH_POLL_SECONDS)
+        elif cancel_event.wait(BATCH_POLL_SECONDS):
+            transport.cancel(batch_id)
+            return "cancelled"
+
+def handle_batch_generation(prompts, exam_name, transport=None, on_event=None, cancel_event=None, on_chunk=None, structured: bool = False, duplicate_filter: DuplicateFilter = None, run_id: str = None, testing: bool = False, on_checkpoint=None, resume: dict = None):
+    """Sends every prompt through a batch transport (OpenAI Batch API by default) instead of live calls.
+    Chunks that fail validation are resubmitted (only their missing or invalid questions with
+    REPAIR_PARTIAL_CHUNKS) in up to BATCH_MAX_ROUNDS batches. run_id tags the raw responses in the
+    raw response log. Testing runs are answered by the fake provider (see get_batch_transport).
+    on_checkpoint(state) gets a JSON-serialisable state after every submitted batch; passing it back
+    as resume (e.g. after a restart) waits for that batch again instead of submitting a new one.
+    Returns (all_questions, skipped_chunks) like handle_generation."""
+    transport = transport or get_batch_transport(get_llm_provider(testing))
+    system_prompt = build_system_prompt(exam_name)
+    emit_event(on_event, "generation_started", total_chunks=len(prompts))
+    # Per chunk: validated question per topic so far and the prompt that asks for the missing ones
+    states = [
+        {"slots": [None] * len(chunk_topics), "prompt": prompt, "last_failed": []}
+        for _, prompt, chunk_topics in prompts
+    ]
+    generated = [None] * len(prompts)
+    first_round = 0
+    if resume:
+        states, generated, first_round = resume["states"], resume["generated"], resume["round"]
+    response_format = {"response_format": structured_response_format(MODEL)} if structured else {}
+    
+    for round_number in range(first_round, BATCH_MAX_ROUNDS):
+        pending = [i for i in range(len(prompts)) if generated[i] is None]
+        if not pending or (cancel_event is not None and cancel_event.is_set()):
+            break
+        batch_submitted = time.perf_counter()
+        if resume and round_number == first_round:
+            batch_id = resume["batch_id"]
+            print(f"📦 Resuming batch {batch_id} (round {round_number + 1}).")
+        else:
+            requests_path = os.path.join(BATCH_REQUESTS_DIR, f"requests_{uuid.uuid4().hex[:8]}.jsonl")
+            try:
+                with open(requests_path, "w", encoding="utf-8") as f:
+                    for i in pending:
+                        f.write(json.dumps({
+                            "custom_id": f"chunk-{i}-round-{round_number}",
+                            "method": "POST",
+                            "url": "/v1/chat/completions",
+                            "body": {
+                                "model": MODEL,
+                                "messages": [
+                                    {"role": "system", "content": system_prompt},
+                                    {"role": "user", "content": states[i]["prompt"]}
+                                ],
+                                "temperature": 0.7,
+                                "max_tokens": get_output_token_model().max_tokens_for(prompts[i][0], states[i]["slots"].count(None)),
+                                **response_format
+                            }
+                        }) + "\n")
+                batch_id = transport.submit(requests_path)
+            finally:
+                # The transport has its own copy (uploaded file / input file) once submitted
+                try:
+                    os.remove(requests_path)
+                except OSError:
+                    pass
+            print(f"📦 Submitted batch {batch_id} with {len(pending)} chunk(s) (round {round_number + 1}).")
+        emit_event(on_event, "batch_submitted", batch_id=batch_id, chunks=len(pending), round=round_number + 1)
+        if on_checkpoint is not None:
+            try:
+                on_checkpoint({"round": round_number, "batch_id": batch_id, "states": states, "generated": generated})
             except Exception as e:
-                print(f"An error occurred during GPT call for {qtype}: {e}")
-                if attempt < max_retries_per_chunk - 1:
-                    time.sleep(2) # Wait longer if there's an actual API error
+                print(f"⚠️ Failed to checkpoint batch {batch_id}: {e}")
         
-        # After the retry loop, check if we got a valid chunk
-        if generated_chunk:
-            all_questions.extend(generated_chunk)
+        status = wait_for_batch(transport, batch_id, cancel_event)
+        print(f"📦 Batch {batch_id} finished with status: {status}")
+        emit_event(on_event, "batch_finished", batch_id=batch_id, status=status)
+        # Expired batches still return the requests that did complete
+        contents = transport.results(batch_id) if status in ("completed", "expired") else {}
+        
+        for i in pending:
+            state = states[i]
+            qtype = prompts[i][0]
+            content = contents.get(f"chunk-{i}-round-{round_number}")
+            if content is None:
+                state["last_failed"] = failed_chunk_listing(state["slots"], []) + ["--- BATCH REQUEST FAILED ---", f"Prompt Type: {qtype}"]
+                continue
+            save_raw_response(content, run_id, qtype, round_number + 1, time.perf_counter() - batch_submitted,
+                              chunk=i, batch_id=batch_id, structured=structured)
+            questions = split_questions(content, structured)
+            expected = state["slots"].count(None)
+            accepted, rejected = fill_chunk_slots(state["slots"], questions, qtype, duplicate_filter, last_attempt=round_number == BATCH_MAX_ROUNDS - 1)
+            state["last_failed"] = failed_chunk_listing(state["slots"], rejected)
+            if len(accepted) == expected:
+                generated[i] = state["slots"]
+                log_generation_to_db(system_prompt, state["prompt"], content, exam_name, MODEL, testing=testing)
+            elif REPAIR_PARTIAL_CHUNKS and accepted:
+                pending_topics = [topic for topic, question in zip(prompts[i][2], state["slots"]) if question is None]
+                state["prompt"] = build_prompt_from_template(pending_topics, qtype, len(pending_topics), exam_name, structured)
+    
+    all_questions = []
+    skipped_chunks = []
+    for i, (qtype, _, chunk_topics) in enumerate(prompts):
+        if generated[i]:
+            all_questions.extend(generated[i])
+            emit_event(on_event, "chunk_validated", chunk=i, qtype=qtype, questions=len(generated[i]))
+            notify_chunk(on_chunk, qtype, chunk_topics, generated[i])
         else:
-            print(f"❌ Failed to generate a valid chunk for {qtype} after {max_retries_per_chunk} attempts. Skipping.")
-            # Optionally, you could save the last failed response for debugging
-            skipped_chunks.append(last_failed_chunk)
-            
-    # random.shuffle(all_questions)
+            skipped_chunks.append(states[i]["last_failed"])
+            emit_event(on_event, "chunk_skipped", chunk=i, qtype=qtype)
     return all_questions, skipped_chunks
 
+def estimate_generation_task(plan: dict, exam_name: str, questions_per_chunk: int, topics: List[str], packing_factors: dict = None, structured: bool = None):
+    """Dry run: plans the chunks and builds the prompts of a run, then estimates its tokens and cost
+    without calling GPT. Raises ValueError like run_generation_task if there are too few topics."""
+    validate_topic_capacity(plan, topics, questions_per_chunk)
+    if structured is None:
+        structured = STRUCTURED_OUTPUT
+    prompts = build_chunk_prompts(plan_topic_chunks(plan, topics, questions_per_chunk), exam_name, structured)
+    if packing_factors is None:
+        packing_factors = PROMPT_PACKING_FACTORS
+    requests = []
+    packing_limited = []
+    units = pack_prompts(prompts, packing_factors, exam_name, structured, on_event=lambda event, data: packing_limited.append(data))
+    for chunk_indices, packed_prompt in units:
+        qtype, prompt, _ = prompts[chunk_indices[0]]
+        num_questions = sum(len(prompts[i][2]) for i in chunk_indices)
+        requests.append((qtype, packed_prompt or prompt, num_questions))
+    estimate = estimate_requests(requests, build_system_prompt(exam_name), MODEL)
+    if packing_limited:
+        estimate["packing_limited"] = packing_limited # Packing factors the output budget cut down
+    return estimate
+
+def upload_to_cloudinary(local_path: str, public_id: str) -> str:
+    """Uploads a generated file as a raw Cloudinary asset and returns its URL."""
+    upload = cloudinary.uploader.upload(local_path, resource_type="raw", public_id=public_id)
+    return upload.get("secure_url")
+
 
 # === MAIN ENTRY POINT FOR BACKEND ===
-def run_generation_task(plan: dict, testing_mode: bool, exam_name: str, output_format: str, questions_per_chunk: int, topics: List[str]):
-    """Main function to be called by the FastAPI """
+def run_generation_task(plan: dict, testing_mode: bool, exam_name: str, output_format: str, questions_per_chunk: int, topics: List[str], max_in_flight: int = None, run_id: str = None, on_event=None, cancel_event=None, stream: bool = None, user_id: int = None, use_question_bank: bool = False, output_mode: str = "online", batch_transport=None, packing_factors: dict = None, hedge: bool = None, deadline_seconds: float = None, upload_function=None, structured: bool = None, on_checkpoint=None, resume: dict = None):
+    """Main function to be called by the FastAPI. The run stops early when cancel_event is set or
+    deadline_seconds pass; questions validated until then are still rendered as a partial result.
+    upload_function(local_path, public_id) -> url replaces the Cloudinary upload (e.g. in benchmarks).
+    structured asks GPT for JSON questions instead of the marker format (defaults to STRUCTURED_OUTPUT).
+    Batch runs report on_checkpoint(state) after every submitted batch; resume=state continues such a
+    run (e.g. after a restart) with the chunks it was planned with, waiting for its last batch."""
+    upload_function = upload_function or upload_to_cloudinary
+    if structured is None:
+        structured = STRUCTURED_OUTPUT
+    if deadline_seconds is None:
+        deadline_seconds = GENERATION_DEADLINE_SECONDS
+    deadline_reached = threading.Event()
+    deadline_timer = None
+    questions_document = None
+    if deadline_seconds:
+        cancel_event = cancel_event or threading.Event()
+        def on_deadline():
+            print(f"⏰ Deadline of {deadline_seconds}s reached, stopping the run.")
+            deadline_reached.set()
+            cancel_event.set()
+        deadline_timer = threading.Timer(deadline_seconds, on_deadline)
+        deadline_timer.daemon = True
+        deadline_timer.start()
     try:
         print(f"Starting generation for {exam_name} with plan: {plan}")
         
-        run_id = uuid.uuid4().hex[:8]
+        run_id = run_id or uuid.uuid4().hex[:8]
         # questions_filename = f"Questions_{run_id}.docx"
         # skipped_filename = f"Skipped_{run_id}.docx"
         extension = ".pdf" if output_format == 'pdf' else ".docx"
         questions_filename = f"Questions_{run_id}{extension}"
         skipped_filename = f"Skipped_{run_id}{extension}"
         
-        save_function = save_to_pdf if output_format == 'pdf' else save_to_docx
+        document_format = 'pdf' if output_format == 'pdf' else 'docx'
 
         # topics = load_all_topics()
         
         validate_topic_capacity(plan, topics, questions_per_chunk)
         
-        prompts = generate_all_prompts(plan, topics, exam_name, questions_per_chunk)
+        banked_questions = []
+        # Simulated (testing / fake provider) questions never touch the question bank; batch runs
+        # are answered by the fake provider too unless an explicit transport is given
+        simulated = testing_mode or ((output_mode != "batch" or batch_transport is None) and get_llm_provider(testing_mode).simulated)
+        if resume:
+            # Topics are shuffled when chunks are planned, so a resumed batch must keep its own prompts
+            banked_questions = [BankedQuestion(*question) for question in resume["banked_questions"]]
+            prompts = [tuple(prompt) for prompt in resume["prompts"]]
+        else:
+            with timed_stage("prompt_build"):
+                chunks = plan_topic_chunks(plan, topics, questions_per_chunk)
+            if use_question_bank and user_id is not None and not simulated:
+                # Serve what we can from previously validated questions; only the misses go to GPT
+                banked_questions, chunks = take_from_question_bank(user_id, exam_name, chunks, questions_per_chunk)
+                emit_event(on_event, "question_bank_used", questions=len(banked_questions))
+            with timed_stage("prompt_build"):
+                prompts = build_chunk_prompts(chunks, exam_name, structured)
+        # Near-duplicates of questions this user already got for the exam are regenerated
+        duplicate_filter = DuplicateFilter.for_run(user_id, exam_name) if not simulated else None
+        if duplicate_filter is not None:
+            duplicate_filter.accept([question_text(question.question) for question in banked_questions])
+        
+        # Questions are rendered as their chunks are validated, while the remaining GPT calls run
+        questions_document = open_question_document(questions_filename, document_format)
+        render_errors = []
+        def append_to_document(questions):
+            if render_errors:
+                return # The document is incomplete anyway; the error is raised once generation is over
+            try:
+                with timed_stage("render"):
+                    questions_document.append(questions)
+            except Exception as e:
+                render_errors.append(e)
+        # Saved with the run so other formats can be exported later without generating again
+        run_questions = []
+        def add_to_paper(qtype, chunk_topics, questions):
+            # Structured questions are rendered here, numbered by their place in the paper
+            append_to_document([question_text(question, len(run_questions) + i + 1) for i, question in enumerate(questions)])
+            run_questions.extend(
+                {"qtype": qtype, "topic": topic, **({"question": question} if isinstance(question, dict) else {"text": question})}
+                for topic, question in zip(chunk_topics, questions)
+            )
+        # Banked questions go into their qtype's section of the paper (qtypes in plan order), just
+        # before that qtype's first generated chunk; chunks are validated in prompt order
+        qtype_order = list(plan)
+        banked_by_qtype = {}
+        for question in banked_questions:
+            banked_by_qtype.setdefault(question.qtype, []).append(question)
+        def add_banked_up_to(qtype=None):
+            for banked_qtype in qtype_order[:qtype_order.index(qtype) + 1] if qtype in qtype_order else qtype_order:
+                banked = banked_by_qtype.pop(banked_qtype, None)
+                if banked:
+                    add_to_paper(banked_qtype, [question.topic for question in banked], [question.question for question in banked])
+        
+        def on_validated_chunk(qtype, chunk_topics, questions):
+            add_banked_up_to(qtype)
+            add_to_paper(qtype, chunk_topics, questions)
+            if not simulated:
+                store_in_question_bank(user_id, exam_name, qtype, chunk_topics, questions)
         
-        generated_questions, skipped_chunks = handle_generation(prompts, testing_mode, exam_name, questions_per_chunk)
+        if output_mode == "batch":
+            generated_questions, skipped_chunks = handle_batch_generation(
+                prompts, exam_name, batch_transport, on_event, cancel_event,
+                on_chunk=on_validated_chunk,
+                structured=structured,
+                duplicate_filter=duplicate_filter,
+                run_id=run_id,
+                testing=testing_mode,
+                on_checkpoint=(lambda state: on_checkpoint({**state, "prompts": prompts, "banked_questions": banked_questions})) if on_checkpoint else None,
+                resume=resume
+            )
+        else:
+            generated_questions, skipped_chunks = handle_generation(
+                prompts, testing_mode, exam_name, max_in_flight, on_event, cancel_event, stream,
+                on_chunk=on_validated_chunk,
+                packing_factors=packing_factors,
+                hedge=hedge,
+                structured=structured,
+                duplicate_filter=duplicate_filter,
+                run_id=run_id
+            )
+        generated_questions = [question.question for question in banked_questions] + generated_questions
+        if duplicate_filter is not None:
+            if duplicate_filter.flagged:
+                mode = "reject" if duplicate_filter.reject else "flag"
+                print(f"🔁 Found {duplicate_filter.flagged} near-duplicate question(s) (mode: {mode}).")
+                emit_event(on_event, "duplicates_found", questions=duplicate_filter.flagged, mode=mode)
+        stopped_reason = None
+        if cancel_event is not None and cancel_event.is_set():
+            stopped_reason = "deadline" if deadline_reached.is_set() else "cancelled"
+            print(f"🛑 Generation stopped ({stopped_reason}) with {len(generated_questions)} validated question(s).")
+            emit_event(on_event, "generation_stopped", reason=stopped_reason, questions=len(generated_questions))
+            if not generated_questions:
+                message = "Question generation was cancelled." if stopped_reason == "cancelled" else "The deadline passed before any question was validated."
+                return {"success": False, "message": message, "files": {}, "stopped_reason": stopped_reason}
         if not generated_questions and not skipped_chunks:
             raise RuntimeError("No questions were successfully generated. Check logs for API errors or response format issues.")
         
@@ -353,40 +1186,55 @@ def run_generation_task(plan: dict, testing_mode: bool, exam_name: str, output_f
         generated_files = {}
         message = ""
         if generated_questions:
-            save_function("\n\n".join(generated_questions), questions_filename)
+            add_banked_up_to() # Banked qtypes that had no generated chunk after them
+            with timed_stage("render"):
+                if not render_errors:
+                    try:
+                        questions_document.finish()
+                    except Exception as e:
+                        render_errors.append(e)
+                if render_errors:
+                    raise IOError(f"❌ Cannot save {document_format.upper()} to {questions_document.path}. Details: {render_errors[0]}")
+                questions_document = None
+            emit_event(on_event, "document_rendered", document="questions", filename=questions_filename)
+            mark_bank_questions_delivered(user_id, banked_questions)
+            if duplicate_filter is not None:
+                # Only a written paper counts as served; a failed render leaves its questions free for later runs
+                duplicate_filter.commit([question_text(question) for question in generated_questions])
+            try:
+                with timed_stage("run_store"):
+                    record_run(run_id, run_questions, user_id, exam_name, rendered={document_format: os.path.join(OUTPUT_DIR, questions_filename)})
+            except Exception as e:
+                print(f"⚠️ Failed to save run {run_id} for later exports: {e}")
             # --- CLOUDINARY UPLOAD: Questions ---
             try:
                 print(f"Uploading {questions_filename} to Cloudinary...")
-                upload_questions = cloudinary.uploader.upload(
-                    os.path.join(OUTPUT_DIR, questions_filename),
-                    resource_type="raw",
-                    public_id=f"ace-track/{questions_filename}"
-                )
-                # Store the Cloudinary URL instead of the local filename
-                generated_files["questions"] = upload_questions.get("secure_url")
+                with timed_stage("upload"):
+                    # Store the Cloudinary URL instead of the local filename
+                    generated_files["questions"] = upload_function(os.path.join(OUTPUT_DIR, questions_filename), f"ace-track/{questions_filename}")
                 message = f"Successfully generated {len(generated_questions)} questions."
             except Exception as u_err:
                 print(f"⚠️ Cloudinary upload failed for questions: {u_err}")
                 generated_files["questions"] = questions_filename # Fallback to filename
+            emit_event(on_event, "upload_done", document="questions", file=generated_files["questions"])
             
         if skipped_chunks:
-            skipped_text = "\n\n".join([
+            skipped_blocks = [
                 f"--- Skipped Chunk {i+1} ---:\n" + "\n\n".join(chunk)
                 for i, chunk in enumerate(skipped_chunks)
-            ])
+            ]
             # save_to_docx(skipped_text, skipped_filename)
-            save_function(skipped_text, skipped_filename)
+            with timed_stage("render"):
+                save_document(skipped_blocks, skipped_filename, document_format)
+            emit_event(on_event, "document_rendered", document="skipped", filename=skipped_filename)
             # --- CLOUDINARY UPLOAD: Skipped ---
             try:
-                upload_skipped = cloudinary.uploader.upload(
-                    os.path.join(OUTPUT_DIR, skipped_filename),
-                    resource_type="raw",
-                    public_id=f"ace-track/{skipped_filename}"
-                )
-                generated_files["skipped"] = upload_skipped.get("secure_url")
+                with timed_stage("upload"):
+                    generated_files["skipped"] = upload_function(os.path.join(OUTPUT_DIR, skipped_filename), f"ace-track/{skipped_filename}")
             except Exception as u_err:
                 print(f"⚠️ Cloudinary upload failed for skipped chunks: {u_err}")
                 generated_files["skipped"] = skipped_filename # Fallback
+            emit_event(on_event, "upload_done", document="skipped", file=generated_files["skipped"])
             
             
         if message and len(skipped_chunks)>0: # Add to existing message
@@ -395,6 +1243,8 @@ def run_generation_task(plan: dict, testing_mode: bool, exam_name: str, output_f
             pass
         else: # Create new message
                 message = f"Failed to generate questions, but {len(skipped_chunks)} skipped chunk(s) were saved."
+        if stopped_reason:
+            message = f"{'Deadline reached' if stopped_reason == 'deadline' else 'Cancelled'}: partial result. " + message
 
         print("\n✅ Mock Test Generation Completed.")
         
@@ -416,11 +1266,17 @@ def run_generation_task(plan: dict, testing_mode: bool, exam_name: str, output_f
         return {
             "success": True,
             "message": message,
-            "files": generated_files
+            "files": generated_files,
+            "stopped_reason": stopped_reason
             # "partial_success": bool(skipped_chunks and generated_questions) # True only if we have both
         }
 
     except Exception as e:
         error_message = f"Question generation failed: {str(e)}"
         print(f"❌ {error_message}")
-        return {"success": False, "message": error_message, "files": {}}
\ No newline at end of file
+        return {"success": False, "message": error_message, "files": {}}
+    finally:
+        if deadline_timer is not None:
+            deadline_timer.cancel()
+        if questions_document is not None:
+            questions_document.abort() # Nothing was generated, or the run failed
\ No newline at end of file
@@ -0,0 +1,110 @@
+import math
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+# ===============================================================
+# === HEDGED GPT REQUESTS ===
+# ===============================================================
+# A few chunks per paper take several times the median latency and decide how
+# long the whole run takes. When a request runs past a percentile of the recent
+# latencies for the same kind of request (model, qtype and number of questions
+# asked for, so short repair requests don't drag the percentile down), a duplicate
+# is sent and the first valid answer wins. Extra requests are capped per run so
+# hedging can't double the bill, and hedged requests run on a bounded pool of threads.
+
+HEDGE_GPT_REQUESTS = os.getenv("HEDGE_GPT_REQUESTS", "false").lower() == "true"
+# Hedge once a request is slower than this share of recent requests
+HEDGE_LATENCY_PERCENTILE = float(os.getenv("HEDGE_LATENCY_PERCENTILE", "0.9"))
+# Extra requests per run, as a share of the run's chunks (at least 1)
+HEDGE_MAX_EXTRA_FRACTION = float(os.getenv("HEDGE_MAX_EXTRA_FRACTION", "0.1"))
+# Threads for hedged requests (originals and duplicates) across all runs; when they are all
+# busy, requests are sent without a hedge
+HEDGE_MAX_WORKERS = int(os.getenv("HEDGE_MAX_WORKERS", "8"))
+# Latencies kept per model/qtype/questions, and how many are needed before hedging starts
+HEDGE_LATENCY_WINDOW = 50
+HEDGE_MIN_SAMPLES = 5
+
+class LatencyTracker:
+    """Recent successful request latencies (seconds), per (model, qtype, questions requested), in memory."""
+
+    def __init__(self, window: int = HEDGE_LATENCY_WINDOW):
+        self.window = window
+        self._latencies: Dict[Tuple[str, str, int], deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, qtype: str, questions: int, seconds: float):
+        with self._lock:
+            self._latencies.setdefault((model, qtype, questions), deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model: str, qtype: str, questions: int, q: float = HEDGE_LATENCY_PERCENTILE) -> Optional[float]:
+        """The q-th latency percentile, or None until HEDGE_MIN_SAMPLES requests were seen."""
+        with self._lock:
+            samples = sorted(self._latencies.get((model, qtype, questions), ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(math.ceil(q * len(samples))) - 1)]
+
+class HedgeBudget:
+    """Caps the duplicate requests a single run may send."""
+
+    def __init__(self, max_extra_requests: int):
+        self.max_extra_requests = max_extra_requests
+        self.used = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_run(cls, total_chunks: int) -> "HedgeBudget":
+        return cls(max(1, math.ceil(total_chunks * HEDGE_MAX_EXTRA_FRACTION)))
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.used >= self.max_extra_requests:
+                return False
+            self.used += 1
+            return True
+
+    def refund(self):
+        """Returns a request that try_spend allowed but was not sent."""
+        with self._lock:
+            self.used -= 1
+
+class HedgePool:
+    """Threads for hedged requests, at most max_workers at a time. Work is only accepted while a
+    thread is free, so a request never waits in a queue while its hedge timer runs."""
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gpt-hedge")
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def try_submit(self, fn, *args, **kwargs) -> Optional[Future]:
+        """Runs fn(*args, **kwargs) on a free thread; None if every thread is busy."""
+        if not self._slots.acquire(blocking=False):
+            return None
+        def run():
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._slots.release()
+        try:
+            return self._executor.submit(run)
+        except BaseException:
+            self._slots.release()
+            raise
+
+_latency_tracker = LatencyTracker()
+
+def get_latency_tracker() -> LatencyTracker:
+    return _latency_tracker
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+def get_hedge_pool() -> HedgePool:
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = HedgePool(HEDGE_MAX_WORKERS)
+        return _hedge_pool
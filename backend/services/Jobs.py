@@ -0,0 +1,299 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from services.Generation import run_generation_task
+from services.Storage import data_path
+
+# ===============================================================
+# === BACKGROUND GENERATION JOBS ===
+# ===============================================================
+# Generation runs for minutes (GPT calls, retries, rendering, uploads), so it is
+# executed on a worker thread and the API only hands out a job id to poll.
+# Batch runs (output_mode="batch") mostly wait for the Batch API's completion window,
+# for hours, so they run on their own pool instead of blocking live generations, and
+# they are saved to JOBS_DIR after every submitted batch: after a restart they wait
+# for the same batch again instead of losing it (one API process per JOBS_DIR).
+
+# Number of generation runs executed at the same time per worker process
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "2"))
+# Batch runs waiting for their batches at the same time (they mostly sleep between polls)
+MAX_CONCURRENT_BATCH_JOBS = int(os.getenv("MAX_CONCURRENT_BATCH_JOBS", "16"))
+# Finished jobs are kept in memory this long so clients can still fetch the result
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+# Batch results can arrive while nobody is polling, so they are kept longer
+BATCH_JOB_RETENTION_SECONDS = int(os.getenv("BATCH_JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+JOBS_DIR = os.getenv("JOBS_DIR", data_path("jobs"))
+# cancel_on_disconnect jobs are cancelled after this long without a poll or an open event stream
+CLIENT_DISCONNECT_GRACE_SECONDS = float(os.getenv("CLIENT_DISCONNECT_GRACE_SECONDS", "30"))
+
+class GenerationJob:
+    """Tracks the state and progress of a single background generation run."""
+
+    def __init__(self, user_id: int, cancel_on_disconnect: bool = False, task_kwargs: dict = None):
+        self.id = uuid.uuid4().hex[:8]
+        self.user_id = user_id
+        self.cancel_on_disconnect = cancel_on_disconnect
+        self.task_kwargs = task_kwargs or {}
+        self.batch = self.task_kwargs.get("output_mode") == "batch"
+        self.checkpoint: Optional[dict] = None # Last batch checkpoint of a batch run (see run_generation_task)
+        self.last_seen = time.monotonic() # Last time the client polled or was streaming events
+        self.status = "queued" # queued -> running -> completed | failed | cancelled
+        self.message = "Waiting for a free generation worker."
+        self.files: Dict[str, str] = {}
+        self.error: Optional[str] = None
+        self.chunks_total = 0
+        self.chunks_done = 0
+        self.chunks_failed = 0
+        self.created_at = datetime.now()
+        self.finished_at: Optional[datetime] = None
+        self.cancel_event = threading.Event()
+        # Ordered progress events, replayed to SSE subscribers by index
+        self.events: List[Tuple[str, dict]] = []
+        self._lock = threading.Lock()
+
+    def on_event(self, event: str, data: dict):
+        """Progress callback passed down to run_generation_task."""
+        with self._lock:
+            self.events.append((event, data))
+            if event == "generation_started":
+                self.chunks_total = data.get("total_chunks", 0)
+                self.message = f"Generating {self.chunks_total} chunk(s)."
+            elif event == "chunk_validated":
+                self.chunks_done += 1
+            elif event == "chunk_skipped":
+                self.chunks_failed += 1
+
+    def touch(self):
+        """Records that the client is still following this job."""
+        self.last_seen = time.monotonic()
+
+    def is_finished(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
+
+    def events_since(self, since: int) -> List[Tuple[int, str, dict]]:
+        """Returns the (index, event, data) entries recorded after index `since`."""
+        with self._lock:
+            return [(i, event, data) for i, (event, data) in enumerate(self.events[since:], start=since)]
+
+    def finish(self, status: str):
+        """Marks the job as finished and publishes the terminal event."""
+        self.status = status
+        self.finished_at = datetime.now()
+        self.checkpoint = None
+        self.on_event("job_finished", {
+            "status": status,
+            "message": self.message,
+            "files": self.files,
+            "error": self.error,
+        })
+        if self.batch:
+            self.save()
+
+    def on_checkpoint(self, state: dict):
+        """Checkpoint callback of batch runs: saved so the run survives a restart."""
+        self.checkpoint = state
+        self.save()
+
+    def retention_seconds(self) -> int:
+        return BATCH_JOB_RETENTION_SECONDS if self.batch else JOB_RETENTION_SECONDS
+
+    # --- persistence (batch runs) ---
+    def path(self) -> str:
+        return os.path.join(JOBS_DIR, f"{self.id}.json")
+
+    def save(self):
+        record = {
+            "id": self.id,
+            "user_id": self.user_id,
+            "task_kwargs": self.task_kwargs,
+            "status": self.status,
+            "message": self.message,
+            "files": self.files,
+            "error": self.error,
+            "chunks_total": self.chunks_total,
+            "chunks_done": self.chunks_done,
+            "chunks_failed": self.chunks_failed,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "checkpoint": self.checkpoint,
+        }
+        try:
+            os.makedirs(JOBS_DIR, exist_ok=True)
+            temp_path = f"{self.path()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(record, f, ensure_ascii=False)
+            os.replace(temp_path, self.path())
+        except Exception as e:
+            print(f"⚠️ Failed to save job {self.id}: {e}")
+
+    @classmethod
+    def load(cls, path: str) -> "GenerationJob":
+        with open(path, "r", encoding="utf-8") as f:
+            record = json.load(f)
+        job = cls(record["user_id"], task_kwargs=record["task_kwargs"])
+        job.id = record["id"]
+        job.status = record["status"]
+        job.message = record["message"]
+        job.files = record["files"]
+        job.error = record["error"]
+        job.chunks_total = record["chunks_total"]
+        job.chunks_done = record["chunks_done"]
+        job.chunks_failed = record["chunks_failed"]
+        job.created_at = datetime.fromisoformat(record["created_at"])
+        job.finished_at = datetime.fromisoformat(record["finished_at"]) if record["finished_at"] else None
+        job.checkpoint = record["checkpoint"]
+        return job
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "message": self.message,
+                "chunks_total": self.chunks_total,
+                "chunks_done": self.chunks_done,
+                "chunks_failed": self.chunks_failed,
+                "files": self.files,
+                "error": self.error,
+                "created_at": self.created_at.isoformat(),
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            }
+
+_jobs: Dict[str, GenerationJob] = {}
+_jobs_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="generation-job")
+_batch_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCH_JOBS, thread_name_prefix="batch-job")
+
+def _prune_finished_jobs():
+    """Drops finished jobs older than their retention (JOB_RETENTION_SECONDS / BATCH_JOB_RETENTION_SECONDS)."""
+    now = time.time()
+    with _jobs_lock:
+        expired = [
+            job for job in _jobs.values()
+            if job.is_finished() and job.finished_at and job.finished_at.timestamp() < now - job.retention_seconds()
+        ]
+        for job in expired:
+            del _jobs[job.id]
+    for job in expired:
+        if job.batch:
+            try:
+                os.remove(job.path())
+            except OSError:
+                pass
+
+def _watch_client(job: GenerationJob):
+    """Cancels the job once its client stops polling / streaming for CLIENT_DISCONNECT_GRACE_SECONDS."""
+    while not job.is_finished() and not job.cancel_event.is_set():
+        if time.monotonic() - job.last_seen > CLIENT_DISCONNECT_GRACE_SECONDS:
+            print(f"🔌 Client of job {job.id} disconnected, cancelling it.")
+            job.message = "Client disconnected, cancelling."
+            job.cancel_event.set()
+            return
+        time.sleep(1)
+
+def _run_job(job: GenerationJob, task_kwargs: dict):
+    if job.cancel_event.is_set():
+        job.message = "Question generation was cancelled before it started."
+        job.finish("cancelled")
+        return
+
+    job.status = "running"
+    job.message = "Generation started."
+    if job.cancel_on_disconnect:
+        job.touch() # The grace period starts when the job does, not when it was queued
+        threading.Thread(target=_watch_client, args=(job,), name=f"job-watch-{job.id}", daemon=True).start()
+    try:
+        batch_kwargs = {"on_checkpoint": job.on_checkpoint, "resume": job.checkpoint} if job.batch else {}
+        result = run_generation_task(
+            **task_kwargs,
+            **batch_kwargs,
+            run_id=job.id,
+            user_id=job.user_id,
+            on_event=job.on_event,
+            cancel_event=job.cancel_event
+        )
+        job.files = result.get("files") or {}
+        job.message = result["message"]
+        # A run stopped by its deadline or cancelled still completes with the partial result it uploaded
+        if result["success"] and job.files:
+            status = "completed"
+        elif result.get("stopped_reason") == "cancelled":
+            status = "cancelled"
+        elif result["success"]:
+            status = "completed"
+        else:
+            status = "failed"
+            job.error = result["message"]
+    except Exception as e:
+        status = "failed"
+        job.error = f"Question generation failed: {str(e)}"
+        job.message = job.error
+    job.finish(status)
+
+def submit_generation_job(user_id: int, cancel_on_disconnect: bool = False, **task_kwargs) -> GenerationJob:
+    """Queues run_generation_task(**task_kwargs) on the job pool and returns immediately."""
+    _prune_finished_jobs()
+    job = GenerationJob(user_id, cancel_on_disconnect, task_kwargs)
+    with _jobs_lock:
+        _jobs[job.id] = job
+    if job.batch:
+        job.save()
+        _batch_executor.submit(_run_job, job, task_kwargs)
+    else:
+        _executor.submit(_run_job, job, task_kwargs)
+    return job
+
+def resume_batch_jobs():
+    """Loads the batch jobs saved in JOBS_DIR at startup: finished ones can be fetched again and
+    unfinished ones wait for their last submitted batch again."""
+    if not os.path.isdir(JOBS_DIR):
+        return
+    for name in os.listdir(JOBS_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            job = GenerationJob.load(os.path.join(JOBS_DIR, name))
+        except Exception as e:
+            print(f"⚠️ Skipping unreadable job file {name}: {e}")
+            continue
+        with _jobs_lock:
+            if job.id in _jobs:
+                continue
+            _jobs[job.id] = job
+        if job.is_finished():
+            continue
+        if job.checkpoint is None:
+            # Nothing was submitted yet, so nothing was paid for; the client can simply retry
+            job.error = "The server restarted before the batch was submitted."
+            job.message = job.error
+            job.finish("failed")
+            continue
+        print(f"📦 Resuming batch job {job.id}.")
+        job.status = "queued"
+        job.message = "Resuming after a server restart."
+        _batch_executor.submit(_run_job, job, job.task_kwargs)
+    _prune_finished_jobs()
+
+def get_job(job_id: str, user_id: int) -> Optional[GenerationJob]:
+    """Returns the job if it exists and belongs to the given user."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None or job.user_id != user_id:
+        return None
+    job.touch()
+    return job
+
+def cancel_job(job_id: str, user_id: int) -> Optional[GenerationJob]:
+    """Requests cooperative cancellation: no new chunks start and streamed requests in flight are aborted.
+    Questions validated so far are still rendered as a partial result."""
+    job = get_job(job_id, user_id)
+    if job is not None and not job.is_finished():
+        job.cancel_event.set()
+        job.message = "Cancellation requested."
+    return job
@@ -0,0 +1,321 @@
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+import httpx
+import openai
+from openai.types import CompletionUsage
+from openai.types.completion_usage import PromptTokensDetails
+
+from services.OpenAIClient import get_openai_client
+
+# ===============================================================
+# === LLM PROVIDERS ===
+# ===============================================================
+# call_gpt / call_gpt_stream talk to a provider instead of the OpenAI SDK directly.
+# OpenAIProvider is the real backend; FakeProvider answers locally with simulated
+# latency, malformed responses and 429/5xx errors (raised as the SDK's own error
+# types), so the whole pipeline can be exercised and load-tested offline.
+
+# "openai" or "fake"; testing_mode runs always use the fake provider
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai").lower()
+
+class LLMCompletion:
+    """A finished completion, normalised across providers."""
+
+    def __init__(self, content: str, finish_reason: Optional[str], usage: Optional[CompletionUsage], headers=None):
+        self.content = content
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.headers = headers or {}
+
+class LLMStreamDelta:
+    """One streamed piece of a completion; usage is only set on the final delta."""
+
+    def __init__(self, content: Optional[str] = None, finish_reason: Optional[str] = None, usage: Optional[CompletionUsage] = None):
+        self.content = content
+        self.finish_reason = finish_reason
+        self.usage = usage
+
+class LLMStream:
+    """Iterable of LLMStreamDelta; close() stops the underlying response."""
+
+    def __init__(self, deltas: Iterator[LLMStreamDelta], headers=None, on_close=None):
+        self._deltas = deltas
+        self.headers = headers or {}
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self._deltas
+
+    def close(self):
+        if self._on_close:
+            self._on_close()
+
+class OpenAIProvider:
+    """Chat completions through the shared OpenAI client."""
+
+    name = "openai"
+    simulated = False
+
+    def __init__(self, client=None):
+        self.client = client
+
+    def _client(self):
+        return self.client or get_openai_client()
+
+    def complete(self, model: str, messages: List[dict], max_tokens: int, temperature: float, response_format: Optional[dict] = None) -> LLMCompletion:
+        raw_response = self._client().chat.completions.with_raw_response.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **({"response_format": response_format} if response_format else {})
+        )
+        response = raw_response.parse()
+        choice = response.choices[0]
+        return LLMCompletion(choice.message.content, choice.finish_reason, response.usage, raw_response.headers)
+
+    def stream(self, model: str, messages: List[dict], max_tokens: int, temperature: float, response_format: Optional[dict] = None) -> LLMStream:
+        raw_response = self._client().chat.completions.with_raw_response.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+            **({"response_format": response_format} if response_format else {})
+        )
+        stream = raw_response.parse()
+        def deltas():
+            for event in stream:
+                choice = event.choices[0] if event.choices else None
+                yield LLMStreamDelta(
+                    content=choice.delta.content if choice else None,
+                    finish_reason=choice.finish_reason if choice else None,
+                    usage=event.usage
+                )
+        return LLMStream(deltas(), raw_response.headers, on_close=stream.close) # close() aborts the HTTP response
+
+_TOPICS_BLOCK = re.compile(r"^TOPICS:\n(.*?)^ANSWER KEY:", re.MULTILINE | re.DOTALL)
+_NUM_LINE = re.compile(r"^N = (\d+)$", re.MULTILINE)
+_SECTION_HEADER = re.compile(r"^Section (\d+):$", re.MULTILINE)
+_TOPIC_LINE = re.compile(r"^\d+\. (.+)$", re.MULTILINE)
+_FAKE_REQUEST = httpx.Request("POST", "https://fake-llm.local/v1/chat/completions")
+
+class FakeProvider:
+    """Deterministic (seeded) stand-in for the OpenAI API.
+
+    latency: "fixed" (always latency_seconds), "uniform" (0.5x-1.5x) or "lognormal" (median
+    latency_seconds, spread latency_sigma); streamed responses spread it over the deltas.
+    malformed_rate: share of responses that are missing some questions or have one structurally invalid
+    question (answer key out of range; structured responses: a missing option); rate_limit_rate / server_error_rate: share of calls failing with
+    openai.RateLimitError (with retry-after-ms) / InternalServerError. With a response_format the
+    questions come back as JSON, in the layout of services.StructuredOutput."""
+
+    name = "fake"
+    simulated = True
+
+    def __init__(self, latency: str = "lognormal", latency_seconds: float = 1.0, latency_sigma: float = 0.5,
+                 malformed_rate: float = 0.0, rate_limit_rate: float = 0.0, server_error_rate: float = 0.0,
+                 retry_after_seconds: float = 1.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.latency_seconds = latency_seconds
+        self.latency_sigma = latency_sigma
+        self.malformed_rate = malformed_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.retry_after_seconds = retry_after_seconds
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._seen_prompts: Dict[str, str] = {} # First 1024 prompt tokens -> last prompt, for cache hits
+        self.calls = 0
+
+    @classmethod
+    def from_env(cls, prefix: str = "FAKE_LLM_") -> "FakeProvider":
+        env = lambda key, default: os.getenv(prefix + key, default)
+        seed = env("SEED", "")
+        return cls(
+            latency=env("LATENCY", "lognormal"),
+            latency_seconds=float(env("LATENCY_SECONDS", "1.0")),
+            latency_sigma=float(env("LATENCY_SIGMA", "0.5")),
+            malformed_rate=float(env("MALFORMED_RATE", "0")),
+            rate_limit_rate=float(env("RATE_LIMIT_RATE", "0")),
+            server_error_rate=float(env("SERVER_ERROR_RATE", "0")),
+            retry_after_seconds=float(env("RETRY_AFTER_SECONDS", "1.0")),
+            seed=int(seed) if seed else None,
+        )
+
+    # --- simulation ---
+    def _sample_latency(self) -> float:
+        with self._lock:
+            if self.latency == "fixed":
+                return self.latency_seconds
+            if self.latency == "uniform":
+                return self._random.uniform(0.5, 1.5) * self.latency_seconds
+            return self.latency_seconds * math.exp(self._random.gauss(0, self.latency_sigma))
+
+    def _roll(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def _maybe_fail(self):
+        with self._lock:
+            self.calls += 1
+        if self._roll(self.rate_limit_rate):
+            response = httpx.Response(429, headers={"retry-after-ms": str(int(self.retry_after_seconds * 1000))}, request=_FAKE_REQUEST)
+            raise openai.RateLimitError("Simulated rate limit", response=response, body=None)
+        if self._roll(self.server_error_rate):
+            response = httpx.Response(500, request=_FAKE_REQUEST)
+            raise openai.InternalServerError("Simulated server error", response=response, body=None)
+
+    def _requested_sections(self, prompt: str) -> List[List[str]]:
+        """Topics per section of the request (a single section for unpacked prompts)."""
+        block = _TOPICS_BLOCK.search(prompt)
+        if not block:
+            num = _NUM_LINE.search(prompt)
+            return [[f"topic {i + 1}" for i in range(int(num.group(1)) if num else 1)]]
+        text = block.group(1)
+        headers = list(_SECTION_HEADER.finditer(text))
+        if not headers:
+            return [_TOPIC_LINE.findall(text)]
+        return [
+            _TOPIC_LINE.findall(text[header.end(): headers[i + 1].start() if i + 1 < len(headers) else len(text)])
+            for i, header in enumerate(headers)
+        ]
+
+    def _question(self, number: int, topic: str) -> str:
+        with self._lock:
+            answer = self._random.randint(1, 4)
+        return (
+            f"--Question Starting--\n"
+            f"{number}. [Simulated] Which statement about {topic} is correct?\n"
+            f"(1) Statement A\n(2) Statement B\n(3) Statement C\n(4) Statement D\n"
+            f"Answer Key: {answer}\n"
+            f"Solution:\nStatement {'ABCD'[answer - 1]} is the accurate description of {topic}.\n"
+            f"Hence, Option ({answer}) is the right answer."
+        )
+
+    def _structured_question(self, topic: str) -> dict:
+        with self._lock:
+            answer = self._random.randint(1, 4)
+        return {
+            "stem": f"[Simulated] Which statement about {topic} is correct?",
+            "options": ["Statement A", "Statement B", "Statement C", "Statement D"],
+            "answer_key": answer,
+            "solution": f"Statement {'ABCD'[answer - 1]} is the accurate description of {topic}.",
+            "hence": f"Hence, Option ({answer}) is the right answer.",
+        }
+
+    def _structured_content(self, prompt: str) -> str:
+        sections = self._requested_sections(prompt)
+        malformed = self._roll(self.malformed_rate)
+        question_sets = [{"questions": [self._structured_question(topic) for topic in topics]} for topics in sections]
+        if malformed:
+            with self._lock:
+                question_set = self._random.choice(question_sets)
+                if question_set["questions"]:
+                    self._random.choice(question_set["questions"])["options"].pop() # Only 3 options
+        return json.dumps({"sections": question_sets} if len(sections) > 1 else question_sets[0])
+
+    def _content(self, prompt: str) -> str:
+        sections = self._requested_sections(prompt)
+        malformed = self._roll(self.malformed_rate)
+        parts = []
+        for s, topics in enumerate(sections):
+            questions = [self._question(i + 1, topic) for i, topic in enumerate(topics)]
+            if malformed and questions:
+                with self._lock:
+                    if self._random.random() < 0.5:
+                        questions = questions[:self._random.randint(0, len(questions) - 1)]
+                    else:
+                        broken = self._random.randrange(len(questions))
+                        questions[broken] = re.sub(r"Answer Key: \d", "Answer Key: 7", questions[broken])
+            body = "\n\n".join(questions)
+            parts.append(f"--Section {s + 1} Starting--\n{body}" if len(sections) > 1 else body)
+        return "\n\n".join(parts)
+
+    def _usage(self, messages: List[dict], content: str) -> CompletionUsage:
+        prompt = "".join(m["content"] for m in messages)
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(content) // 4
+        # Mimics automatic prefix caching: 1024+ token prompts, cached in 128-token steps
+        cached_tokens = 0
+        if prompt_tokens >= 1024:
+            head = prompt[:4096]
+            with self._lock:
+                previous = self._seen_prompts.get(head)
+                self._seen_prompts[head] = prompt
+            if previous is not None:
+                common = len(os.path.commonprefix([previous, prompt])) // 4
+                cached_tokens = (common // 128) * 128 if common >= 1024 else 0
+        return CompletionUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+            prompt_tokens_details=PromptTokensDetails(cached_tokens=cached_tokens)
+        )
+
+    def _truncate(self, content: str, max_tokens: int):
+        if len(content) // 4 > max_tokens:
+            return content[:max_tokens * 4], "length"
+        return content, "stop"
+
+    # --- provider interface ---
+    def complete(self, model: str, messages: List[dict], max_tokens: int, temperature: float, response_format: Optional[dict] = None) -> LLMCompletion:
+        self._maybe_fail()
+        prompt = messages[-1]["content"]
+        content, finish_reason = self._truncate(self._structured_content(prompt) if response_format else self._content(prompt), max_tokens)
+        time.sleep(self._sample_latency())
+        return LLMCompletion(content, finish_reason, self._usage(messages, content))
+
+    def stream(self, model: str, messages: List[dict], max_tokens: int, temperature: float, response_format: Optional[dict] = None) -> LLMStream:
+        self._maybe_fail()
+        prompt = messages[-1]["content"]
+        content, finish_reason = self._truncate(self._structured_content(prompt) if response_format else self._content(prompt), max_tokens)
+        latency = self._sample_latency()
+        closed = threading.Event()
+        pieces = [content[i:i + 64] for i in range(0, len(content), 64)] or [""]
+        def deltas():
+            closed.wait(latency * 0.2) # Time to first token
+            for piece in pieces:
+                if closed.is_set():
+                    return
+                yield LLMStreamDelta(content=piece)
+                closed.wait(latency * 0.8 / len(pieces))
+            yield LLMStreamDelta(finish_reason=finish_reason)
+            yield LLMStreamDelta(usage=self._usage(messages, content))
+        return LLMStream(deltas(), on_close=closed.set)
+
+_provider_override = None
+_fake_provider = None
+_openai_provider = OpenAIProvider()
+_provider_lock = threading.Lock()
+
+def set_llm_provider(provider):
+    """Routes every GPT call through `provider` (None restores the default); used by benchmarks."""
+    global _provider_override
+    _provider_override = provider
+
+def get_fake_provider() -> FakeProvider:
+    """The process-wide fake provider, configured from FAKE_LLM_* variables."""
+    global _fake_provider
+    with _provider_lock:
+        if _fake_provider is None:
+            _fake_provider = FakeProvider.from_env()
+        return _fake_provider
+
+def get_llm_provider(testing: bool = False):
+    """Provider for a call: the override if set, the fake one for testing runs, LLM_PROVIDER otherwise."""
+    if _provider_override is not None:
+        return _provider_override
+    if testing or LLM_PROVIDER == "fake":
+        return get_fake_provider()
+    return _openai_provider
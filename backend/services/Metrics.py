@@ -0,0 +1,131 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+# ===============================================================
+# === IN-PROCESS GENERATION METRICS ===
+# ===============================================================
+# Counters are per worker process and reset on restart; they are meant for
+# checking the effect of tuning (prompt caching, packing, ...) on a live worker.
+
+class PromptUsageStats:
+    """Per-model prompt/cached/completion token counters plus latency split by cache hit."""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.cache_hits = 0
+        self.latency_hit_seconds = 0.0
+        self.latency_miss_seconds = 0.0
+
+    def to_dict(self) -> dict:
+        misses = self.requests - self.cache_hits
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache_hit_requests": self.cache_hits,
+            # Share of prompt tokens billed at the cached rate
+            "cached_token_ratio": round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+            "mean_latency_hit_seconds": round(self.latency_hit_seconds / self.cache_hits, 3) if self.cache_hits else None,
+            "mean_latency_miss_seconds": round(self.latency_miss_seconds / misses, 3) if misses else None,
+        }
+
+_usage: Dict[str, PromptUsageStats] = {}
+_usage_lock = threading.Lock()
+
+def cached_prompt_tokens(usage) -> int:
+    """Reads usage.prompt_tokens_details.cached_tokens (0 when the API does not report it)."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+def record_prompt_usage(model: str, usage, latency_seconds: float):
+    """Adds one completion's usage block to the counters of its model."""
+    if usage is None:
+        return
+    cached = cached_prompt_tokens(usage)
+    with _usage_lock:
+        stats = _usage.setdefault(model, PromptUsageStats())
+        stats.requests += 1
+        stats.prompt_tokens += usage.prompt_tokens or 0
+        stats.cached_tokens += cached
+        stats.completion_tokens += usage.completion_tokens or 0
+        if cached:
+            stats.cache_hits += 1
+            stats.latency_hit_seconds += latency_seconds
+        else:
+            stats.latency_miss_seconds += latency_seconds
+
+def get_prompt_usage_stats() -> dict:
+    """Returns {model: counters} for this process."""
+    with _usage_lock:
+        return {model: stats.to_dict() for model, stats in _usage.items()}
+
+# --- Pipeline stage timings ---
+# Summed over all runs (and threads) of the process; concurrent stages overlap, so
+# the totals can exceed wall time. Benchmarks reset them between scenarios.
+_stages: Dict[str, list] = {}
+_stages_lock = threading.Lock()
+
+def record_stage(stage: str, seconds: float):
+    with _stages_lock:
+        totals = _stages.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+
+@contextmanager
+def timed_stage(stage: str):
+    """Adds the time spent in the block to the stage's total."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started_at)
+
+def get_stage_timings() -> dict:
+    """Returns {stage: {"seconds": total, "calls": count}}."""
+    with _stages_lock:
+        return {stage: {"seconds": round(seconds, 4), "calls": calls} for stage, (seconds, calls) in _stages.items()}
+
+def reset_stage_timings():
+    with _stages_lock:
+        _stages.clear()
+
+# --- Document rendering ---
+_render = {"queue_depth": 0, "peak_queue_depth": 0, "documents": {}}
+_render_lock = threading.Lock()
+
+def record_render_queued(delta: int):
+    """Tracks sections submitted to the render pool and not finished yet."""
+    with _render_lock:
+        _render["queue_depth"] += delta
+        _render["peak_queue_depth"] = max(_render["peak_queue_depth"], _render["queue_depth"])
+
+def record_render_finished(output_format: str, sections: int, seconds: float):
+    with _render_lock:
+        stats = _render["documents"].setdefault(output_format, {"documents": 0, "sections": 0, "seconds": 0.0, "max_seconds": 0.0})
+        stats["documents"] += 1
+        stats["sections"] += sections
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+def get_render_stats() -> dict:
+    """Returns the current/peak render queue depth and render time per output format."""
+    with _render_lock:
+        return {
+            "queue_depth": _render["queue_depth"],
+            "peak_queue_depth": _render["peak_queue_depth"],
+            "documents": {
+                output_format: {
+                    "documents": stats["documents"],
+                    "sections": stats["sections"],
+                    "mean_seconds": round(stats["seconds"] / stats["documents"], 4),
+                    "max_seconds": round(stats["max_seconds"], 4),
+                }
+                for output_format, stats in _render["documents"].items()
+            },
+        }
@@ -0,0 +1,66 @@
+import importlib.util
+import os
+import threading
+
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+
+# ===============================================================
+# === SHARED OPENAI CLIENTS ===
+# ===============================================================
+# One client per worker process keeps the httpx connection pool (and the TLS
+# sessions in it) alive across chunks, retries and requests.
+
+API_KEY = os.getenv("API_KEY")
+# Falls back to the public API when unset; also used to point at a local mock server
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+# Chunks of one run are seconds apart, so keep idle connections longer than httpx's 5s default
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "180"))
+# HTTP/2 needs the optional `h2` package; use it only when it is installed
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "auto").lower()
+
+_client = None
+_client_lock = threading.Lock()
+
+def _http2_enabled() -> bool:
+    if OPENAI_HTTP2 == "auto":
+        return importlib.util.find_spec("h2") is not None
+    return OPENAI_HTTP2 == "true"
+
+def _http_client_options() -> dict:
+    return {
+        "limits": httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        "http2": _http2_enabled(),
+    }
+
+def get_openai_client() -> OpenAI:
+    """Returns the process-wide OpenAI client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=API_KEY,
+                    base_url=OPENAI_BASE_URL,
+                    max_retries=0, # Retries go through services.RateLimiter instead
+                    http_client=DefaultHttpxClient(**_http_client_options())
+                )
+    return _client
+
+def close_openai_clients():
+    """Closes the shared client (e.g. on shutdown or in benchmarks)."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
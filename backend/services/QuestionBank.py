@@ -0,0 +1,90 @@
+from typing import List, NamedTuple, Optional, Tuple
+
+from database import SessionLocal
+from crud import get_unused_bank_questions, add_bank_questions, mark_bank_questions_served
+from services.StructuredOutput import question_text
+
+# ===============================================================
+# === QUESTION BANK (PLAN FULFILMENT) ===
+# ===============================================================
+# Validated questions are stored per (exam, qtype, topic). A run can then take
+# unused questions from the bank for as many plan slots as possible and only
+# send the remaining topics to GPT. Questions taken from the bank only count as
+# served once the run has delivered them (mark_bank_questions_delivered).
+# Structured questions keep their fields (question_json) next to their rendered text.
+
+class BankedQuestion(NamedTuple):
+    id: int
+    qtype: str
+    topic: str
+    text: str
+    fields: Optional[dict] = None
+
+    @property
+    def question(self):
+        """The question as generation produces it: its fields if structured, its text otherwise."""
+        return self.fields if self.fields is not None else self.text
+
+def take_from_question_bank(user_id: int, exam_name: str, chunks: List[Tuple[str, List[str]]], questions_per_chunk: int):
+    """Fills (qtype, chunk_topics) slots from the bank without repeating questions for the user.
+    Returns (banked_questions, remaining_chunks): BankedQuestions in plan order, and the missed topics
+    of each qtype regrouped into chunks of up to questions_per_chunk topics."""
+    topics_by_qtype = {}
+    for qtype, chunk_topics in chunks:
+        topics_by_qtype.setdefault(qtype, []).extend(chunk_topics)
+
+    banked_questions = []
+    remaining_chunks = []
+    db = SessionLocal()
+    try:
+        for qtype, qtype_topics in topics_by_qtype.items():
+            available = get_unused_bank_questions(db, user_id, exam_name, qtype, list(set(qtype_topics)))
+            missing_topics = []
+            for topic in qtype_topics:
+                if available.get(topic):
+                    question = available[topic].pop()
+                    banked_questions.append(BankedQuestion(question.id, qtype, topic, question.question_text, question.question_json))
+                else:
+                    missing_topics.append(topic)
+            for i in range(0, len(missing_topics), questions_per_chunk):
+                remaining_chunks.append((qtype, missing_topics[i:i + questions_per_chunk]))
+    except Exception as e:
+        print(f"⚠️ Question bank lookup failed, generating every question: {e}")
+        return [], chunks
+    finally:
+        db.close()
+
+    print(f"🏦 Question bank served {len(banked_questions)} question(s); {sum(len(t) for _, t in remaining_chunks)} left for GPT.")
+    return banked_questions, remaining_chunks
+
+def mark_bank_questions_delivered(user_id: int, banked_questions: List[BankedQuestion]):
+    """Marks the bank questions of a delivered paper as served, so they are not repeated for the user.
+    Called once the paper is rendered; a run that fails or delivers nothing leaves them for the next one."""
+    if user_id is None or not banked_questions:
+        return
+    db = SessionLocal()
+    try:
+        mark_bank_questions_served(db, user_id, [question.id for question in banked_questions])
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️ Failed to mark bank questions as served: {e}")
+    finally:
+        db.close()
+
+def store_in_question_bank(user_id: int, exam_name: str, qtype: str, chunk_topics: List[str], questions: list):
+    """Saves a validated chunk (one question per topic, in topic order, text or structured) and marks it
+    as served to the user."""
+    db = SessionLocal()
+    try:
+        entries = [
+            (topic, question_text(question), question if isinstance(question, dict) else None)
+            for topic, question in zip(chunk_topics, questions)
+        ]
+        db_questions = add_bank_questions(db, exam_name, qtype, entries)
+        if user_id is not None:
+            mark_bank_questions_served(db, user_id, [q.id for q in db_questions])
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️ Failed to store chunk in the question bank: {e}")
+    finally:
+        db.close()
@@ -0,0 +1,123 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+from services.StructuredOutput import structured_question_problems, validate_question
+
+# ===============================================================
+# === PER-QUESTION STRUCTURAL VALIDATION ===
+# ===============================================================
+# A chunk used to pass as soon as it had one question per topic. Each question is
+# now checked on its own (answer key, options, solution, hence line), so broken
+# questions are not shipped and only they are regenerated, not the whole chunk.
+# Structured (JSON) questions are checked field by field instead
+# (services.StructuredOutput), without the text layout rules below.
+
+VALIDATE_QUESTIONS = os.getenv("VALIDATE_QUESTIONS", "true").lower() == "true"
+DEFAULT_NUM_OPTIONS = 4
+# Options per question for qtypes that differ from DEFAULT_NUM_OPTIONS (every current template uses four)
+QTYPE_NUM_OPTIONS: Dict[str, int] = {}
+
+_ANSWER_KEY_LINE = re.compile(r"^\s*Answer\s*Key\s*:\s*\(?\s*(\d+)?", re.IGNORECASE | re.MULTILINE)
+_OPTION_LINE = re.compile(r"^\s*\((\d+)\)\s*(.*?)\s*$", re.MULTILINE)
+_SOLUTION_LINE = re.compile(r"^\s*Solution\s*:", re.IGNORECASE | re.MULTILINE)
+# "Hence, Option (1) is the right answer." / "Thus, the correct answer is Option (3)."
+_HENCE_LINE = re.compile(r"^\s*(?:Hence|Thus|Therefore)\b.*?Option\s*\(?\s*(\d+)", re.IGNORECASE | re.MULTILINE)
+
+def question_problems(text: str, qtype: Optional[str] = None) -> List[str]:
+    """Returns what is structurally wrong with one question (an empty list if it is valid)."""
+    num_options = QTYPE_NUM_OPTIONS.get(qtype, DEFAULT_NUM_OPTIONS)
+    answer_key_match = _ANSWER_KEY_LINE.search(text)
+    if answer_key_match is None:
+        return ["no 'Answer Key:' line"]
+    problems = []
+
+    options = _OPTION_LINE.findall(text[:answer_key_match.start()])
+    numbers = [int(number) for number, _ in options]
+    if numbers != list(range(1, num_options + 1)):
+        problems.append(f"expected options (1)-({num_options}), found {len(options)}")
+    texts = [" ".join(option.split()).lower() for _, option in options]
+    if any(not option for option in texts):
+        problems.append("empty option")
+    elif len(set(texts)) < len(texts):
+        problems.append("duplicate options")
+
+    answer_key = int(answer_key_match.group(1)) if answer_key_match.group(1) else None
+    if answer_key is None:
+        problems.append("answer key is not a number")
+    elif not 1 <= answer_key <= num_options:
+        problems.append(f"answer key {answer_key} outside 1-{num_options}")
+
+    after_answer_key = text[answer_key_match.end():]
+    solution_match = _SOLUTION_LINE.search(after_answer_key)
+    hence_matches = list(_HENCE_LINE.finditer(after_answer_key))
+    if solution_match is None:
+        problems.append("no 'Solution:' section")
+    if not hence_matches:
+        problems.append("no hence line")
+    else:
+        hence = hence_matches[-1]
+        if solution_match is not None and not after_answer_key[solution_match.end():hence.start()].strip():
+            problems.append("empty solution")
+        if answer_key is not None and int(hence.group(1)) != answer_key:
+            problems.append(f"hence line says option {hence.group(1)}, answer key says {answer_key}")
+    return problems
+
+def check_question(question, qtype: Optional[str] = None) -> Tuple[object, List[str]]:
+    """(question, problems) for a marker-format (text) question or a structured question item; valid
+    structured questions come back normalised (see validate_question)."""
+    if isinstance(question, str):
+        return question, question_problems(question, qtype) if VALIDATE_QUESTIONS else []
+    problems = structured_question_problems(question)
+    return (question, problems) if problems else (validate_question(question), [])
+
+def assign_questions(questions: list, positions: List[int], qtype: Optional[str] = None, truncated: bool = False) -> Tuple[Dict[int, object], List[Tuple[object, List[str]]]]:
+    """Matches the questions of a response (text, or structured question items) to the topic positions
+    it was asked for, in order.
+    Returns ({position: question} for valid questions, [(question, problems)] for rejected ones).
+    Extra fragments (e.g. from a stray marker) are dropped if invalid; if there are still more
+    questions than positions they cannot be matched to topics and all are rejected. Fewer questions
+    than positions are only matched in order when the response was truncated (cut off at max_tokens,
+    so they are the first topics); otherwise any topic may have been skipped and all are rejected."""
+    checked = [check_question(question, qtype) for question in questions]
+    rejected = []
+    if len(checked) > len(positions):
+        rejected = [(question, problems) for question, problems in checked if problems]
+        checked = [(question, problems) for question, problems in checked if not problems]
+        if len(checked) > len(positions):
+            return {}, rejected + [(question, [f"{len(checked)} questions for {len(positions)} topics"]) for question, _ in checked]
+    if len(checked) < len(positions) and not truncated:
+        return {}, rejected + [(question, problems or [f"{len(checked)} questions for {len(positions)} topics"]) for question, problems in checked]
+    accepted = {}
+    for position, (question, problems) in zip(positions, checked):
+        if problems:
+            rejected.append((question, problems))
+        else:
+            accepted[position] = question
+    return accepted, rejected
+
+def describe_rejections(rejected: List[Tuple[str, List[str]]]) -> str:
+    """One-line summary of rejected questions, for logs and progress events."""
+    return "; ".join(", ".join(problems) for _, problems in rejected)
+
+_QUESTION_NUMBER = re.compile(r"^\s*\d+\s*[.)]\s*")
+
+def parse_question(text: str) -> Dict[str, object]:
+    """Splits a question into stem, options, answer key and solution (for the CSV / JSON / answer-key
+    exports); parts that are missing come back empty, as banked questions predate validation."""
+    answer_key_match = _ANSWER_KEY_LINE.search(text)
+    before_answer_key = text if answer_key_match is None else text[:answer_key_match.start()]
+    first_option = _OPTION_LINE.search(before_answer_key)
+    stem = before_answer_key if first_option is None else before_answer_key[:first_option.start()]
+    solution = ""
+    if answer_key_match is not None:
+        after_answer_key = text[answer_key_match.end():]
+        solution_match = _SOLUTION_LINE.search(after_answer_key)
+        if solution_match is not None:
+            solution = after_answer_key[solution_match.end():]
+    return {
+        "stem": _QUESTION_NUMBER.sub("", stem.strip(), count=1),
+        "options": [option for _, option in _OPTION_LINE.findall(before_answer_key)],
+        "answer_key": int(answer_key_match.group(1)) if answer_key_match and answer_key_match.group(1) else None,
+        "solution": solution.strip(),
+    }
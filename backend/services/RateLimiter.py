@@ -0,0 +1,166 @@
+import os
+import random
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+# ===============================================================
+# === CLIENT-SIDE OPENAI RATE LIMITING ===
+# ===============================================================
+# Every GPT request takes from two token buckets per model: one for requests/min
+# and one for estimated tokens/min. The buckets start from the configured limits
+# and are re-synced from the x-ratelimit-* headers the API returns, so concurrent
+# generations share the account ceiling instead of running into 429 storms.
+
+DEFAULT_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+DEFAULT_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "30000"))
+# Stay slightly under the advertised limits to leave room for other clients of the key
+RATE_LIMIT_HEADROOM = float(os.getenv("OPENAI_RATE_LIMIT_HEADROOM", "0.95"))
+BACKOFF_BASE_SECONDS = float(os.getenv("OPENAI_BACKOFF_BASE_SECONDS", "1"))
+BACKOFF_MAX_SECONDS = float(os.getenv("OPENAI_BACKOFF_MAX_SECONDS", "60"))
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parses x-ratelimit-reset-* values such as '1s', '6m0s' or '20ms' into seconds."""
+    if not value:
+        return None
+    seconds = 0.0
+    matched = False
+    for amount, unit in _DURATION_PART.findall(value):
+        matched = True
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds if matched else None
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Reads the server's requested wait from retry-after-ms / retry-after headers."""
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Exponential backoff with full jitter, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+class TokenBucket:
+    """Refills continuously up to `capacity` at `capacity` units per minute."""
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.available = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        rate_per_second = self.capacity / 60.0
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * rate_per_second)
+        self.updated_at = now
+
+    def seconds_until(self, amount: float) -> float:
+        """Seconds until `amount` units are available (0 if they are available now)."""
+        # A request bigger than the whole bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / (self.capacity / 60.0)
+
+class ModelRateLimiter:
+    """Requests/min and tokens/min limiter for one model."""
+
+    def __init__(self, rpm: int = DEFAULT_RPM_LIMIT, tpm: int = DEFAULT_TPM_LIMIT):
+        self.requests = TokenBucket(rpm * RATE_LIMIT_HEADROOM)
+        self.tokens = TokenBucket(tpm * RATE_LIMIT_HEADROOM)
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens: int):
+        """Blocks until one request and `estimated_tokens` tokens can be spent, then spends them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                wait = max(
+                    self.blocked_until - now,
+                    self.requests.seconds_until(1),
+                    self.tokens.seconds_until(estimated_tokens),
+                )
+                if wait <= 0:
+                    self.requests.available -= 1
+                    self.tokens.available -= min(estimated_tokens, self.tokens.capacity)
+                    return
+            time.sleep(min(wait, 5.0))
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Refunds (or charges) the difference between the estimate and the reported usage."""
+        if actual_tokens is None:
+            return
+        with self._lock:
+            self.tokens.available = min(self.tokens.capacity, self.tokens.available + estimated_tokens - actual_tokens)
+
+    def update_from_headers(self, headers):
+        """Re-syncs both buckets with the x-ratelimit-* headers of a response."""
+        if not headers:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                try:
+                    limit = headers.get(f"x-ratelimit-limit-{kind}")
+                    remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                    if limit:
+                        bucket.refill(now)
+                        bucket.capacity = float(limit) * RATE_LIMIT_HEADROOM
+                    if remaining is not None:
+                        bucket.refill(now)
+                        bucket.available = min(bucket.available, float(remaining) * RATE_LIMIT_HEADROOM)
+                except ValueError:
+                    continue
+
+    def observe_error(self, error: Exception) -> Optional[float]:
+        """Feeds a failed call back into the limiter; returns the server's Retry-After, if any."""
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        retry_after = retry_after_seconds(headers)
+        if getattr(error, "status_code", None) == 429:
+            self.update_from_headers(headers)
+            self.penalize(retry_after, headers)
+        return retry_after
+
+    def penalize(self, retry_after: Optional[float], headers=None):
+        """Pauses every caller of this model after a 429, for as long as the server asked."""
+        wait = retry_after
+        if wait is None and headers:
+            resets = [parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}")) for kind in ("requests", "tokens")]
+            resets = [r for r in resets if r is not None]
+            wait = max(resets) if resets else None
+        if wait is None:
+            wait = BACKOFF_BASE_SECONDS
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + wait)
+            self.requests.available = min(self.requests.available, 0)
+
+_limiters: Dict[str, ModelRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(model: str) -> ModelRateLimiter:
+    """Returns the shared limiter for a model, creating it on first use."""
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = ModelRateLimiter()
+        return _limiters[model]
+
+def estimate_request_tokens(*texts: str, max_tokens: int = 0) -> int:
+    """Rough token count used for the tokens/min bucket (~4 characters per token).
+    OpenAI counts max_tokens against the limit up front, so it is included."""
+    return sum(len(t) for t in texts if t) // 4 + max_tokens
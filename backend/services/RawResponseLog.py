@@ -0,0 +1,331 @@
+import argparse
+import atexit
+import glob
+import gzip
+import io
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+from services.Storage import data_path
+
+try:
+    import zstandard
+except ImportError: # Optional: the log is gzip-compressed without it
+    zstandard = None
+
+# ===============================================================
+# === RAW RESPONSE LOG ===
+# ===============================================================
+# Every raw GPT response used to be laid out as its own PDF on the generating
+# thread: an FPDF pass and a file per response, and nothing could search them.
+# Responses are now appended to a compressed JSONL log with their run, qtype,
+# attempt and latency. append() only queues the record; a background thread
+# serialises, compresses and writes it, and rotates the log into segments.
+#
+#     cd backend && python -m services.RawResponseLog grep "Answer Key" --run-id 1a2b3c4d
+#     cd backend && python -m services.RawResponseLog replay --run-id 1a2b3c4d
+
+RAW_RESPONSE_LOG_DIR = os.getenv("RAW_RESPONSE_LOG_DIR", data_path("raw_responses"))
+# "zstd" (needs the zstandard package) or "gzip"
+RAW_RESPONSE_LOG_COMPRESSION = os.getenv("RAW_RESPONSE_LOG_COMPRESSION", "zstd" if zstandard is not None else "gzip").lower()
+# A segment is closed and a new one started once it reaches this many (compressed) bytes
+RAW_RESPONSE_LOG_SEGMENT_BYTES = int(os.getenv("RAW_RESPONSE_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+# Closed segments kept; older ones are deleted (0 = keep all)
+RAW_RESPONSE_LOG_MAX_SEGMENTS = int(os.getenv("RAW_RESPONSE_LOG_MAX_SEGMENTS", "50"))
+# Buffered records are flushed to disk (readable) at least this often
+RAW_RESPONSE_LOG_FLUSH_SECONDS = float(os.getenv("RAW_RESPONSE_LOG_FLUSH_SECONDS", "2"))
+# Records waiting for the writer; beyond that new ones are dropped rather than slowing generation down
+RAW_RESPONSE_LOG_MAX_PENDING = int(os.getenv("RAW_RESPONSE_LOG_MAX_PENDING", "10000"))
+
+SEGMENT_PREFIX = "raw_responses_"
+SEGMENT_EXTENSIONS = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+# Suffix of the segment a process is writing (renamed when it is closed; never rotated away)
+ACTIVE_SUFFIX = ".active"
+
+_FLUSH = object()
+_CLOSE = object()
+
+class _Segment:
+    """One compressed JSONL file being written."""
+
+    def __init__(self, path: str, compression: str):
+        self.path = path
+        self.file = open(path + ACTIVE_SUFFIX, "wb")
+        if compression == "zstd":
+            self.stream = zstandard.ZstdCompressor(level=3).stream_writer(self.file, closefd=False)
+        else:
+            self.stream = gzip.GzipFile(fileobj=self.file, mode="wb", compresslevel=6)
+        self.compression = compression
+
+    def write(self, data: bytes):
+        self.stream.write(data)
+
+    def flush(self):
+        """Ends the compressed block, so everything written so far can be read back."""
+        if self.compression == "zstd":
+            self.stream.flush(zstandard.FLUSH_BLOCK)
+        else:
+            self.stream.flush()
+        self.file.flush()
+
+    def size(self) -> int:
+        return self.file.tell()
+
+    def close(self):
+        self.stream.close()
+        self.file.close()
+        os.replace(self.path + ACTIVE_SUFFIX, self.path)
+
+class RawResponseLog:
+    """Append-only log of raw responses. append() never blocks: records are written by a background
+    thread (started on first use), which flushes every RAW_RESPONSE_LOG_FLUSH_SECONDS and starts a new
+    segment file every RAW_RESPONSE_LOG_SEGMENT_BYTES."""
+
+    def __init__(self, directory: str = RAW_RESPONSE_LOG_DIR, compression: str = RAW_RESPONSE_LOG_COMPRESSION,
+                 segment_bytes: int = RAW_RESPONSE_LOG_SEGMENT_BYTES, max_segments: int = RAW_RESPONSE_LOG_MAX_SEGMENTS,
+                 flush_seconds: float = RAW_RESPONSE_LOG_FLUSH_SECONDS, max_pending: int = RAW_RESPONSE_LOG_MAX_PENDING):
+        if compression == "zstd" and zstandard is None:
+            print("⚠️ zstandard is not installed, the raw response log is gzip-compressed.")
+            compression = "gzip"
+        if compression not in SEGMENT_EXTENSIONS:
+            raise ValueError(f"Unknown raw response log compression: {compression}")
+        self.directory = directory
+        self.compression = compression
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.flush_seconds = flush_seconds
+        self.records = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._segment: Optional[_Segment] = None
+        self._segment_number = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def append(self, record: dict) -> bool:
+        """Queues a record for the log; returns False if it was dropped because the writer is behind."""
+        self._start()
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                if self.dropped == 1:
+                    print(f"⚠️ Raw response log is {self._queue.maxsize} records behind; dropping responses.")
+            return False
+
+    def flush(self):
+        """Waits until the records appended so far are on disk."""
+        if self._thread is not None:
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    def close(self):
+        """Writes the pending records and closes the current segment."""
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(_CLOSE)
+                self._thread.join()
+                self._thread = None
+
+    def stats(self) -> dict:
+        return {"compression": self.compression, "records": self.records, "dropped": self.dropped, "pending": self._queue.qsize()}
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="raw-response-log", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self._queue.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                record, queued = _FLUSH, False
+            else:
+                queued = True
+            try:
+                if record is _CLOSE:
+                    self._close_segment()
+                    return
+                if record is not _FLUSH:
+                    self._write(record)
+                if record is _FLUSH or time.monotonic() - last_flush >= self.flush_seconds:
+                    if self._segment is not None:
+                        self._segment.flush()
+                    last_flush = time.monotonic()
+            except Exception as e:
+                print(f"❌ Failed to write the raw response log. Details: {e}")
+            finally:
+                if queued:
+                    self._queue.task_done() # flush() waits for this
+
+    def _write(self, record: dict):
+        if self._segment is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._segment_number += 1
+            name = f"{SEGMENT_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{self._segment_number:04d}"
+            self._segment = _Segment(os.path.join(self.directory, name + SEGMENT_EXTENSIONS[self.compression]), self.compression)
+        self._segment.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.records += 1
+        if self._segment.size() >= self.segment_bytes:
+            self._close_segment()
+
+    def _close_segment(self):
+        if self._segment is None:
+            return
+        segment, self._segment = self._segment, None
+        segment.close()
+        if self.max_segments > 0:
+            closed = list_segments(self.directory, include_active=False)
+            for path in closed[:-self.max_segments]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass # Removed by another process
+
+_log: Optional[RawResponseLog] = None
+_log_lock = threading.Lock()
+
+def get_raw_response_log() -> RawResponseLog:
+    """The process-wide raw response log (its pending records are written at exit)."""
+    global _log
+    with _log_lock:
+        if _log is None:
+            _log = RawResponseLog()
+            atexit.register(_log.close)
+        return _log
+
+def close_raw_response_log():
+    """Writes the pending records and closes the log (a new segment is started on the next response)."""
+    with _log_lock:
+        log = _log
+    if log is not None:
+        log.close()
+
+def log_raw_response(response: str, run_id: str = None, qtype: str = None, attempt: int = None,
+                     latency_seconds: float = None, **fields) -> bool:
+    """Appends a raw response to the log with what produced it (extra fields are stored as given)."""
+    return get_raw_response_log().append({
+        "time": datetime.now().isoformat(timespec="milliseconds"),
+        "run_id": run_id,
+        "qtype": qtype,
+        "attempt": attempt,
+        "latency_seconds": round(latency_seconds, 3) if latency_seconds is not None else None,
+        **fields,
+        "response": response,
+    })
+
+# ===============================================================
+# === READER ===
+# ===============================================================
+
+def list_segments(directory: str = RAW_RESPONSE_LOG_DIR, include_active: bool = True) -> List[str]:
+    """Segment files, oldest first (names start with their creation time)."""
+    paths = []
+    for extension in SEGMENT_EXTENSIONS.values():
+        paths += glob.glob(os.path.join(directory, f"{SEGMENT_PREFIX}*{extension}"))
+        if include_active:
+            paths += glob.glob(os.path.join(directory, f"{SEGMENT_PREFIX}*{extension}{ACTIVE_SUFFIX}"))
+    return sorted(paths, key=os.path.basename)
+
+# Raised when reading past the last flush of a segment that was not closed
+_TRUNCATED_STREAM_ERRORS = (EOFError, OSError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+def _open_segment(path: str):
+    if path.endswith(ACTIVE_SUFFIX):
+        name = path[:-len(ACTIVE_SUFFIX)]
+    else:
+        name = path
+    if name.endswith(SEGMENT_EXTENSIONS["zstd"]):
+        if zstandard is None:
+            raise RuntimeError(f"{path} is zstd-compressed; install zstandard to read it")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+    return gzip.open(path, "rb")
+
+def read_segment(path: str) -> Iterator[dict]:
+    """Records of a segment. A segment still being written (or cut off by a crash) is read up to its
+    last flush."""
+    with _open_segment(path) as stream:
+        lines = io.TextIOWrapper(stream, encoding="utf-8")
+        try:
+            for line in lines:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue # Torn last line
+        except _TRUNCATED_STREAM_ERRORS:
+            return # Unfinished compressed stream
+
+def read_records(directory: str = RAW_RESPONSE_LOG_DIR, run_id: str = None, qtype: str = None,
+                 since: str = None, pattern: Optional["re.Pattern"] = None) -> Iterator[dict]:
+    """Records of every segment in the order they were logged, optionally filtered by run, qtype,
+    time (ISO prefix, e.g. 2024-06-01 or 2024-06-01T14) and a regex over the response."""
+    for path in list_segments(directory):
+        for record in read_segment(path):
+            if run_id is not None and record.get("run_id") != run_id:
+                continue
+            if qtype is not None and record.get("qtype") != qtype:
+                continue
+            if since is not None and (record.get("time") or "") < since:
+                continue
+            if pattern is not None and not pattern.search(record.get("response") or ""):
+                continue
+            yield record
+
+def _describe(record: dict) -> str:
+    fields = [record.get("time"), f"run {record.get('run_id')}", record.get("qtype"), f"attempt {record.get('attempt')}"]
+    if record.get("latency_seconds") is not None:
+        fields.append(f"{record['latency_seconds']}s")
+    if record.get("chunk") is not None:
+        fields.append(f"chunk {record['chunk']}")
+    return " | ".join(str(field) for field in fields if field is not None)
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Searches and replays the raw GPT response log.")
+    parser.add_argument("--dir", default=RAW_RESPONSE_LOG_DIR, help="Log directory (default: RAW_RESPONSE_LOG_DIR)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    grep_parser = commands.add_parser("grep", help="Lists the responses matching a regex, with the matching lines")
+    grep_parser.add_argument("pattern")
+    grep_parser.add_argument("-i", "--ignore-case", action="store_true")
+    replay_parser = commands.add_parser("replay", help="Prints the responses in the order they were logged")
+    replay_parser.add_argument("--json", action="store_true", help="Whole records as JSON lines")
+    for command in (grep_parser, replay_parser):
+        command.add_argument("--run-id")
+        command.add_argument("--qtype")
+        command.add_argument("--since", help="ISO time prefix, e.g. 2024-06-01 or 2024-06-01T14:30")
+    args = parser.parse_args(argv)
+
+    pattern = re.compile(args.pattern, re.IGNORECASE if args.ignore_case else 0) if args.command == "grep" else None
+    count = 0
+    try:
+        for record in read_records(args.dir, args.run_id, args.qtype, args.since, pattern):
+            count += 1
+            if args.command == "grep":
+                print(_describe(record))
+                for line in (record.get("response") or "").splitlines():
+                    if pattern.search(line):
+                        print(f"    {line}")
+            elif args.json:
+                print(json.dumps(record, ensure_ascii=False))
+            else:
+                print(f"===== {_describe(record)}")
+                print(record.get("response") or "")
+    except BrokenPipeError:
+        sys.stderr.close() # Output piped into head
+        return
+    print(f"{count} response(s)", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
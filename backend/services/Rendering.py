@@ -0,0 +1,359 @@
+import io
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, List, Sequence, Set, Tuple
+from xml.sax.saxutils import escape as xml_escape
+
+from docx import Document
+from services.Metrics import record_render_queued, record_render_finished
+from services.UnicodePdf import UnicodeFPDF
+
+# ===============================================================
+# === DOCUMENT RENDERING ===
+# ===============================================================
+# FPDF layout and python-docx serialisation are pure CPU and used to hold the GIL
+# of the worker for seconds on large papers, and a paper was only rendered once all
+# of it was generated. Documents are now written incrementally as chunks are
+# validated: PDF layout (the expensive part) runs on a bounded process pool, section
+# by section, while the remaining GPT calls are in flight, and laid-out pages are
+# spooled to disk until the file is assembled; a .docx is streamed straight into its
+# zip package.
+
+# Render worker processes (0 = render in the calling thread)
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", str(min(4, os.cpu_count() or 1))))
+# Blocks (questions / skipped chunks) per PDF section; smaller documents are laid out in one piece
+RENDER_SECTION_BLOCKS = int(os.getenv("RENDER_SECTION_BLOCKS", "50"))
+# Sections waiting for or being rendered, across all runs, before new ones have to wait
+RENDER_MAX_QUEUED = int(os.getenv("RENDER_MAX_QUEUED", "32"))
+
+PDF_FONT_SIZE = 11
+PDF_FALLBACK_FONT = "Arial" # Latin-1 core font, when the Unicode font is missing
+PDF_LINE_HEIGHT = 5
+
+def pdf_safe(text: str) -> str:
+    """The core PDF fonts are latin-1 only; other characters become '?'."""
+    return text.encode('latin-1', 'replace').decode('latin-1')
+
+def set_pdf_font(pdf: UnicodeFPDF) -> bool:
+    """Registers and selects the document font as the only font of the PDF (so it is /F1). Returns
+    whether it is the Unicode font."""
+    family = pdf.add_unicode_font()
+    pdf.set_font(family or PDF_FALLBACK_FONT, size=PDF_FONT_SIZE)
+    return family is not None
+
+def load_pdf_font():
+    """Parses the PDF font ahead of the first document (render worker initializer)."""
+    set_pdf_font(UnicodeFPDF())
+
+def layout_pdf_pages(text: str) -> Tuple[List[str], Set[int]]:
+    """Lays out text with FPDF and returns the content stream of every page and the characters
+    the pages use from the font, to subset it (runs in a worker)."""
+    pdf = UnicodeFPDF()
+    pdf.add_page()
+    unicode_font = set_pdf_font(pdf)
+    pdf.multi_cell(0, PDF_LINE_HEIGHT, txt=pdf.writable(text) if unicode_font else pdf_safe(text))
+    glyphs = set(pdf.current_font['subset']) if unicode_font else set()
+    return [pdf.pages[n] for n in range(1, pdf.page + 1)], glyphs
+
+class _FileBuffer:
+    """Stands in for FPDF.buffer: lines FPDF appends go straight to the file; len() is the bytes written
+    (FPDF takes object offsets from it)."""
+
+    def __init__(self, file):
+        self.file = file
+        self.size = 0
+
+    def __iadd__(self, text: str):
+        data = text.encode("latin1")
+        self.file.write(data)
+        self.size += len(data)
+        return self
+
+    def __len__(self):
+        return self.size
+
+class _PageStreamFPDF(UnicodeFPDF):
+    """Assembles laid-out pages (from layout_pdf_pages) into a PDF written straight to a file, reading
+    every page only when it is output. The pages come from processes that registered the same single
+    font first, so their /F1 references stay valid here; the font is subset to the glyphs they use."""
+
+    def __init__(self, pages: Sequence[str], file, glyphs: Iterable[int] = ()):
+        UnicodeFPDF.__init__(self)
+        if set_pdf_font(self):
+            self.current_font['subset'].update(glyphs)
+        self.pages = _PageNumbering(pages)
+        self.page = len(pages)
+        self.state = 1 # Pages are complete: _out writes to the (file) buffer, not to a page
+        self.buffer = _FileBuffer(file)
+
+class _PageNumbering:
+    """FPDF numbers pages from 1."""
+
+    def __init__(self, pages: Sequence[str]):
+        self._pages = pages
+
+    def __getitem__(self, number: int) -> str:
+        return self._pages[number - 1]
+
+def write_pdf_pages(pages: Sequence[str], path: str, glyphs: Iterable[int] = ()):
+    """Writes laid-out pages as one PDF, embedding the glyphs they use."""
+    with open(path, "wb") as f:
+        _PageStreamFPDF(pages or [""], f, glyphs).close()
+
+class PageSpool:
+    """Laid-out pages kept in a temporary file instead of in memory, readable by page index."""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self._extents = []
+        self._end = 0
+
+    def __len__(self):
+        return len(self._extents)
+
+    def add(self, pages: List[str]):
+        self.file.seek(self._end)
+        for page in pages:
+            data = page.encode("latin1")
+            self.file.write(data)
+            self._extents.append((self._end, len(data)))
+            self._end += len(data)
+
+    def __getitem__(self, index: int) -> str:
+        offset, length = self._extents[index]
+        self.file.seek(offset)
+        return self.file.read(length).decode("latin1")
+
+    def close(self):
+        self.file.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+_queue_slots = threading.BoundedSemaphore(max(1, RENDER_MAX_QUEUED))
+
+def get_render_pool():
+    """The process-wide render pool, started on first use (None when RENDER_PROCESSES is 0)."""
+    global _pool
+    if RENDER_PROCESSES <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a process that runs threads (uvicorn, job workers) is not safe
+            _pool = ProcessPoolExecutor(
+                max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn"), initializer=load_pdf_font
+            )
+        return _pool
+
+def shutdown_render_pool():
+    """Stops the render workers (a new pool is started on the next render)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        # wait=True: without it idle workers can miss their stop signal and block interpreter exit
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def _submit(pool, function, *args):
+    """Submits a render task, waiting while RENDER_MAX_QUEUED tasks (across all runs) are queued."""
+    _queue_slots.acquire()
+    record_render_queued(1)
+    def release(_future=None):
+        _queue_slots.release()
+        record_render_queued(-1)
+    try:
+        future = pool.submit(function, *args)
+    except BaseException:
+        release()
+        raise
+    future.add_done_callback(release)
+    return future
+
+class DocumentWriter:
+    """Renders a document incrementally: append() takes blocks (questions, skipped chunks, ...) as they
+    are produced, separated by blank lines in the document, and finish() completes the file. Neither the
+    whole text nor the whole rendered document is ever held in memory. Not thread-safe: feed it from
+    one thread (e.g. an on_chunk callback, which runs in prompt order). The document is written to a
+    temporary file next to path and only renamed to path by finish(), so downloads never see a partial
+    file."""
+
+    output_format = None
+
+    def __init__(self, path: str):
+        self.path = path
+        fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp_", suffix=os.path.splitext(path)[1])
+        os.close(fd)
+        self.blocks = 0
+        self.sections = 0
+        self.seconds = 0.0 # Spent in append() and finish(), for the render metrics
+
+    def append(self, blocks: List[str]):
+        started_at = time.perf_counter()
+        self._append(blocks)
+        self.blocks += len(blocks)
+        self.seconds += time.perf_counter() - started_at
+
+    def finish(self):
+        started_at = time.perf_counter()
+        self._finish()
+        os.replace(self.temp_path, self.path)
+        self.seconds += time.perf_counter() - started_at
+        record_render_finished(self.output_format, self.sections, self.seconds)
+
+    def abort(self):
+        """Drops the document (e.g. when the run produced nothing or failed)."""
+        self._close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class PdfDocumentWriter(DocumentWriter):
+    """Every RENDER_SECTION_BLOCKS blocks form a section that is laid out on the render pool while
+    generation goes on (a section starts on a new page). Laid-out pages are spooled to a temporary
+    file in order, and finish() streams them into the PDF with the font subset to the glyphs used."""
+
+    output_format = "pdf"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.spool = PageSpool()
+        self.glyphs: Set[int] = set()
+        self._pending: List[str] = [] # Blocks of the section being filled
+        self._in_flight = deque() # (future or None, section text), in document order
+
+    def _append(self, blocks: List[str]):
+        for block in blocks:
+            self._pending.append(block)
+            if len(self._pending) >= RENDER_SECTION_BLOCKS:
+                self._submit_section()
+        self._spool_laid_out(wait=False)
+
+    def _submit_section(self):
+        text = "\n\n".join(self._pending)
+        self._pending = []
+        self.sections += 1
+        pool = get_render_pool()
+        self._in_flight.append((_submit(pool, layout_pdf_pages, text) if pool is not None else None, text))
+
+    def _spool_laid_out(self, wait: bool):
+        """Moves laid-out sections at the head of the queue to the spool (all of them if wait)."""
+        while self._in_flight:
+            future, text = self._in_flight[0]
+            if future is not None and not wait and not future.done():
+                return
+            self._in_flight.popleft()
+            if future is None:
+                self._spool(*layout_pdf_pages(text))
+                continue
+            try:
+                self._spool(*future.result())
+            except BrokenProcessPool:
+                print("⚠️ Render pool broke, rendering in-process.")
+                shutdown_render_pool()
+                self._spool(*layout_pdf_pages(text))
+
+    def _spool(self, pages: List[str], glyphs: Set[int]):
+        self.spool.add(pages)
+        self.glyphs.update(glyphs)
+
+    def _finish(self):
+        if self._pending or not self.sections:
+            self._submit_section()
+        self._spool_laid_out(wait=True)
+        try:
+            write_pdf_pages(self.spool, self.temp_path, self.glyphs)
+        finally:
+            self.spool.close()
+
+    def _close(self):
+        for future, _ in self._in_flight:
+            if future is not None:
+                future.cancel()
+        self._in_flight.clear()
+        self.spool.close()
+
+# Characters XML 1.0 does not allow (python-docx refuses them)
+_XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+_DOCX_LINE_BREAK = re.compile(r"(\n|\r|\t)")
+
+def docx_run_content(text: str) -> str:
+    """The XML of text inside a <w:r>, as python-docx writes it: line breaks become <w:br/>, tabs <w:tab/>."""
+    parts = []
+    for piece in _DOCX_LINE_BREAK.split(_XML_ILLEGAL.sub("", text)):
+        if piece == "\t":
+            parts.append("<w:tab/>")
+        elif piece in ("\n", "\r"):
+            parts.append("<w:br/>")
+        elif piece:
+            parts.append(f'<w:t xml:space="preserve">{xml_escape(piece)}</w:t>')
+    return "".join(parts)
+
+DOCX_DOCUMENT_PART = "word/document.xml"
+_docx_template = None
+
+def docx_template():
+    """The parts of python-docx's default document, with word/document.xml split around its body content."""
+    global _docx_template
+    if _docx_template is None:
+        buffer = io.BytesIO()
+        Document().save(buffer)
+        with zipfile.ZipFile(buffer) as template:
+            parts = [(info, template.read(info)) for info in template.infolist()]
+        document_xml = next(data for info, data in parts if info.filename == DOCX_DOCUMENT_PART).decode("utf-8")
+        body_start = document_xml.index("<w:body>") + len("<w:body>")
+        body_end = document_xml.index("<w:sectPr")
+        _docx_template = (
+            [(info, data) for info, data in parts if info.filename != DOCX_DOCUMENT_PART],
+            document_xml[:body_start], document_xml[body_end:]
+        )
+    return _docx_template
+
+class DocxDocumentWriter(DocumentWriter):
+    """Writes the .docx package directly, streaming word/document.xml into the zip as blocks arrive.
+    The text goes into one paragraph, exactly as doc.add_paragraph(text) would put it."""
+
+    output_format = "docx"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        parts, self._body_prefix, self._body_suffix = docx_template()
+        self.package = zipfile.ZipFile(self.temp_path, "w", zipfile.ZIP_DEFLATED)
+        for info, data in parts:
+            self.package.writestr(info, data)
+        self.document = self.package.open(DOCX_DOCUMENT_PART, "w")
+        self.document.write((self._body_prefix + "<w:p><w:r>").encode("utf-8"))
+        self.sections = 1
+
+    def _append(self, blocks: List[str]):
+        content = "<w:br/><w:br/>".join(docx_run_content(block) for block in blocks)
+        if self.blocks and blocks:
+            content = "<w:br/><w:br/>" + content
+        self.document.write(content.encode("utf-8"))
+
+    def _finish(self):
+        self.document.write(("</w:r></w:p>" + self._body_suffix).encode("utf-8"))
+        self._close()
+
+    def _close(self):
+        self.document.close()
+        self.package.close()
+
+def open_document_writer(path: str, output_format: str) -> DocumentWriter:
+    return PdfDocumentWriter(path) if output_format == "pdf" else DocxDocumentWriter(path)
+
+def render_document(blocks: List[str], path: str, output_format: str):
+    """Renders blocks (questions, skipped chunks, ...) separated by blank lines into a .pdf or .docx
+    file; PDF sections of RENDER_SECTION_BLOCKS blocks are laid out in parallel on the render pool."""
+    writer = open_document_writer(path, output_format)
+    try:
+        writer.append(blocks)
+        writer.finish()
+    except BaseException:
+        writer.abort()
+        raise
@@ -0,0 +1,309 @@
+import csv
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from services.QuestionValidator import parse_question
+from services.Storage import data_path
+from services.Rendering import render_document
+from services.StructuredOutput import question_record, render_question
+
+# ===============================================================
+# === RUN STORE & ON-DEMAND EXPORTS ===
+# ===============================================================
+# The output format used to be fixed when a run was requested, so getting the same
+# paper as both PDF and DOCX meant paying for the whole generation again. Each run's
+# validated questions are now saved once as compact JSON keyed by run_id, and any
+# export format is rendered from it when it is first downloaded. Rendered exports are
+# kept in an on-disk cache with least-recently-used eviction.
+
+RUN_STORE_DIR = os.getenv("RUN_STORE_DIR", data_path("runs"))
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", data_path("exports"))
+# Total size of cached exports; the least recently downloaded ones are deleted beyond it
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Parsed runs kept in memory (downloads of a run usually come in bursts)
+MAX_LOADED_RUNS = int(os.getenv("MAX_LOADED_RUNS", "32"))
+
+RUN_FORMAT_VERSION = 1
+# Export format -> (file suffix, media type)
+EXPORT_FORMATS = {
+    "pdf": ("pdf", "application/pdf"),
+    "docx": ("docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    "json": ("json", "application/json"),
+    "csv": ("csv", "text/csv; charset=utf-8"),
+    "answer-key": ("answer-key.pdf", "application/pdf"),
+}
+
+_RUN_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def valid_run_id(run_id: str) -> bool:
+    """run_ids end up in file names, so only plain identifiers are accepted."""
+    return bool(run_id) and _RUN_ID.match(run_id) is not None
+
+def run_path(run_id: str) -> str:
+    return os.path.join(RUN_STORE_DIR, f"{run_id}.json")
+
+def export_filename(run_id: str, export_format: str) -> str:
+    return f"Questions_{run_id}.{EXPORT_FORMATS[export_format][0]}"
+
+def _write_atomically(path: str, write: Callable[[str], None]):
+    """write(temp_path) creates the file next to path, which then replaces path in one step,
+    so readers never see a half-written run or export."""
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_", suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+# === RUN STORE ===
+_loaded_runs: "OrderedDict[str, dict]" = OrderedDict()
+_loaded_runs_lock = threading.Lock()
+
+def save_run(run_id: str, questions: List[dict], user_id: int = None, exam_name: str = None) -> str:
+    """Saves a run's validated questions in paper order: {"qtype", "topic", "text"} each, or
+    {"qtype", "topic", "question"} with the fields of a structured question. Returns the path of the run file."""
+    if not valid_run_id(run_id):
+        raise ValueError(f"Invalid run_id: {run_id!r}")
+    run = {
+        "version": RUN_FORMAT_VERSION,
+        "run_id": run_id,
+        "user_id": user_id,
+        "exam_name": exam_name,
+        "created_at": datetime.now().isoformat(),
+        "questions": questions,
+    }
+    def write(temp_path):
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(run, f, ensure_ascii=False, separators=(",", ":"))
+    path = run_path(run_id)
+    _write_atomically(path, write)
+    with _loaded_runs_lock:
+        _loaded_runs.pop(run_id, None)
+    return path
+
+def load_run(run_id: str) -> Optional[dict]:
+    """The saved run, or None if there is none."""
+    if not valid_run_id(run_id):
+        return None
+    with _loaded_runs_lock:
+        if run_id in _loaded_runs:
+            _loaded_runs.move_to_end(run_id)
+            return _loaded_runs[run_id]
+    try:
+        with open(run_path(run_id), encoding="utf-8") as f:
+            run = json.load(f)
+    except FileNotFoundError:
+        return None
+    with _loaded_runs_lock:
+        _loaded_runs[run_id] = run
+        while len(_loaded_runs) > MAX_LOADED_RUNS:
+            _loaded_runs.popitem(last=False)
+    return run
+
+# === EXPORTS ===
+def export_records(run: dict) -> List[dict]:
+    """One record per question, numbered in paper order, with the question split into its parts
+    (structured questions already are)."""
+    return [
+        {"number": number, "qtype": question["qtype"], "topic": question["topic"],
+         **(question_record(question["question"]) if "question" in question else parse_question(question["text"]))}
+        for number, question in enumerate(run["questions"], start=1)
+    ]
+
+def document_blocks(run: dict) -> List[str]:
+    """The questions of a run as document blocks; structured ones are numbered by their place in the paper."""
+    return [
+        render_question(question["question"], number) if "question" in question else question["text"]
+        for number, question in enumerate(run["questions"], start=1)
+    ]
+
+def write_json_export(run: dict, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "run_id": run["run_id"],
+            "exam_name": run["exam_name"],
+            "created_at": run["created_at"],
+            "questions": export_records(run),
+        }, f, ensure_ascii=False, indent=2)
+
+def write_csv_export(run: dict, path: str):
+    records = export_records(run)
+    num_options = max((len(record["options"]) for record in records), default=0)
+    # utf-8-sig: Excel only detects UTF-8 (symbols, non-English papers) with the BOM
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["number", "qtype", "topic", "question"] + [f"option_{i + 1}" for i in range(num_options)] + ["answer_key", "solution"])
+        for record in records:
+            options = record["options"] + [""] * (num_options - len(record["options"]))
+            answer_key = record["answer_key"] if record["answer_key"] is not None else ""
+            writer.writerow([record["number"], record["qtype"] or "", record["topic"] or "", record["stem"]] + options + [answer_key, record["solution"]])
+
+def write_answer_key_export(run: dict, path: str):
+    lines = [
+        f"{record['number']}. ({record['answer_key']})" if record["answer_key"] is not None else f"{record['number']}. -"
+        for record in export_records(run)
+    ]
+    title = f"Answer Key: {run['exam_name']}" if run.get("exam_name") else "Answer Key"
+    render_document([title, "\n".join(lines)], path, "pdf")
+
+def write_export(run: dict, export_format: str, path: str):
+    """Renders one export of a saved run to path."""
+    if export_format in ("pdf", "docx"):
+        render_document(document_blocks(run), path, export_format)
+    elif export_format == "json":
+        write_json_export(run, path)
+    elif export_format == "csv":
+        write_csv_export(run, path)
+    elif export_format == "answer-key":
+        write_answer_key_export(run, path)
+    else:
+        raise ValueError(f"Unknown export format: {export_format!r}")
+
+# === EXPORT CACHE ===
+class ExportCache:
+    """Rendered exports on disk, evicted least recently used first once they take more than
+    max_bytes. File mtimes record the last use, so the order survives restarts; an export
+    that is being rendered is rendered once, however many downloads ask for it."""
+
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes: "OrderedDict[str, int]" = None # File name -> bytes, least recently used first
+        self._total_bytes = 0
+        self._building: Dict[str, threading.Lock] = {}
+
+    def _index(self) -> "OrderedDict[str, int]":
+        """Called with the lock held; scans the cache folder on first use."""
+        if self._sizes is None:
+            os.makedirs(self.folder, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.is_file() and not entry.name.startswith(".tmp_"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+            self._sizes = OrderedDict((name, size) for _, name, size in sorted(entries))
+            self._total_bytes = sum(self._sizes.values())
+        return self._sizes
+
+    def _hit(self, name: str) -> Optional[str]:
+        """Called with the lock held; the cached file's path, marked as just used."""
+        sizes = self._index()
+        if name not in sizes:
+            return None
+        path = os.path.join(self.folder, name)
+        try:
+            os.utime(path)
+        except FileNotFoundError: # Deleted behind our back
+            self._total_bytes -= sizes.pop(name)
+            return None
+        sizes.move_to_end(name)
+        return path
+
+    def _add(self, name: str):
+        """Called with the lock held; records a new file and evicts the oldest ones over max_bytes."""
+        sizes = self._index()
+        if name in sizes:
+            self._total_bytes -= sizes.pop(name)
+        sizes[name] = os.path.getsize(os.path.join(self.folder, name))
+        self._total_bytes += sizes[name]
+        while self._total_bytes > self.max_bytes and len(sizes) > 1:
+            oldest, size = sizes.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.folder, oldest))
+            except FileNotFoundError:
+                pass
+
+    def get(self, name: str, build: Callable[[str], None]) -> str:
+        """The path of the cached file name, calling build(path) to create it on a miss."""
+        with self._lock:
+            path = self._hit(name)
+            if path is not None:
+                return path
+            building = self._building.setdefault(name, threading.Lock())
+        with building:
+            with self._lock:
+                path = self._hit(name) # Built by a concurrent download while we waited
+                if path is not None:
+                    return path
+            path = os.path.join(self.folder, name)
+            try:
+                _write_atomically(path, build)
+                with self._lock:
+                    self._add(name)
+            finally:
+                with self._lock:
+                    self._building.pop(name, None)
+        return path
+
+    def put(self, name: str, source_path: str):
+        """Adds an already rendered file (hard-linked when possible, so it takes no extra space)."""
+        def link(temp_path):
+            os.remove(temp_path)
+            try:
+                os.link(source_path, temp_path)
+            except OSError: # Different file system, or links not supported
+                shutil.copyfile(source_path, temp_path)
+        _write_atomically(os.path.join(self.folder, name), link)
+        with self._lock:
+            self._add(name)
+
+    def discard(self, prefix: str):
+        """Deletes the cached files whose names start with prefix (e.g. all exports of a run)."""
+        with self._lock:
+            sizes = self._index()
+            for name in [name for name in sizes if name.startswith(prefix)]:
+                self._total_bytes -= sizes.pop(name)
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            sizes = self._index()
+            return {"files": len(sizes), "bytes": self._total_bytes, "max_bytes": self.max_bytes}
+
+_export_cache = None
+_export_cache_lock = threading.Lock()
+
+def get_export_cache() -> ExportCache:
+    global _export_cache
+    with _export_cache_lock:
+        if _export_cache is None:
+            _export_cache = ExportCache(EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_BYTES)
+        return _export_cache
+
+def export_run(run_id: str, export_format: str) -> Optional[str]:
+    """The path of a run's export, rendered from the saved run on first use. None if the run was
+    not saved; ValueError for unknown formats."""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format!r}")
+    run = load_run(run_id)
+    if run is None:
+        return None
+    return get_export_cache().get(export_filename(run_id, export_format), lambda path: write_export(run, export_format, path))
+
+def record_run(run_id: str, questions: List[dict], user_id: int = None, exam_name: str = None, rendered: Dict[str, str] = None):
+    """Saves a finished run and seeds the export cache with the documents the run already rendered
+    ({export format: path}), so downloading them does not render them again."""
+    save_run(run_id, questions, user_id, exam_name)
+    cache = get_export_cache()
+    cache.discard(f"Questions_{run_id}.") # A re-recorded run_id must not serve stale exports
+    for export_format, path in (rendered or {}).items():
+        cache.put(export_filename(run_id, export_format), path)
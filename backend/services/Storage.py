@@ -0,0 +1,14 @@
+import os
+
+# ===============================================================
+# === LOCAL DATA DIRECTORY ===
+# ===============================================================
+# Generated files, logs, caches and saved runs all live under one data directory:
+# /app/data in the container. Set BACKEND_DATA_DIR to run the backend (or the
+# benchmarks) elsewhere, e.g. as a non-root user or against a temporary directory.
+
+BACKEND_DATA_DIR = os.getenv("BACKEND_DATA_DIR", "/app/data")
+
+def data_path(*parts: str) -> str:
+    """A path inside BACKEND_DATA_DIR."""
+    return os.path.join(BACKEND_DATA_DIR, *parts)
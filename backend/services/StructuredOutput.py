@@ -0,0 +1,187 @@
+import json
+import os
+from typing import List, Optional
+
+# ===============================================================
+# === STRUCTURED (JSON) QUESTION OUTPUT ===
+# ===============================================================
+# Instead of free text split on "--Question Starting--", GPT returns every question
+# as typed fields constrained by a JSON schema. Each question is checked on its own,
+# so one malformed question no longer costs the whole chunk. Validated questions stay
+# typed dicts through slot filling, deduplication, the question bank and the run store;
+# the text layout of the legacy format is only produced (render_question) when a
+# document or export is written.
+
+# Ask for JSON questions by default (the marker format stays available per run)
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "false").lower() == "true"
+# "json_schema" (Structured Outputs, gpt-4o-2024-08-06 and later), "json_object" (JSON mode, e.g.
+# gpt-4-turbo, which rejects json_schema) or "auto": json_schema if the model supports it
+STRUCTURED_RESPONSE_FORMAT = os.getenv("STRUCTURED_RESPONSE_FORMAT", "auto")
+# Model families accepting json_schema response formats (fine-tuned "ft:" models follow their base model)
+JSON_SCHEMA_MODEL_PREFIXES = ("gpt-4o", "gpt-4.1", "gpt-4.5", "gpt-5", "o1", "o3", "o4")
+JSON_SCHEMA_UNSUPPORTED_MODELS = ("gpt-4o-2024-05-13", "o1-preview", "o1-mini")
+NUM_OPTIONS = 4
+
+QUESTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "stem": {"type": "string", "description": "The question (with any statements, lists or tables), without its number"},
+        "options": {"type": "array", "items": {"type": "string"}, "description": f"Exactly {NUM_OPTIONS} option texts, without the (1)-(4) labels"},
+        "answer_key": {"type": "integer", "description": "Number of the correct option, 1 to 4"},
+        "solution": {"type": "string", "description": "The explanation, without the 'Solution:' label and the hence line"},
+        "hence": {"type": "string", "description": "The closing line, e.g. 'Hence, Option (2) is the right answer.'"},
+    },
+    "required": ["stem", "options", "answer_key", "solution", "hence"],
+    "additionalProperties": False,
+}
+
+QUESTION_SET_SCHEMA = {
+    "type": "object",
+    "properties": {"questions": {"type": "array", "items": QUESTION_SCHEMA}},
+    "required": ["questions"],
+    "additionalProperties": False,
+}
+
+# Packed requests: one question set per section, in section order
+PACKED_QUESTION_SET_SCHEMA = {
+    "type": "object",
+    "properties": {"sections": {"type": "array", "items": QUESTION_SET_SCHEMA}},
+    "required": ["sections"],
+    "additionalProperties": False,
+}
+
+def supports_json_schema(model: str) -> bool:
+    """Whether a model accepts {"type": "json_schema"} response formats (Structured Outputs)."""
+    model = model.lower().removeprefix("ft:")
+    return model.startswith(JSON_SCHEMA_MODEL_PREFIXES) and not model.startswith(JSON_SCHEMA_UNSUPPORTED_MODELS)
+
+def response_format(model: str, packed: bool = False) -> dict:
+    """The response_format parameter for a chat completion of `model` returning questions."""
+    format_type = STRUCTURED_RESPONSE_FORMAT
+    if format_type == "auto":
+        format_type = "json_schema" if supports_json_schema(model) else "json_object"
+    if format_type == "json_object":
+        return {"type": "json_object"}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "packed_question_sets" if packed else "question_set",
+            "strict": True,
+            "schema": PACKED_QUESTION_SET_SCHEMA if packed else QUESTION_SET_SCHEMA,
+        },
+    }
+
+def structured_instructions(num_sections: int = 1) -> str:
+    """Appended to a prompt (after its per-chunk suffix) to replace the marker format with JSON."""
+    layout = (
+        '{"questions": [QUESTION, ...]}' if num_sections == 1
+        else f'{{"sections": [{{"questions": [QUESTION, ...]}}, ...]}} with exactly {num_sections} sections, in section order'
+    )
+    return (
+        f"\n\n=== OUTPUT FORMAT ===\n"
+        f"Ignore the \"--Question Starting--\" text layout shown above and reply with JSON only: {layout}, "
+        f"one QUESTION per topic, in topic order. Each QUESTION is an object with the fields "
+        f"\"stem\" (the question with any statements, lists or tables, without its number), "
+        f"\"options\" (exactly {NUM_OPTIONS} option texts, without the (1)-(4) labels), "
+        f"\"answer_key\" (the number of the correct option, following the answer key), "
+        f"\"solution\" (the detailed explanation) and "
+        f"\"hence\" (the closing \"Hence, Option (n) is the right answer.\" line)."
+    )
+
+def structured_question_problems(item) -> List[str]:
+    """Returns what is structurally wrong with one JSON question (an empty list if it is valid)."""
+    if not isinstance(item, dict):
+        return ["not a JSON object"]
+    problems = []
+    stem, options, answer_key = item.get("stem"), item.get("options"), item.get("answer_key")
+    if not isinstance(stem, str) or not stem.strip():
+        problems.append("empty stem")
+    if not isinstance(options, list) or len(options) != NUM_OPTIONS:
+        problems.append(f"expected {NUM_OPTIONS} options")
+    elif not all(isinstance(option, str) and option.strip() for option in options):
+        problems.append("empty option")
+    elif len({" ".join(option.split()).lower() for option in options}) < NUM_OPTIONS:
+        problems.append("duplicate options")
+    if isinstance(answer_key, str) and answer_key.strip().isdigit():
+        answer_key = int(answer_key) # JSON mode (no schema) sometimes quotes numbers
+    if isinstance(answer_key, bool) or not isinstance(answer_key, int):
+        problems.append("answer key is not a number")
+    elif not 1 <= answer_key <= NUM_OPTIONS:
+        problems.append(f"answer key {answer_key} outside 1-{NUM_OPTIONS}")
+    for field in ("solution", "hence"):
+        if not isinstance(item.get(field), str) or not item[field].strip():
+            problems.append(f"empty {field}")
+    return problems
+
+def validate_question(item) -> Optional[dict]:
+    """Returns the question with its fields normalised, or None if it is structurally invalid."""
+    if structured_question_problems(item):
+        return None
+    return {
+        "stem": item["stem"].strip(),
+        "options": [option.strip() for option in item["options"]],
+        "answer_key": int(item["answer_key"]),
+        "solution": item["solution"].strip(),
+        "hence": item["hence"].strip(),
+    }
+
+def _load(content):
+    try:
+        return json.loads(content) if content else None
+    except ValueError: # Truncated or not JSON at all
+        return None
+
+def _question_items(question_set) -> list:
+    items = question_set.get("questions") if isinstance(question_set, dict) else None
+    return items if isinstance(items, list) else []
+
+def parse_structured_questions(content: str) -> list:
+    """Parses a {"questions": [...]} response into its question items, valid or not, in topic order
+    (validate_question checks them one by one)."""
+    return _question_items(_load(content))
+
+def parse_structured_sections(content: str, num_sections: int) -> List[Optional[list]]:
+    """Parses a packed {"sections": [...]} response into each section's question items; missing
+    sections come back as None."""
+    data = _load(content)
+    sections = data.get("sections") if isinstance(data, dict) else None
+    if not isinstance(sections, list):
+        return [None] * num_sections
+    return [_question_items(sections[i]) if i < len(sections) else None for i in range(num_sections)]
+
+def count_structured_questions(content: str) -> int:
+    """Questions in a plain or packed response, valid or not (0 if it is not JSON)."""
+    data = _load(content)
+    if not isinstance(data, dict):
+        return 0
+    question_sets = data.get("sections") if isinstance(data.get("sections"), list) else [data]
+    return sum(
+        len(question_set["questions"]) for question_set in question_sets
+        if isinstance(question_set, dict) and isinstance(question_set.get("questions"), list)
+    )
+
+def render_question(question: dict, number: Optional[int] = None) -> str:
+    """Renders a validated question in the text layout of the marker format (without the marker),
+    numbered `number` if given."""
+    options = "\n".join(f"({i + 1}) {option}" for i, option in enumerate(question["options"]))
+    return (
+        (f"{number}. " if number is not None else "") + f"{question['stem']}\n"
+        f"{options}\n"
+        f"Answer Key: {question['answer_key']}\n"
+        f"Solution:\n{question['solution']}\n"
+        f"{question['hence']}"
+    )
+
+def question_text(question, number: Optional[int] = None) -> str:
+    """The text of a question of either format: marker-format questions are text already, structured
+    ones (validated dicts) are rendered with render_question."""
+    return render_question(question, number) if isinstance(question, dict) else question
+
+def question_record(question) -> dict:
+    """The parts of a structured question in the layout of QuestionValidator.parse_question (for exports)."""
+    return {
+        "stem": question["stem"],
+        "options": list(question["options"]),
+        "answer_key": question["answer_key"],
+        "solution": f"{question['solution']}\n{question['hence']}",
+    }
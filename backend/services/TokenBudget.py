@@ -0,0 +1,190 @@
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Optional
+
+from services.PromptsDict import prompt_templates
+from services.Storage import data_path
+
+try:
+    import tiktoken
+except ImportError: # Optional: falls back to the ~4 characters per token rule
+    tiktoken = None
+
+# ===============================================================
+# === TOKEN BUDGETS ===
+# ===============================================================
+# Predicts input/output tokens and cost of a run before it starts, and sizes
+# max_tokens per request from how many output tokens each qtype actually used
+# per question in past responses (persisted across restarts). Until a qtype has
+# been observed, the example questions of its prompt template stand in.
+
+OUTPUT_TOKEN_STATS_PATH = os.getenv("OUTPUT_TOKEN_STATS_PATH", data_path("output_token_stats.json"))
+# Used for a qtype until it has been observed at least once, if its template has no example question
+DEFAULT_OUTPUT_TOKENS_PER_QUESTION = int(os.getenv("DEFAULT_OUTPUT_TOKENS_PER_QUESTION", "600"))
+# The templates' example questions follow this marker (Generation.QUESTION_MARKER)
+TEMPLATE_QUESTION_MARKER = "--Question Starting--"
+# max_tokens = expected output * headroom, so a longer-than-usual response is not cut off
+MAX_TOKENS_HEADROOM = float(os.getenv("MAX_TOKENS_HEADROOM", "1.5"))
+MIN_MAX_TOKENS = 256
+# Upper bound for a single completion (gpt-4-turbo caps output at 4096 tokens)
+GPT_MAX_OUTPUT_TOKENS = int(os.getenv("GPT_MAX_OUTPUT_TOKENS", "4096"))
+# Weight of the newest response in the per-qtype moving average
+OUTPUT_STATS_SMOOTHING = 0.2
+# The stats file is rewritten at most this often (and at exit), not on every response
+OUTPUT_STATS_SAVE_SECONDS = float(os.getenv("OUTPUT_STATS_SAVE_SECONDS", "30"))
+
+# USD per 1K tokens (gpt-4-turbo list prices by default)
+INPUT_PRICE_PER_1K = float(os.getenv("OPENAI_INPUT_PRICE_PER_1K", "0.01"))
+OUTPUT_PRICE_PER_1K = float(os.getenv("OPENAI_OUTPUT_PRICE_PER_1K", "0.03"))
+
+_encodings = {}
+
+def _encoding_for(model: str):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+def tokenizer_name() -> str:
+    return "tiktoken" if tiktoken is not None else "chars/4"
+
+def count_tokens(text: str, model: str = "gpt-4-turbo") -> int:
+    """Counts the tokens of a text with tiktoken when installed, ~4 characters per token otherwise."""
+    if not text:
+        return 0
+    if tiktoken is None:
+        return len(text) // 4
+    return len(_encoding_for(model).encode(text))
+
+@lru_cache(maxsize=None)
+def template_tokens_per_question(qtype: str) -> float:
+    """Output tokens per question a qtype's prompt template implies: the tokens of its longest example
+    question (DEFAULT_OUTPUT_TOKENS_PER_QUESTION if the template has none)."""
+    # Examples start on a line of their own (the instructions quote the marker mid-line)
+    examples = prompt_templates.get(qtype, "").split("\n" + TEMPLATE_QUESTION_MARKER)[1:]
+    return max((count_tokens(example) for example in examples), default=0) or DEFAULT_OUTPUT_TOKENS_PER_QUESTION
+
+class OutputTokenModel:
+    """Moving average of completion tokens per question, per qtype, stored as JSON."""
+
+    def __init__(self, path: str = OUTPUT_TOKEN_STATS_PATH):
+        self.path = path
+        self.stats: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.stats = json.load(f)
+        except (OSError, ValueError):
+            self.stats = {}
+
+    def tokens_per_question(self, qtype: str) -> float:
+        with self._lock:
+            entry = self.stats.get(qtype)
+            if entry:
+                return entry["tokens_per_question"]
+        return template_tokens_per_question(qtype)
+
+    def max_tokens_for(self, qtype: str, num_questions: int) -> int:
+        """max_tokens for a request asking for num_questions questions of a qtype."""
+        expected = self.tokens_per_question(qtype) * max(1, num_questions)
+        return max(MIN_MAX_TOKENS, min(GPT_MAX_OUTPUT_TOKENS, math.ceil(expected * MAX_TOKENS_HEADROOM)))
+
+    def fits_output_budget(self, qtype: str, num_questions: int) -> bool:
+        """Whether num_questions questions of a qtype (with headroom) fit in GPT_MAX_OUTPUT_TOKENS,
+        i.e. max_tokens_for does not have to cap the request."""
+        return self.tokens_per_question(qtype) * max(1, num_questions) * MAX_TOKENS_HEADROOM <= GPT_MAX_OUTPUT_TOKENS
+
+    def max_questions_per_request(self, qtype: str) -> int:
+        """The most questions of a qtype that fits_output_budget allows in one request."""
+        return max(1, int(GPT_MAX_OUTPUT_TOKENS / (self.tokens_per_question(qtype) * MAX_TOKENS_HEADROOM)))
+
+    def observe(self, qtype: str, num_questions: int, completion_tokens: Optional[int], truncated: bool = False):
+        """Feeds one response into the average. A response cut off by max_tokens ends in a partial
+        question, which is not counted."""
+        if truncated:
+            num_questions -= 1
+        if not completion_tokens or num_questions <= 0:
+            return
+        observed = completion_tokens / num_questions
+        with self._lock:
+            entry = self.stats.get(qtype)
+            if entry is None:
+                entry = self.stats[qtype] = {"tokens_per_question": observed, "samples": 0}
+            else:
+                entry["tokens_per_question"] += OUTPUT_STATS_SMOOTHING * (observed - entry["tokens_per_question"])
+            entry["samples"] += 1
+            self._dirty = True
+            save_due = time.monotonic() - self._saved_at >= OUTPUT_STATS_SAVE_SECONDS
+        if save_due:
+            self.save()
+
+    def save(self):
+        """Writes the stats if they changed since the last save; the file is written outside the
+        stats lock, so responses are not held up by disk I/O."""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                snapshot = json.dumps(self.stats, indent=2)
+                self._dirty = False
+                self._saved_at = time.monotonic()
+            try:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(snapshot)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"⚠️ Could not save output token stats: {e}")
+
+_output_token_model = None
+_output_token_model_lock = threading.Lock()
+
+def get_output_token_model() -> OutputTokenModel:
+    """Returns the process-wide output token model, loading it on first use."""
+    global _output_token_model
+    if _output_token_model is None:
+        with _output_token_model_lock:
+            if _output_token_model is None:
+                _output_token_model = OutputTokenModel()
+                atexit.register(_output_token_model.save)
+    return _output_token_model
+
+def estimate_requests(requests, system_prompt: str, model: str = "gpt-4-turbo") -> dict:
+    """Estimates tokens and cost for (qtype, prompt, num_questions) requests, without calling the API."""
+    output_model = get_output_token_model()
+    system_tokens = count_tokens(system_prompt, model)
+    per_qtype = {}
+    for qtype, prompt, num_questions in requests:
+        row = per_qtype.setdefault(qtype, {
+            "requests": 0, "questions": 0, "input_tokens": 0, "output_tokens": 0, "max_tokens": 0,
+            "output_tokens_per_question": round(output_model.tokens_per_question(qtype), 1)
+        })
+        row["requests"] += 1
+        row["questions"] += num_questions
+        row["input_tokens"] += system_tokens + count_tokens(prompt, model)
+        row["output_tokens"] += math.ceil(output_model.tokens_per_question(qtype) * num_questions)
+        row["max_tokens"] += output_model.max_tokens_for(qtype, num_questions)
+
+    input_tokens = sum(row["input_tokens"] for row in per_qtype.values())
+    output_tokens = sum(row["output_tokens"] for row in per_qtype.values())
+    return {
+        "requests": sum(row["requests"] for row in per_qtype.values()),
+        "questions": sum(row["questions"] for row in per_qtype.values()),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "max_tokens": sum(row["max_tokens"] for row in per_qtype.values()),
+        # Upper bound: assumes no prompt-cache hits
+        "estimated_cost_usd": round(input_tokens / 1000 * INPUT_PRICE_PER_1K + output_tokens / 1000 * OUTPUT_PRICE_PER_1K, 4),
+        "tokenizer": tokenizer_name(),
+        "per_qtype": per_qtype,
+    }
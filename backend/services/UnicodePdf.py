@@ -0,0 +1,385 @@
+import os
+import re
+import threading
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import accumulate
+from typing import Optional
+
+import fpdf.fpdf
+from fpdf import FPDF, set_global
+from fpdf.php import sprintf
+from fpdf.ttfonts import TTFontFile
+
+# ===============================================================
+# === UNICODE PDF FONTS ===
+# ===============================================================
+# The core PDF fonts only cover latin-1, so maths symbols, arrows and non-English
+# text came out as '?'. PDFs are set in an embedded TrueType font instead, subsetted
+# to the characters a document uses. fpdf 1.7.2 parses and subsets the font again for
+# every document, tracks used characters in an ever-growing list and lays Unicode text
+# out one method call per character. Here parsed fonts and embedded subsets are cached
+# per process, and the justified multi_cell the papers use is laid out word by word.
+
+# TrueType font for PDFs (fonts-dejavu-core in the Docker image); without it (or set to "") PDFs use the latin-1 core font
+PDF_UNICODE_FONT = os.getenv("PDF_UNICODE_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+UNICODE_FONT_FAMILY = "Unicode"
+# Embedded font subsets kept per process (documents using the same characters share one)
+MAX_CACHED_SUBSETS = 32
+
+# Fonts are cached in memory below, so fpdf must not write .pkl metric files next to them
+set_global("FPDF_CACHE_MODE", 1)
+
+class CachedTTFontFile(TTFontFile):
+    """fpdf's TrueType parser, parsing every font file once per process."""
+
+    _metrics = {}
+    _lock = threading.Lock()
+
+    def getMetrics(self, file):
+        with self._lock:
+            parsed = self._metrics.get(file)
+            if parsed is None:
+                parsed = self._metrics[file] = TTFontFile()
+                parsed.getMetrics(file)
+        self.__dict__.update(parsed.__dict__)
+
+# FPDF.add_font creates a TTFontFile per document (fpdf is pinned to 1.7.2)
+fpdf.fpdf.TTFontFile = CachedTTFontFile
+
+class GlyphSubset(set):
+    """The characters a document uses in a TrueType font. fpdf keeps them in a list with one
+    entry per character drawn, which made membership tests while writing the font quadratic."""
+
+    def append(self, code: int):
+        self.add(code)
+
+class EmbeddedFont:
+    """The parts of a TrueType font object that only depend on the font and the glyph subset: the
+    subset font program and CIDToGIDMap (compressed) and the /W glyph widths entry."""
+
+    def __init__(self, widths: str, cid_to_gid_map: bytes, font_program: bytes, font_program_size: int):
+        self.widths = widths
+        self.cid_to_gid_map = cid_to_gid_map
+        self.font_program = font_program
+        self.font_program_size = font_program_size
+
+_embedded_fonts: "OrderedDict[tuple, EmbeddedFont]" = OrderedDict()
+_embedded_fonts_lock = threading.Lock()
+
+# ToUnicode CMap of every TrueType font (fpdf maps CIDs to Unicode one to one)
+TO_UNICODE_CMAP = (
+    "/CIDInit /ProcSet findresource begin\n"
+    "12 dict begin\n"
+    "begincmap\n"
+    "/CIDSystemInfo\n"
+    "<</Registry (Adobe)\n"
+    "/Ordering (UCS)\n"
+    "/Supplement 0\n"
+    ">> def\n"
+    "/CMapName /Adobe-Identity-UCS def\n"
+    "/CMapType 2 def\n"
+    "1 begincodespacerange\n"
+    "<0000> <FFFF>\n"
+    "endcodespacerange\n"
+    "1 beginbfrange\n"
+    "<0000> <FFFF> <0000>\n"
+    "endbfrange\n"
+    "endcmap\n"
+    "CMapName currentdict /CMap defineresource pop\n"
+    "end\n"
+    "end"
+)
+
+class _WordWidths(dict):
+    """Width of words in a TrueType font, in 1/1000 of the font size, computed on first use."""
+
+    def __init__(self, font: dict):
+        super().__init__()
+        self.widths = font['cw']
+        self.missing = font['desc'].get('MissingWidth') or 500
+
+    def __missing__(self, word: str) -> int:
+        widths = self.widths
+        try:
+            width = sum(map(widths.__getitem__, map(ord, word)))
+        except IndexError: # Characters past the font's character map
+            width = sum(widths[code] if code < len(widths) else self.missing for code in map(ord, word))
+        self[word] = width
+        return width
+
+class _EscapedUtf16(dict):
+    """Code point -> its UTF-16BE bytes as escaped in a PDF string (as FPDF writes them), for str.translate."""
+
+    def __missing__(self, code: int) -> str:
+        escaped = self[code] = FPDF._escape(None, chr(code).encode('utf-16-be').decode('latin1'))
+        return escaped
+
+_ESCAPED_UTF16 = _EscapedUtf16()
+# Not a latin-1 character, so it cannot appear in translated text
+_WORD_GAP = "\u0100"
+_ESCAPED_UTF16_WORDS = _EscapedUtf16({ord(" "): _WORD_GAP})
+
+@lru_cache(maxsize=8)
+def _unwritable(last_code: int):
+    """Lone surrogates (e.g. from JSON escapes) and characters past a font's last code point."""
+    beyond = f"{chr(last_code + 1)}-\U0010ffff" if last_code < 0x10FFFF else ""
+    return re.compile(f"[\ud800-\udfff{beyond}]")
+
+_font_available = None
+
+def unicode_font_available() -> bool:
+    global _font_available
+    if _font_available is None:
+        _font_available = bool(PDF_UNICODE_FONT) and os.path.exists(PDF_UNICODE_FONT)
+        if PDF_UNICODE_FONT and not _font_available:
+            print(f"⚠️ PDF_UNICODE_FONT {PDF_UNICODE_FONT!r} not found. PDFs fall back to latin-1 text.")
+    return _font_available
+
+class UnicodeFPDF(FPDF):
+    """FPDF for the cached TrueType font. Justified multi_cell text without borders (what the
+    papers use) is broken into lines word by word, and TrueType fonts are embedded from the
+    EmbeddedFont cache, with the same output as FPDF."""
+
+    def __init__(self, *args, **kwargs):
+        FPDF.__init__(self, *args, **kwargs)
+        self._word_widths = {}
+
+    def add_font(self, family, style='', fname='', uni=False):
+        FPDF.add_font(self, family, style, fname, uni)
+        fontkey = ("helvetica" if family.lower() == "arial" else family.lower()) + ("BI" if style.upper() == "IB" else style.upper())
+        if uni and not isinstance(self.fonts[fontkey]['subset'], GlyphSubset):
+            self.fonts[fontkey]['subset'] = GlyphSubset(self.fonts[fontkey]['subset'])
+
+    def add_unicode_font(self) -> Optional[str]:
+        """Registers PDF_UNICODE_FONT and returns its family (None if the font is not available)."""
+        if not unicode_font_available():
+            return None
+        self.add_font(UNICODE_FONT_FAMILY, '', PDF_UNICODE_FONT, uni=True)
+        return UNICODE_FONT_FAMILY
+
+    def writable(self, text: str) -> str:
+        """text with the characters FPDF fails on in the current TrueType font replaced by '?': lone
+        surrogates and those past its character map (e.g. emoji in DejaVu Sans)."""
+        last_code = len(self.current_font['cw']) - 1
+        if not text or max(text) <= chr(min(last_code, 0xD7FF)):
+            return text
+        return _unwritable(last_code).sub("?", text)
+
+    def word_widths(self) -> _WordWidths:
+        fontkey = self.current_font['fontkey']
+        widths = self._word_widths.get(fontkey)
+        if widths is None:
+            widths = self._word_widths[fontkey] = _WordWidths(self.current_font)
+        return widths
+
+    def get_string_width(self, s):
+        if not self.unifontsubset:
+            return FPDF.get_string_width(self, s)
+        return self.word_widths()[s] * self.font_size / 1000.0
+
+    def multi_cell(self, w, h, txt='', border=0, align='J', fill=0, split_only=False):
+        if not self.unifontsubset or border or fill or split_only or align != 'J' or not self.page:
+            return FPDF.multi_cell(self, w, h, txt, border, align, fill, split_only)
+        if w == 0:
+            w = self.w - self.r_margin - self.x
+        wmax = (w - 2 * self.c_margin) * 1000.0 / self.font_size
+        text = txt.replace("\r", "")
+        if text.endswith("\n"):
+            text = text[:-1]
+        self.current_font['subset'].update(map(ord, text))
+        widths = self.word_widths()
+        for paragraph in text.split("\n"):
+            for line, width_before_space, spaces in self._break_lines(paragraph, wmax, widths):
+                if spaces is None:
+                    self._reset_word_spacing()
+                else: # Justified
+                    self.ws = (wmax - width_before_space) / 1000.0 * self.font_size / (spaces - 1) if spaces > 1 else 0
+                    self._out(sprintf('%.3f Tw', self.ws * self.k))
+                self._line_cell(w, h, line)
+        self.x = self.l_margin
+        return []
+
+    def _reset_word_spacing(self):
+        if self.ws > 0:
+            self.ws = 0
+            self._out('0 Tw')
+
+    @staticmethod
+    def _break_lines(paragraph: str, wmax: float, widths: _WordWidths):
+        """FPDF's line breaking: a line ends at its last space once the width is exceeded, and words
+        wider than a line are cut. Yields (line, width before that space, spaces in the line) for lines
+        ending at a space, and (line, None, None) for cut words and the paragraph's last line."""
+        if widths[paragraph] <= wmax:
+            yield paragraph, None, None
+            return
+        space = widths[" "]
+        words = paragraph.split(" ")
+        # Width of (and character offset into the paragraph at) the start of every word
+        word_starts = list(accumulate((widths[word] + space for word in words), initial=0))
+        offsets = list(accumulate((len(word) + 1 for word in words), initial=0))
+        first = 0 # First word of the line
+        base = 0 # word_starts[first], less when the line starts with the rest of a cut word
+        start = 0 # First character of the line
+        while True:
+            # The line ends before the first word that does not fit: word_starts[end + 1] - space - base > wmax
+            end = bisect_right(word_starts, wmax + space + base, first + 1) - 1
+            if end == len(words):
+                yield paragraph[start:], None, None
+                return
+            if end > first:
+                yield paragraph[start:offsets[end] - 1], word_starts[end] - space - base, end - first
+                first, base, start = end, word_starts[end], offsets[end]
+                continue
+            # The word is wider than a line: cut it character by character, as FPDF does
+            width = 0
+            i, word_end = start, offsets[first] + len(words[first])
+            while i < word_end:
+                width += widths[paragraph[i]]
+                if width > wmax:
+                    if i == start:
+                        i += 1
+                    yield paragraph[start:i], None, None
+                    start, width = i, 0
+                else:
+                    i += 1
+            base = word_starts[first + 1] - space - width
+
+    def _line_cell(self, w, h, txt):
+        """FPDF.cell(w, h, txt, 0, 2, 'J', 0) for the current TrueType font."""
+        if self.color_flag or self.underline:
+            return FPDF.cell(self, w, h, txt, 0, 2, 'J', 0)
+        k = self.k
+        if self.y + h > self.page_break_trigger and not self.in_footer and self.accept_page_break():
+            x, ws = self.x, self.ws
+            if ws > 0:
+                self.ws = 0
+                self._out('0 Tw')
+            self.add_page(self.cur_orientation)
+            self.x = x
+            if ws > 0:
+                self.ws = ws
+                self._out(sprintf('%.3f Tw', ws * k))
+        if txt != '':
+            x = (self.x + self.c_margin) * k
+            y = (self.h - (self.y + .5 * h + .3 * self.font_size)) * k
+            if self.ws:
+                # Tw has no effect on two-byte text: spaces are widened with TJ adjustments
+                gap = sprintf(') %d(%s) (', -(self.ws * self.k) * 1000 / self.font_size_pt, _ESCAPED_UTF16[ord(' ')])
+                words = txt.translate(_ESCAPED_UTF16_WORDS).replace(_WORD_GAP, gap)
+                self._out(sprintf('BT 0 Tw %.2F %.2F Td [', x, y) + '(' + words + ') ] TJ ET')
+            else:
+                self._out(sprintf('BT %.2f %.2f Td (%s) Tj ET', x, y, txt.translate(_ESCAPED_UTF16)))
+        self.lasth = h
+        self.y += h
+
+    def _putfonts(self):
+        """FPDF._putfonts, with the TrueType fonts written from the per-process EmbeddedFont cache."""
+        fonts = self.fonts
+        truetype = sorted((font for font in fonts.values() if font['type'] == 'TTF'), key=lambda font: font['i'])
+        self.fonts = {key: font for key, font in fonts.items() if font['type'] != 'TTF'}
+        try:
+            FPDF._putfonts(self)
+        finally:
+            self.fonts = fonts
+        for font in truetype:
+            self._put_truetype_font(font, self._embedded_font(font))
+
+    def _embedded_font(self, font: dict) -> EmbeddedFont:
+        # fpdf subsets the characters used without 0 (the subset starts as range(0, 32))
+        codes = frozenset(font['subset']) - {0}
+        key = (font['ttffile'], codes)
+        with _embedded_fonts_lock:
+            embedded = _embedded_fonts.get(key)
+            if embedded is not None:
+                _embedded_fonts.move_to_end(key)
+                return embedded
+        ttf = TTFontFile()
+        font_program = ttf.makeSubset(font['ttffile'], sorted(codes))
+        cid_to_gid_map = bytearray(256 * 256 * 2)
+        for code, glyph in ttf.codeToGlyph.items():
+            cid_to_gid_map[code * 2] = glyph >> 8
+            cid_to_gid_map[code * 2 + 1] = glyph & 0xFF
+        widths = []
+        self._out = widths.append # _putTTfontwidths writes the /W entry
+        try:
+            FPDF._putTTfontwidths(self, font, ttf.maxUni)
+        finally:
+            del self._out
+        embedded = EmbeddedFont(
+            ''.join(widths), zlib.compress(bytes(cid_to_gid_map)), zlib.compress(font_program), len(font_program)
+        )
+        with _embedded_fonts_lock:
+            _embedded_fonts[key] = embedded
+            while len(_embedded_fonts) > MAX_CACHED_SUBSETS:
+                _embedded_fonts.popitem(last=False)
+        return embedded
+
+    def _put_truetype_font(self, font: dict, embedded: EmbeddedFont):
+        """The objects FPDF._putfonts writes for a TrueType font."""
+        font['n'] = self.n + 1
+        fontname = 'MPDFAA' + '+' + font['name']
+        # Type0 font, composed of the CIDFont below
+        self._newobj()
+        self._out('<</Type /Font')
+        self._out('/Subtype /Type0')
+        self._out('/BaseFont /' + fontname)
+        self._out('/Encoding /Identity-H')
+        self._out('/DescendantFonts [' + str(self.n + 1) + ' 0 R]')
+        self._out('/ToUnicode ' + str(self.n + 2) + ' 0 R')
+        self._out('>>')
+        self._out('endobj')
+        # CIDFontType2: glyphs from the TrueType font program
+        self._newobj()
+        self._out('<</Type /Font')
+        self._out('/Subtype /CIDFontType2')
+        self._out('/BaseFont /' + fontname)
+        self._out('/CIDSystemInfo ' + str(self.n + 2) + ' 0 R')
+        self._out('/FontDescriptor ' + str(self.n + 3) + ' 0 R')
+        if font['desc'].get('MissingWidth'):
+            self._out('/DW %d' % font['desc']['MissingWidth'])
+        self._out(embedded.widths)
+        self._out('/CIDToGIDMap ' + str(self.n + 4) + ' 0 R')
+        self._out('>>')
+        self._out('endobj')
+        # ToUnicode
+        self._newobj()
+        self._out('<</Length ' + str(len(TO_UNICODE_CMAP)) + '>>')
+        self._putstream(TO_UNICODE_CMAP)
+        self._out('endobj')
+        # CIDSystemInfo
+        self._newobj()
+        self._out('<</Registry (Adobe)')
+        self._out('/Ordering (UCS)')
+        self._out('/Supplement 0')
+        self._out('>>')
+        self._out('endobj')
+        # Font descriptor
+        self._newobj()
+        self._out('<</Type /FontDescriptor')
+        self._out('/FontName /' + fontname)
+        for kd in ('Ascent', 'Descent', 'CapHeight', 'Flags', 'FontBBox', 'ItalicAngle', 'StemV', 'MissingWidth'):
+            v = font['desc'][kd]
+            if kd == 'Flags':
+                v = (v | 4) & ~32 # Not symbolic
+            self._out(' /%s %s' % (kd, v))
+        self._out('/FontFile2 ' + str(self.n + 2) + ' 0 R')
+        self._out('>>')
+        self._out('endobj')
+        # CIDToGIDMap
+        self._newobj()
+        self._out('<</Length ' + str(len(embedded.cid_to_gid_map)))
+        self._out('/Filter /FlateDecode')
+        self._out('>>')
+        self._putstream(embedded.cid_to_gid_map)
+        self._out('endobj')
+        # Font program
+        self._newobj()
+        self._out('<</Length ' + str(len(embedded.font_program)))
+        self._out('/Filter /FlateDecode')
+        self._out('/Length1 ' + str(embedded.font_program_size))
+        self._out('>>')
+        self._putstream(embedded.font_program)
+        self._out('endobj')
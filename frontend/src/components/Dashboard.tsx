@@ -48,6 +48,18 @@ interface QuestionGenerationRequest {
   output_format: 'pdf' | 'docx';
   questions_per_chunk: number;
   syllabus_id: number; // <-- ADDED
+  cancel_on_disconnect?: boolean;
+}
+
+interface GenerationJob {
+  job_id: string;
+  status: 'queued' | 'running' | 'completed' | 'failed' | 'cancelled';
+  message: string;
+  chunks_total: number;
+  chunks_done: number;
+  chunks_failed: number;
+  files: { [key: string]: string };
+  error?: string | null;
 }
 
 // --- NEW INTERFACE ---
@@ -68,6 +80,9 @@ const formatFilenameForDisplay = (filename: string): string => {
 
 // const numQuestionsChunk = 3;
 const numQuestionsChunk = 5;
+const JOB_POLL_INTERVAL_MS = 3000;
+
+const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms));
 
 // --- MAIN COMPONENT ---
 const Dashboard: React.FC<DashboardProps> = ({ user, onLogout }) => {
@@ -84,6 +99,7 @@ const Dashboard: React.FC<DashboardProps> = ({ user, onLogout }) => {
   const [questionPlan, setQuestionPlan] = useState<{ [key: string]: number }>({});
   const [testingMode, setTestingMode] = useState(false);
   const [isGenerating, setIsGenerating] = useState(false);
+  const [generationProgress, setGenerationProgress] = useState<string | null>(null);
   const [outputFormat, setOutputFormat] = useState<'pdf' | 'docx'>('pdf');
   const [generationResult, setGenerationResult] = useState<{
     success: boolean;
@@ -232,7 +248,8 @@ const Dashboard: React.FC<DashboardProps> = ({ user, onLogout }) => {
         exam_name: examName,
         output_format: outputFormat,
         questions_per_chunk: numQuestionsChunk,
-        syllabus_id: selectedSyllabusId // <-- PASS THE ID
+        syllabus_id: selectedSyllabusId, // <-- PASS THE ID
+        cancel_on_disconnect: true // Closing the tab stops the run instead of leaving it billing
       };
 
       const response = await fetch(`${API_BASE_URL}/api/generate-questions`, {
@@ -252,12 +269,86 @@ const Dashboard: React.FC<DashboardProps> = ({ user, onLogout }) => {
       if (!response.ok) {
         setGenerationResult({ success: false, message: result.detail || 'An unknown server error occurred.' });
       } else {
-        setGenerationResult(result);
+        const finished = await streamJobEvents(result.job_id, token);
+        setGenerationResult(finished ?? await waitForJob(result.job_id, token));
       }
     } catch (error) {
       setGenerationResult({ success: false, message: `An unexpected error occurred: ${error}` });
     } finally {
       setIsGenerating(false);
+      setGenerationProgress(null);
+    }
+  };
+
+  // Follows the job's Server-Sent Events stream; returns null if the stream breaks so we can fall back to polling
+  const streamJobEvents = async (jobId: string, token: string | null) => {
+    try {
+      const response = await fetch(`${API_BASE_URL}/api/generate-questions/${jobId}/events`, {
+        headers: { 'Authorization': `Bearer ${token}`, 'Accept': 'text/event-stream' }
+      });
+      if (!response.ok || !response.body) return null;
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let chunksTotal = 0;
+      let chunksFinished = 0;
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) return null;
+        buffer += decoder.decode(value, { stream: true });
+        const messages = buffer.split('\n\n');
+        buffer = messages.pop() || '';
+        for (const message of messages) {
+          const eventLine = message.split('\n').find(line => line.startsWith('event: '));
+          const dataLine = message.split('\n').find(line => line.startsWith('data: '));
+          if (!eventLine || !dataLine) continue;
+          const event = eventLine.slice('event: '.length);
+          const data = JSON.parse(dataLine.slice('data: '.length));
+          if (event === 'generation_started') {
+            chunksTotal = data.total_chunks;
+          } else if (event === 'chunk_validated' || event === 'chunk_skipped') {
+            chunksFinished += 1;
+          } else if (event === 'document_rendered') {
+            setGenerationProgress(`rendering ${data.document}`);
+            continue;
+          } else if (event === 'upload_done') {
+            setGenerationProgress(`uploaded ${data.document}`);
+            continue;
+          } else if (event === 'job_finished') {
+            reader.cancel();
+            return data.status === 'completed'
+              ? { success: true, message: data.message, files: data.files }
+              : { success: false, message: data.error || data.message };
+          }
+          if (chunksTotal > 0) setGenerationProgress(`${chunksFinished}/${chunksTotal} chunks`);
+        }
+      }
+    } catch (error) {
+      return null;
+    }
+  };
+
+  // Generation runs as a background job; poll it until it finishes
+  const waitForJob = async (jobId: string, token: string | null) => {
+    while (true) {
+      await sleep(JOB_POLL_INTERVAL_MS);
+      const response = await fetch(`${API_BASE_URL}/api/jobs/${jobId}`, {
+        headers: { 'Authorization': `Bearer ${token}` }
+      });
+      const job: GenerationJob = await response.json();
+      if (!response.ok) {
+        return { success: false, message: (job as any).detail || 'Lost track of the generation job.' };
+      }
+      if (job.status === 'completed') {
+        return { success: true, message: job.message, files: job.files };
+      }
+      if (job.status === 'failed' || job.status === 'cancelled') {
+        return { success: false, message: job.error || job.message };
+      }
+      if (job.chunks_total > 0) {
+        setGenerationProgress(`${job.chunks_done + job.chunks_failed}/${job.chunks_total} chunks`);
+      }
     }
   };
 
@@ -612,7 +703,7 @@ const Dashboard: React.FC<DashboardProps> = ({ user, onLogout }) => {
                       disabled={isGenerating || isSyllabusLoading || !selectedSyllabusId} // <-- MODIFIED disabled state
                       className="w-full flex items-center justify-center gap-2 px-6 py-3 bg-gradient-to-r from-cyan-500 to-cyan-600 text-white rounded-lg font-semibold text-lg disabled:opacity-50 disabled:cursor-not-allowed"
                     >
-                      {isGenerating ? <><Loader2 className="w-6 h-6 animate-spin" /> Generating...</> : <><Plus className="w-6 h-6" /> Generate Test</>}
+                      {isGenerating ? <><Loader2 className="w-6 h-6 animate-spin" /> Generating{generationProgress ? ` (${generationProgress})` : ''}...</> : <><Plus className="w-6 h-6" /> Generate Test</>}
                     </button>
                   </div>
                 </div>